@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of concurrent CustodiaStoreHandler gets of HostCreds models
+against a local Custodia stand-in on a unix socket.
+
+Several threads share one handler, as with the "storage_workers" setting
+of the StorageService.  Compares connection pool sizes, with and without
+keep-alive.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import commissaire.models as models
+
+from commissaire_service.storage.custodia import CustodiaStoreHandler
+
+from custodia_standin import CustodiaStandIn
+
+
+def run_gets(handler, threads, count, addresses):
+    """
+    Gets HostCreds models from several threads and returns the elapsed
+    seconds.
+
+    :param handler: The store handler to get with
+    :type handler: CustodiaStoreHandler
+    :param threads: Number of threads
+    :type threads: int
+    :param count: Number of gets
+    :type count: int
+    :param addresses: Addresses of saved HostCreds
+    :type addresses: list
+    :rtype: float
+    """
+    def get(i):
+        handler._get(models.HostCreds.new(
+            address=addresses[i % len(addresses)]))
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(threads) as executor:
+        list(executor.map(get, range(count)))
+    return time.monotonic() - start
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '-n', '--number', type=int, default=2000,
+        help='Gets per measurement')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=8,
+        help='Threads sharing the handler')
+    parser.add_argument(
+        '-l', '--latency', type=float, default=1.0,
+        help='Milliseconds the stand-in waits before each reply')
+    parser.add_argument(
+        '-p', '--pool-sizes', type=int, nargs='+', default=[1, 4, 8],
+        help='Connection pool sizes to compare')
+    args = parser.parse_args()
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'custodia.sock')
+    with CustodiaStandIn(socket_path, args.latency / 1000.0):
+        addresses = ['10.0.0.{}'.format(i) for i in range(1, 101)]
+        handler = CustodiaStoreHandler({'socket_path': socket_path})
+        for address in addresses:
+            handler._save(models.HostCreds.new(
+                address=address, ssh_priv_key='', remote_user='root'))
+
+        for pool_size in args.pool_sizes:
+            for keep_alive in (True, False):
+                handler = CustodiaStoreHandler({
+                    'socket_path': socket_path,
+                    'pool_size': pool_size,
+                    'keep_alive': keep_alive,
+                })
+                elapsed = run_gets(
+                    handler, args.threads, args.number, addresses)
+                print('pool_size={:<3} keep_alive={:<5} {:10.1f} gets per '
+                      'second'.format(
+                          pool_size, str(keep_alive),
+                          args.number / elapsed))
+    os.rmdir(os.path.dirname(socket_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of CustodiaStoreHandler save throughput for HostCreds models
+against a local Custodia stand-in on a unix socket.
+
+Compares creating the key container before every save against
+remembering key containers known to exist.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import commissaire.models as models
+
+from commissaire_service.storage.custodia import CustodiaStoreHandler
+
+from custodia_standin import CustodiaStandIn
+
+
+def run_saves(handler, count, forget_containers):
+    """
+    Saves HostCreds models and returns the elapsed seconds.
+
+    :param handler: The store handler to save with
+    :type handler: CustodiaStoreHandler
+    :param count: Number of saves
+    :type count: int
+    :param forget_containers: Forget known key containers before each save
+    :type forget_containers: bool
+    :rtype: float
+    """
+    start = time.monotonic()
+    for i in range(count):
+        if forget_containers:
+            handler._known_containers.clear()
+        handler._save(models.HostCreds.new(
+            address='10.0.{}.{}'.format(i // 256 % 256, i % 256),
+            ssh_priv_key='', remote_user='root'))
+    return time.monotonic() - start
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '-n', '--number', type=int, default=2000,
+        help='Saves per measurement')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=3,
+        help='Measurements per variant; the best is reported')
+    parser.add_argument(
+        '-l', '--latency', type=float, default=0.0,
+        help='Milliseconds the stand-in waits before each reply')
+    args = parser.parse_args()
+
+    socket_path = os.path.join(tempfile.mkdtemp(), 'custodia.sock')
+    with CustodiaStandIn(socket_path, args.latency / 1000.0):
+        handler = CustodiaStoreHandler({'socket_path': socket_path})
+        variants = [
+            ('POST + PUT', True),
+            ('known containers', False),
+        ]
+        for name, forget_containers in variants:
+            best = min(
+                run_saves(handler, args.number, forget_containers)
+                for _ in range(args.repeat))
+            print('{:<20} {:10.1f} saves per second'.format(
+                name, args.number / best))
+    os.rmdir(os.path.dirname(socket_path))
+
+
+if __name__ == '__main__':
+    main()
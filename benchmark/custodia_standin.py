@@ -0,0 +1,132 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A minimal local stand-in for the Custodia secrets API on a unix socket,
+for benchmarking CustodiaStoreHandler.  Keys are kept in memory.
+"""
+
+import os
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers Custodia key container and key requests.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body=b''):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _split_path(self):
+        # /secrets/<container>/ or /secrets/<container>/<key>
+        container, _, key = self.path[len('/secrets/'):].partition('/')
+        return container, key
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        self._read_body()
+        container, _ = self._split_path()
+        with self.server.lock:
+            if container in self.server.containers:
+                status = 409
+            else:
+                self.server.containers[container] = {}
+                status = 201
+        self._reply(status)
+
+    def do_PUT(self):
+        body = self._read_body()
+        container, key = self._split_path()
+        with self.server.lock:
+            keys = self.server.containers.get(container)
+            if keys is not None:
+                keys[key] = body
+        self._reply(404 if keys is None else 201)
+
+    def do_GET(self):
+        container, key = self._split_path()
+        with self.server.lock:
+            keys = self.server.containers.get(container, {})
+            if key:
+                body = keys.get(key)
+            else:
+                body = ('[' + ', '.join(
+                    '"{}"'.format(k) for k in sorted(keys)) + ']').encode()
+        if body is None:
+            self._reply(404)
+        else:
+            self._reply(200, body)
+
+    def do_DELETE(self):
+        container, key = self._split_path()
+        with self.server.lock:
+            found = self.server.containers.get(container, {}).pop(key, None)
+        self._reply(404 if found is None else 204)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class CustodiaStandIn:
+    """
+    Serves the stand-in on a unix socket from a background thread while
+    used as a context manager.
+    """
+
+    def __init__(self, socket_path, latency=0.0):
+        """
+        Creates a new CustodiaStandIn.
+
+        :param socket_path: Path of the unix socket to listen on
+        :type socket_path: str
+        :param latency: Seconds to wait before each reply
+        :type latency: float
+        """
+        self.socket_path = socket_path
+        self.latency = latency
+        self._server = None
+
+    def __enter__(self):
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._server = _Server(self.socket_path, _RequestHandler)
+        self._server.containers = {}
+        self._server.lock = threading.Lock()
+        self._server.latency = self.latency
+        thread = threading.Thread(target=self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._server.shutdown()
+        self._server.server_close()
+        os.unlink(self.socket_path)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmark of EtcdStoreHandler get latency with hedged reads, against a
+local three member etcd stand-in whose "server_url" member is
+occasionally slow.
+
+Compares hedge budgets; a budget of 0 reads from "server_url" only.
+"""
+
+import argparse
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import commissaire.models as models
+
+from commissaire_service.storage.etcd import EtcdStoreHandler
+
+from etcd_standin import EtcdStandIn, Member
+
+
+def run_gets(handler, threads, count, hosts):
+    """
+    Gets Host models from several threads and returns the latency of
+    each get in seconds, sorted.
+
+    :param handler: The store handler to get with
+    :type handler: EtcdStoreHandler
+    :param threads: Number of threads
+    :type threads: int
+    :param count: Number of gets
+    :type count: int
+    :param hosts: Saved Host models
+    :type hosts: list
+    :rtype: list
+    """
+    def get(i):
+        start = time.monotonic()
+        handler._get(hosts[i % len(hosts)])
+        return time.monotonic() - start
+
+    with ThreadPoolExecutor(threads) as executor:
+        return sorted(executor.map(get, range(count)))
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '-n', '--number', type=int, default=5000,
+        help='Gets per measurement')
+    parser.add_argument(
+        '-t', '--threads', type=int, default=4,
+        help='Threads sharing the handler')
+    parser.add_argument(
+        '-l', '--latency', type=float, default=1.0,
+        help='Milliseconds every member waits before each reply')
+    parser.add_argument(
+        '-s', '--slow-latency', type=float, default=200.0,
+        help='Milliseconds the slow member waits before a slow reply')
+    parser.add_argument(
+        '-f', '--slow-fraction', type=float, default=0.03,
+        help='Fraction of the slow member\'s replies which are slow')
+    parser.add_argument(
+        '-b', '--budgets', type=float, nargs='+', default=[0, 0.05, 0.1],
+        help='Hedge budgets to compare')
+    args = parser.parse_args()
+
+    latency = args.latency / 1000.0
+    members = [
+        Member(latency, args.slow_fraction, args.slow_latency / 1000.0),
+        Member(latency),
+        Member(latency),
+    ]
+    with EtcdStandIn(members) as standin:
+        hosts = [models.Host.new(address='10.0.0.{}'.format(i))
+                 for i in range(1, 101)]
+        for budget in args.budgets:
+            handler = EtcdStoreHandler({
+                'server_url': standin.server_urls[0],
+                'endpoints': standin.server_urls,
+                'hedge_budget': budget,
+            })
+            for host in hosts:
+                standin.keys[handler._model_key(host)] = host.to_json()
+            latencies = run_gets(handler, args.threads, args.number, hosts)
+            stats = handler.hedge_stats()
+            print('budget={:<5} p50={:7.2f}ms p99={:7.2f}ms '
+                  'max={:7.2f}ms hedged={}'.format(
+                      budget,
+                      latencies[len(latencies) // 2] * 1000,
+                      latencies[int(len(latencies) * 0.99)] * 1000,
+                      latencies[-1] * 1000,
+                      stats['hedged']))
+
+
+if __name__ == '__main__':
+    main()
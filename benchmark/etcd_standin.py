@@ -0,0 +1,139 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A minimal local stand-in for the key reads of an etcd v2 cluster, for
+benchmarking EtcdStoreHandler.  Each member listens on its own local TCP
+port and all members serve the same in-memory keys.  Latency is injected
+per member.
+"""
+
+import json
+import random
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import unquote, urlparse
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    """
+    Answers etcd v2 key reads.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately; don't let Nagle's
+    # algorithm hold the body back for a delayed ACK.
+    disable_nagle_algorithm = True
+
+    def _reply(self, status, data):
+        member = self.server.member
+        if random.random() < member.slow_fraction:
+            time.sleep(member.slow_latency)
+        else:
+            time.sleep(member.latency)
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Etcd-Index', '1')
+        self.send_header('X-Raft-Index', '1')
+        self.send_header('X-Raft-Term', '1')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        # /v2/keys/<key>?...
+        key = unquote(urlparse(self.path).path[len('/v2/keys'):])
+        value = self.server.keys.get(key)
+        if value is None:
+            self._reply(404, {
+                'errorCode': 100, 'message': 'Key not found',
+                'cause': key, 'index': 1})
+        else:
+            self._reply(200, {'action': 'get', 'node': {
+                'key': key, 'value': value,
+                'modifiedIndex': 1, 'createdIndex': 1}})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Member:
+    """
+    Injected latency of one stand-in cluster member.
+    """
+
+    def __init__(self, latency=0.0, slow_fraction=0.0, slow_latency=0.0):
+        """
+        Creates a new Member.
+
+        :param latency: Seconds to wait before each reply
+        :type latency: float
+        :param slow_fraction: Fraction of replies which are slow
+        :type slow_fraction: float
+        :param slow_latency: Seconds to wait before a slow reply
+        :type slow_latency: float
+        """
+        self.latency = latency
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+
+
+class EtcdStandIn:
+    """
+    Serves stand-in cluster members from background threads while used
+    as a context manager.
+    """
+
+    def __init__(self, members):
+        """
+        Creates a new EtcdStandIn.
+
+        :param members: The members to serve
+        :type members: [Member, ...]
+        """
+        self.members = members
+        #: Values by etcd key, shared by all members.
+        self.keys = {}
+        #: Server URLs of the members, once serving.
+        self.server_urls = []
+        self._servers = []
+
+    def __enter__(self):
+        for member in self.members:
+            server = _Server(('127.0.0.1', 0), _RequestHandler)
+            server.member = member
+            server.keys = self.keys
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self._servers.append(server)
+            self.server_urls.append(
+                'http://127.0.0.1:{}'.format(server.server_address[1]))
+        return self
+
+    def __exit__(self, *exc_info):
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
+        self.server_urls = []
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Microbenchmark of the StorageService model round trip for Host models:
+build from JSON, validate, and convert back to a dict.
+
+Compares calling Host._validate() against the compiled type checks of
+commissaire_service.storage.validation, and against skipping validation
+for a revision already validated.
+"""
+
+import argparse
+import json
+import timeit
+
+import commissaire.models as models
+
+from commissaire_service.storage.validation import ModelValidation
+
+
+HOST_JSON = json.dumps({
+    'address': '192.168.1.100',
+    'status': 'active',
+    'os': 'rhel',
+    'cpus': 4,
+    'memory': 8192,
+    'space': 100000,
+    'last_check': '2017-01-01T00:00:00',
+    'source': '',
+})
+
+
+def round_trip(validate):
+    """
+    Returns a function running one build, validate and to_dict cycle.
+
+    :param validate: Called with the built Host
+    :type validate: callable
+    :rtype: callable
+    """
+    def run():
+        host = models.Host.new(**json.loads(HOST_JSON))
+        validate(host)
+        return host.to_dict()
+    return run
+
+
+def main():
+    """
+    Main entry point.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '-n', '--number', type=int, default=20000,
+        help='Round trips per measurement')
+    parser.add_argument(
+        '-r', '--repeat', type=int, default=5,
+        help='Measurements per variant; the best is reported')
+    args = parser.parse_args()
+
+    validation = ModelValidation()
+    validation.remember(models.Host.new(**json.loads(HOST_JSON)), '1')
+
+    variants = [
+        ('_validate()', lambda host: host._validate()),
+        ('compiled checks', validation.validate),
+        ('validated revision', lambda host: validation.validate(host, '1')),
+        ('no validation', lambda host: None),
+    ]
+    for name, validate in variants:
+        best = min(timeit.repeat(
+            round_trip(validate), number=args.number, repeat=args.repeat))
+        print('{:<20} {:8.2f} us per round trip'.format(
+            name, best / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -60,6 +60,31 @@ class ClusterExecService(CommissaireService):
 
         self.storage = StorageClient(self)
 
+    def _get_host_creds(self, addresses):
+        """
+        Fetches the HostCreds of several hosts in one storage request.
+        Returns an empty dict if any of them fails, so the caller can fall
+        back to fetching them one at a time.
+
+        :param addresses: Host addresses
+        :type addresses: list
+        :returns: HostCreds instances by address
+        :rtype: dict
+        """
+        if not addresses:
+            return {}
+        try:
+            response = self.request(
+                'storage.get', 'HostCreds',
+                [{'address': address} for address in addresses])
+            host_creds = [HostCreds.new(**x) for x in response['result']]
+        except Exception as error:
+            self.logger.warn(
+                'Unable to fetch host credentials in bulk, fetching them '
+                'one at a time: {}: {}'.format(type(error), error))
+            return {}
+        return {x.address: x for x in host_creds}
+
     def _execute(self, message, model_instance, command_args,
                  finished_hosts_key):
         """
@@ -123,10 +148,15 @@ class ClusterExecService(CommissaireService):
         else:
             self.logger.warn('No hosts in cluster "{}"'.format(cluster_name))
 
+        host_creds_by_address = self._get_host_creds(cluster.hostset)
+
         for address in cluster.hostset:
             # Get initial data
             host = self.storage.get_host(address)
-            host_creds = self.storage.get(HostCreds.new(address=host.address))
+            host_creds = host_creds_by_address.get(host.address)
+            if host_creds is None:
+                host_creds = self.storage.get(
+                    HostCreds.new(address=host.address))
             oscmd = get_oscmd(host.os)
 
             # os_command is only used for logging
@@ -22,6 +22,7 @@ from commissaire.util.config import import_plugin, ConfigurationError
 
 from commissaire_service.service import (
     CommissaireService, add_service_arguments)
+from commissaire_service.storage.notify import unbatch
 
 
 class ContainerManagerService(CommissaireService):
@@ -59,7 +60,8 @@ class ContainerManagerService(CommissaireService):
         self.managers = {}
 
         self.storage.register_callback(
-            self._config_notification, models.ContainerManagerConfig)
+            unbatch(self._config_notification),
+            models.ContainerManagerConfig)
 
     def get_consumers(self, Consumer, channel):
         """
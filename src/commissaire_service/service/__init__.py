@@ -16,6 +16,7 @@
 """
 Service base class.
 """
+import fnmatch
 import json
 import logging
 import multiprocessing
@@ -31,6 +32,70 @@ from kombu import Connection, Exchange, Producer, Queue
 from kombu.mixins import ConsumerMixin
 
 
+#: Storage methods which may be routed to a shard by model type.
+SHARDED_STORAGE_METHODS = (
+    'save', 'get', 'delete', 'delete_where', 'list', 'count', 'aggregate')
+
+
+def storage_routing_key(routing_key, model_type_name, shards):
+    """
+    Returns the routing key for a storage request.  Requests for model
+    types matching one of the shards' fnmatch patterns are routed as
+    "storage.<model_type_name>.<method>", to the queue of the
+    StorageService processes serving that model type; all others are
+    left as "storage.<method>".
+
+    :param routing_key: A "storage.<method>" routing key
+    :type routing_key: str
+    :param model_type_name: Model type the request is for, if any
+    :type model_type_name: str or None
+    :param shards: Model type name patterns with their own processes
+    :type shards: list
+    :returns: The routing key to use
+    :rtype: str
+    """
+    parts = routing_key.split('.')
+    if (len(parts) == 2 and parts[1] in SHARDED_STORAGE_METHODS and
+            model_type_name and
+            any(fnmatch.fnmatchcase(model_type_name, x) for x in shards)):
+        return 'storage.{}.{}'.format(model_type_name, parts[1])
+    return routing_key
+
+
+def request_model_type_name(args, kwargs):
+    """
+    Returns the model type name of a request's parameters, however they
+    were given to request(): as "params", by keyword or as the first
+    positional argument, either as a dict or as a list starting with the
+    model type name, or as a model_type_name keyword or first positional
+    argument of their own.
+
+    :param args: Positional arguments of the request
+    :type args: tuple
+    :param kwargs: Keyword arguments of the request
+    :type kwargs: dict
+    :returns: The model type name, or None
+    :rtype: str or None
+    """
+    if 'params' in kwargs:
+        params = kwargs['params']
+    elif args:
+        params = args[0]
+    else:
+        params = kwargs
+    if isinstance(params, dict):
+        model_type_name = params.get('model_type_name')
+    elif isinstance(params, (list, tuple)) and params:
+        model_type_name = params[0]
+    else:
+        model_type_name = params
+    if model_type_name is None:
+        model_type_name = kwargs.get('model_type_name')
+    if isinstance(model_type_name, str):
+        return model_type_name
+    return None
+
+
 def add_service_arguments(parser):
     """
     Adds command-line arguments common to all Commissaire services.
@@ -187,9 +252,14 @@ class CommissaireService(ConsumerMixin, BusMixin):
             exchange_name, type='topic').bind(self._channel)
         self._exchange.declare()
 
+        # Storage requests for model types matching the "storage_shards"
+        # patterns are routed to StorageService processes serving them
+        # (see storage_routing_key()).
+        self._storage_shards = self._config_data.get('storage_shards', [])
+
         # Set up queues
         self._queues = []
-        for kwargs in qkwargs:
+        for kwargs in self._configure_queues(qkwargs):
             queue = Queue(**kwargs)
             queue.exchange = self._exchange
             queue = queue.bind(self._channel)
@@ -200,6 +270,19 @@ class CommissaireService(ConsumerMixin, BusMixin):
         self.producer = Producer(self._channel, self._exchange)
         self.logger.debug('Initializing of {} finished'.format(name))
 
+    def _configure_queues(self, qkwargs):
+        """
+        Returns the queue creation keyword arguments to use, once the
+        configuration file is read.  Subclasses may override this to
+        derive queues from the configuration.
+
+        :param qkwargs: The queue keyword arguments given to __init__()
+        :type qkwargs: list
+        :returns: Queue keyword arguments
+        :rtype: list
+        """
+        return qkwargs
+
     def get_consumers(self, Consumer, channel):
         """
         Returns the a list of consumers to watch. Called by the parent Mixin.
@@ -229,6 +312,26 @@ class CommissaireService(ConsumerMixin, BusMixin):
         :param message: The message instance.
         :type message: kombu.message.Message
         """
+        response = self._process_message(body, message)
+        self._send_response(message, response)
+
+        message.ack()
+        self.logger.debug('Message "{}" {} ackd'.format(
+            message.delivery_tag,
+            ('was' if message.acknowledged else 'was not')))
+
+    def _process_message(self, body, message):
+        """
+        Calls the method requested by a message and builds the jsonrpc
+        response, which holds either the result or an error.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :returns: The jsonrpc response.
+        :rtype: dict
+        """
         self.logger.debug('Received message "{}" {}'.format(
             message.delivery_tag, body))
         expected_method = message.delivery_info['routing_key'].rsplit(
@@ -263,46 +366,96 @@ class CommissaireService(ConsumerMixin, BusMixin):
                     'Dropping unknown message: payload="{}", '
                     'properties="{}"'.format(body, message.properties))
         except Exception as error:
-            # Subclasses of RemoteProcedureCallError are re-created and
-            # raised on the client-side.
-            if isinstance(error, RemoteProcedureCallError):
-                response['error'] = {
-                    'code': error.code,
-                    'message': str(error),
-                    'data': error.data
-                }
-            else:
-                jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_REQUEST']
-                # If there is an attribute error then use the Method Not Found
-                # code in the error response
-                if type(error) is AttributeError:
-                    jsonrpc_error_code = C.JSONRPC_ERRORS['METHOD_NOT_FOUND']
-                elif type(error) is json.decoder.JSONDecodeError:
-                    jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_JSON']
-                response['error'] = {
-                    'code': jsonrpc_error_code,
-                    'message': str(error),
-                    'data': {
-                        'exception': str(type(error))
-                    }
-                }
-                self.logger.warn(
-                    'Exception raised during method call:\n{}'.format(
-                        traceback.format_exc()))
-
-        # Reply back if needed
+            response['error'] = self._build_error(error)
+        return response
+
+    def _build_error(self, error):
+        """
+        Builds a jsonrpc error object from an exception raised by a method
+        call.
+
+        :param error: The exception raised.
+        :type error: Exception
+        :returns: The jsonrpc error object.
+        :rtype: dict
+        """
+        # Subclasses of RemoteProcedureCallError are re-created and
+        # raised on the client-side.
+        if isinstance(error, RemoteProcedureCallError):
+            return {
+                'code': error.code,
+                'message': str(error),
+                'data': error.data
+            }
+
+        jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_REQUEST']
+        # If there is an attribute error then use the Method Not Found
+        # code in the error response
+        if type(error) is AttributeError:
+            jsonrpc_error_code = C.JSONRPC_ERRORS['METHOD_NOT_FOUND']
+        elif type(error) is json.decoder.JSONDecodeError:
+            jsonrpc_error_code = C.JSONRPC_ERRORS['INVALID_JSON']
+        self.logger.warn(
+            'Exception raised during method call:\n{}'.format(
+                ''.join(traceback.format_exception(
+                    type(error), error, error.__traceback__))))
+        return {
+            'code': jsonrpc_error_code,
+            'message': str(error),
+            'data': {
+                'exception': str(type(error))
+            }
+        }
+
+    def _send_response(self, message, response):
+        """
+        Replies to a message with a jsonrpc response, if the sender
+        asked for a reply.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :param response: The jsonrpc response.
+        :type response: dict
+        """
         if message.properties.get('reply_to'):
             self.logger.debug('Responding to {}'.format(
                 message.properties['reply_to']))
             response_queue = self.connection.SimpleQueue(
                 message.properties['reply_to'])
-            response_queue.put(json.dumps(response))
+            response_queue.put(self._encode_response(response))
             response_queue.close()
 
-        message.ack()
-        self.logger.debug('Message "{}" {} ackd'.format(
-            message.delivery_tag,
-            ('was' if message.acknowledged else 'was not')))
+    def _encode_response(self, response):
+        """
+        Encodes a jsonrpc response for sending.
+
+        :param response: The jsonrpc response.
+        :type response: dict
+        :returns: The JSON encoded response.
+        :rtype: str
+        """
+        return json.dumps(response)
+
+    def request(self, routing_key, *args, **kwargs):
+        """
+        Sends a request and waits for the response.  Storage requests for
+        sharded model types are routed by storage_routing_key(), finding
+        their model type with request_model_type_name().
+
+        :param routing_key: The routing key of the request.
+        :type routing_key: str
+        :param args: Positional arguments for BusMixin.request()
+        :type args: tuple
+        :param kwargs: Keyword arguments for BusMixin.request()
+        :type kwargs: dict
+        :returns: The response.
+        :rtype: dict
+        """
+        if self._storage_shards and routing_key.startswith('storage.'):
+            routing_key = storage_routing_key(
+                routing_key, request_model_type_name(args, kwargs),
+                self._storage_shards)
+        return super().request(routing_key, *args, **kwargs)
 
     def respond(self, queue_name, id, payload, **kwargs):
         """
@@ -13,29 +13,65 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
 import fnmatch
 import json
+import queue
+import signal
+import threading
+import time
+
+from concurrent.futures import (
+    ThreadPoolExecutor, TimeoutError, as_completed)
 
 import commissaire.models as models
 
 from commissaire import constants as C
-from commissaire.storage import StoreHandlerBase
+from commissaire.bus import StorageLookupError
+from commissaire.storage import StoreHandlerBase, client
 from commissaire.util.config import (ConfigurationError, import_plugin)
 
 from commissaire_service.service import (
     CommissaireService, add_service_arguments)
 
+from .aggregate import AggregateMixin
+from .base import (
+    NOT_MODIFIED_KEY, REVISION_KEY, BulkStoreHandler, RevisionedStoreHandler,
+    StorageConflictError, content_revision, list_type_name)
+from .cache import (
+    WIRE_KEY, EncodedJSON, ModelCache, NegativeCache, encode_json_default)
+from .coalesce import SingleFlight
 from .custodia import CustodiaStoreHandler
-
-
-class StorageService(CommissaireService):
+from .deletewhere import DeleteWhereMixin
+from .journal import (
+    JOURNAL_DELETE, JOURNAL_SAVE, JournalMixin, is_outage_error)
+from .multi import MultiMixin
+from .notify import NotifyBatcher, unbatch
+from .retention import RetentionMixin, RetentionPolicy
+from .snapshot import SnapshotMixin
+from .stats import StatsMixin, StorageStats
+from .validation import ModelValidation
+from .watch import NotifyEchoes, NotifyTap, WatchMixin, WatchRegistry
+from .writebehind import WriteBehindBuffer
+
+
+class StorageService(WatchMixin, MultiMixin, AggregateMixin, RetentionMixin,
+                     JournalMixin, SnapshotMixin, DeleteWhereMixin, StatsMixin,
+                     CommissaireService):
     """
     Provides access to data stores to other services.
+
+    The handlers of optional features live with the rest of each feature,
+    in the mixins this class is built from.
     """
 
     #: Default configuration file
     _default_config_file = '/etc/commissaire/storage.conf'
 
+    #: Most seconds between acknowledgements of messages handled by
+    #: worker threads.
+    ACK_INTERVAL = 0.1
+
     def __init__(self, exchange_name, connection_url, config_file=None):
         """
         Creates a new StorageService and sets up StoreHandler instances
@@ -82,6 +118,134 @@ class StorageService(CommissaireService):
                              if isinstance(v, type) and
                              issubclass(v, models.Model)}
 
+        # Model change subscriptions made through "storage.watch".
+        self._watches = WatchRegistry(
+            self._config_data.get('watch_backlog_size'),
+            self._config_data.get('watch_timeout'))
+
+        # Guards lazy store handler instantiation.
+        self._handler_lock = threading.Lock()
+
+        # Held while store handler notifications are sent and reported,
+        # so they are recorded before their echoes from the exchange.
+        self._notify_lock = threading.RLock()
+
+        # kombu connections are not thread-safe.  The thread which creates
+        # the service, and runs it, replies and publishes on the service's
+        # connection; other threads each use one of their own (see _bus()).
+        self._owner_thread = threading.current_thread()
+        self._thread_bus = threading.local()
+
+        # Store handler names by id(handler_instance), for statistics.
+        self._handler_names = {}
+
+        # Latency, error and hot key statistics of store operations.
+        self._stats = StorageStats()
+
+        # Model validators, and the store revisions already validated.
+        self._validation = ModelValidation()
+
+        # Identical get and list requests in progress share one call.
+        self._flights = SingleFlight()
+
+        # Remembers missing models for "negative_cache_ttl" seconds,
+        # given either for all model types or by model type name.
+        self._negative_cache = NegativeCache(
+            self._model_type_settings('negative_cache_ttl'))
+
+        # Keeps models read, along with their encoded replies, for
+        # "model_cache_ttl" seconds, given as above; at most
+        # "model_cache_size" models are kept.  Secrets are never kept.
+        self._model_cache = ModelCache(
+            self._model_type_settings('model_cache_ttl', secrets=False),
+            int(self._config_data.get('model_cache_size', 1024)))
+
+        # Saves are held for "write_behind_ms" milliseconds, given as
+        # above, and only the last save of a model in that window is
+        # written.  Secrets are always written right away.
+        windows = self._model_type_settings('write_behind_ms', secrets=False)
+        self._write_behind = WriteBehindBuffer(
+            {k: v / 1000.0 for k, v in windows.items()},
+            self._write_buffered)
+
+        # Store handler notifications are held for "notify_batch_ms"
+        # milliseconds, given as above, and published together by model
+        # type.  Subscribers must wrap their callbacks with unbatch() to
+        # receive them.  Secrets are never batched.
+        windows = self._model_type_settings('notify_batch_ms', secrets=False)
+        self._notify_batcher = NotifyBatcher(
+            {k: v / 1000.0 for k, v in windows.items()},
+            self._publish_notifications)
+
+        # Cached entries must be forgotten when any storage service
+        # process changes the model, so listen to their notifications too.
+        # With "watch_remote" set, watches see those changes as well; it
+        # defaults to on when model types are sharded across processes,
+        # since a watch may be on another process than the saves.
+        self._notify_echoes = None
+        if self._config_data.get('watch_remote', bool(
+                self._storage_shards or
+                self._config_data.get('storage_models'))):
+            self._notify_echoes = NotifyEchoes()
+            notified_names = sorted(self._model_types)
+        else:
+            notified_names = [
+                name for name in sorted(self._model_types)
+                if self._negative_cache.enabled(name) or
+                self._model_cache.enabled(name)]
+        self._storage_client = None
+        if notified_names:
+            self._storage_client = client.StorageClient(self)
+            for name in notified_names:
+                self._storage_client.register_callback(
+                    unbatch(self._storage_notification),
+                    self._model_types[name])
+
+        # Messages are handled on a pool of worker threads if the
+        # "storage_workers" setting is above 1.  At most two messages
+        # per worker are accepted before the consumer waits.  Handled
+        # messages are acknowledged by the consumer's thread.
+        self._executor = None
+        self._handled = queue.Queue()
+        workers = int(self._config_data.get('storage_workers', 1))
+        if workers > 1:
+            self._executor = ThreadPoolExecutor(workers)
+            self._executor_slots = threading.BoundedSemaphore(workers * 2)
+
+        # Hosts are listed from every store handler which can hold them
+        # in parallel, waiting at most "storage_list_timeout" seconds for
+        # each.  The thread pool is created on first use.
+        self._list_timeout = self._config_data.get('storage_list_timeout', 10)
+        self._fan_out_executor = None
+
+        # Completed operation records are removed according to the
+        # "storage_retention" policies by model type name, checked every
+        # "storage_retention_interval" seconds (see RetentionPolicy).
+        self._retention = {}
+        for name, policy in self._config_data.get(
+                'storage_retention', {}).items():
+            if name not in self._model_types:
+                raise ConfigurationError(
+                    'No match for model: {}'.format(name))
+            self._retention[name] = RetentionPolicy(
+                self._model_types[name], policy)
+        self._retention_interval = self._config_data.get(
+            'storage_retention_interval', 300)
+
+        # With "storage_journal" set, saves and deletes of the matching
+        # "models" which can not reach their store are journaled to the
+        # local "path", up to "max_entries", and replayed every
+        # "retry_seconds".  Secrets are never journaled.
+        self._journal = None
+        journal_config = self._config_data.get('storage_journal')
+        if journal_config:
+            self._journal = self._create_journal(journal_config)
+
+        # Snapshots are exported to and imported from files in the
+        # "storage_snapshot_dir" directory (see on_export()).  Without it,
+        # exports and imports are refused.
+        self._snapshot_dir = self._config_data.get('storage_snapshot_dir')
+
         # Prepare CustodiaStoreHandler configuration.
         #
         # Pick out all the 'custodia_*' items from the root-level JSON
@@ -99,6 +263,7 @@ class StorageService(CommissaireService):
             if issubclass(mt, models.SecretModel):
                 matched_types.add(mt)
         handler_type = CustodiaStoreHandler
+        handler_type.check_config(config)
         config['name'] = handler_type.__module__
         definition = (handler_type, config, matched_types)
         self._definitions_by_name[config['name']] = definition
@@ -107,14 +272,96 @@ class StorageService(CommissaireService):
 
         store_handlers = self._config_data.get('storage_handlers', [])
 
-        # Configure store handlers from user data.
+        # Configure store handlers from user data.  The default etcd
+        # store handler is this package's, which enforces revisions with
+        # etcd's own compare-and-swap.
         if len(store_handlers) == 0:
             store_handlers = [
-                C.DEFAULT_ETCD_STORE_HANDLER
+                dict(C.DEFAULT_ETCD_STORE_HANDLER,
+                     type='commissaire_service.storage.etcd')
             ]
         for config in store_handlers:
             self._register_store_handler(config)
 
+        # With "storage_eager_handlers" set, every store handler is
+        # created and probed before consuming messages, and consuming
+        # waits until the "storage_critical_handlers" (by default, all
+        # of them) pass their probe.
+        self._eager_handlers = bool(
+            self._config_data.get('storage_eager_handlers', False))
+        self._critical_handlers = set(self._config_data.get(
+            'storage_critical_handlers', self._definitions_by_name.keys()))
+        for name in self._critical_handlers:
+            if name not in self._definitions_by_name:
+                raise ConfigurationError(
+                    'No such storage handler: {}'.format(name))
+
+        # Warm-up results by store handler name.
+        # { name : { 'ready': bool, 'warm_up_seconds': float,
+        #            'error': str or None } }
+        self._handler_status = {}
+
+    def _configure_queues(self, qkwargs):
+        """
+        Returns the queues to consume from.  With "storage_models" set to
+        a list of model type name patterns, this process serves only the
+        matching model types, each from its own "storage.<model_type>"
+        queue shared by all processes serving it.  Clients route requests
+        to these queues with the "storage_shards" setting.
+
+        :param qkwargs: The default queue keyword arguments
+        :type qkwargs: list
+        :returns: Queue keyword arguments
+        :rtype: list
+        :raises: commissaire.util.config.ConfigurationError
+        """
+        patterns = self._config_data.get('storage_models')
+        if not patterns:
+            return qkwargs
+        names = sorted(k for k, v in models.__dict__.items()
+                       if isinstance(v, type) and
+                       issubclass(v, models.Model))
+        matched = []
+        for pattern in patterns:
+            matches = fnmatch.filter(names, pattern)
+            if not matches:
+                raise ConfigurationError(
+                    'No match for model: {}'.format(pattern))
+            matched.extend(x for x in matches if x not in matched)
+        return [{
+            'name': 'storage.{}'.format(name),
+            'routing_key': 'storage.{}.*'.format(name),
+            'exclusive': False,
+        } for name in matched]
+
+    def _model_type_settings(self, key, secrets=True):
+        """
+        Reads a per-model-type setting, given either as one value for all
+        model types or as a JSON object by model type name.
+
+        :param key: Configuration key
+        :type key: str
+        :param secrets: Whether secret model types may be set
+        :type secrets: bool
+        :returns: Values by model type name
+        :rtype: dict
+        :raises: commissaire.util.config.ConfigurationError
+        """
+        values = self._config_data.get(key, {})
+        if not isinstance(values, dict):
+            values = {name: values for name, mt in self._model_types.items()
+                      if secrets or not issubclass(mt, models.SecretModel)}
+        for name in values:
+            model_type = self._model_types.get(name)
+            if model_type is None:
+                raise ConfigurationError(
+                    'No match for model: {}'.format(name))
+            if not secrets and issubclass(model_type, models.SecretModel):
+                raise ConfigurationError(
+                    'Secret model can not be set in "{}": {}'.format(
+                        key, name))
+        return values
+
     def _register_store_handler(self, config):
         """
         Registers a new store handler type after extracting and validating
@@ -187,6 +434,125 @@ class StorageService(CommissaireService):
         new_items = {mt: definition for mt in matched_types}
         self._definitions_by_model_type.update(new_items)
 
+    def run(self, *args, **kwargs):  # pragma: no cover
+        """
+        Runs the service, after warming up store handlers if configured
+        to.  Called in the service's own process, so connections opened
+        during warm-up are not shared across a fork.
+        """
+        if self._eager_handlers:
+            delay = 1
+            while True:
+                not_ready = self._warm_up_handlers() & self._critical_handlers
+                if not not_ready:
+                    break
+                self.logger.warn(
+                    'Critical storage handlers not ready, retrying in '
+                    '{}s: {}'.format(delay, ', '.join(sorted(not_ready))))
+                time.sleep(delay)
+                delay = min(delay * 2, 30)
+
+        if self._retention:
+            sweeper = threading.Thread(
+                target=self._retention_sweeper, name='RetentionSweeper')
+            sweeper.daemon = True
+            sweeper.start()
+
+        # Stop consuming on SIGTERM, like on SIGINT, so buffered saves
+        # are written before exiting.
+        def stop(signum, frame):
+            self.should_stop = True
+        signal.signal(signal.SIGTERM, stop)
+        if self._journal is not None:
+            replayer = threading.Thread(
+                target=self._journal_replayer, name='JournalReplayer')
+            replayer.daemon = True
+            replayer.start()
+
+        try:
+            super().run(*args, **kwargs)
+        finally:
+            self._write_behind.close()
+            self._notify_batcher.close()
+            if self._journal is not None:
+                self._journal.close()
+
+    def _list_model_type(self, model_type):
+        """
+        Returns the list model type holding a model type, if there is one.
+
+        :param model_type: A model type
+        :type model_type: type
+        :returns: The list model type
+        :rtype: type or None
+        """
+        for list_type in self._model_types.values():
+            if (issubclass(list_type, models.ListModel) and
+                    getattr(list_type, '_list_class', None) is model_type):
+                return list_type
+        return None
+
+    def _warm_up_handlers(self):
+        """
+        Creates every defined store handler not yet marked ready and probes
+        it, recording the outcome and the time taken in
+        self._handler_status.
+
+        :returns: Names of store handlers which are not ready
+        :rtype: set
+        """
+        not_ready = set()
+        for name, definition in self._definitions_by_name.items():
+            if self._handler_status.get(name, {}).get('ready'):
+                continue
+            start = time.monotonic()
+            error = None
+            try:
+                with self._handler_lock:
+                    handler = self._handlers_by_name.get(name)
+                    if handler is None:
+                        handler = self._create_handler(definition)
+                self._probe_handler(handler, definition)
+            except Exception as ex:
+                error = '{}: {}'.format(type(ex).__name__, ex)
+                not_ready.add(name)
+            elapsed = time.monotonic() - start
+            self._handler_status[name] = {
+                'ready': error is None,
+                'warm_up_seconds': elapsed,
+                'error': error,
+            }
+            if error is None:
+                self.logger.info(
+                    'Storage handler "{}" ready in {:.3f}s'.format(
+                        name, elapsed))
+            else:
+                self.logger.warn(
+                    'Storage handler "{}" failed warm-up after {:.3f}s: '
+                    '{}'.format(name, elapsed, error))
+        return not_ready
+
+    def _probe_handler(self, handler, definition):
+        """
+        Checks that a store handler can reach its store by looking up a
+        model which should not exist.  Raises an exception on failure.
+
+        :param handler: The store handler to probe
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param definition: The store handler's definition
+        :type definition: tuple
+        """
+        _, _, model_types = definition
+        model_types = sorted(model_types, key=lambda mt: mt.__name__)
+        # Handlers without model types serve Hosts by "source".
+        model_type = model_types[0] if model_types else models.Host
+        probe = model_type.new(
+            **{model_type._primary_key: '__commissaire_probe__'})
+        try:
+            handler._get(probe)
+        except StorageLookupError:
+            pass
+
     def _create_handler(self, definition):
         """
         Creates a handler instance from a handler definition, and adds the
@@ -195,17 +561,182 @@ class StorageService(CommissaireService):
         handler_type, config, model_types = definition
         handler = handler_type(config)
         handler.notify.connect(self._exchange, self._channel)
+        handler.notify = NotifyTap(
+            handler.notify, self._on_notify, self._notify_lock,
+            self._notify_batcher, self._publish_notifications)
         self._handlers_by_name[config['name']] = handler
+        self._handler_names[id(handler)] = config['name']
         new_items = {mt: handler for mt in model_types}
         self._handlers_by_model_type.update(new_items)
         return handler
 
+    def get_consumers(self, Consumer, channel):
+        """
+        Returns the list of consumers to watch.
+
+        Called by kombu.mixins.ConsumerMixin.
+
+        :param Consumer: Message consumer class.
+        :type Consumer: class
+        :param channel: An open channel.
+        :type channel: kombu.transport.*.Channel
+        :returns: A list of consumer instances
+        :rtype: [kombu.Consumer, ...]
+        """
+        consumers = super().get_consumers(Consumer, channel)
+        if self._storage_client is not None:
+            consumers.extend(
+                self._storage_client.get_consumers(Consumer, channel))
+        return consumers
+
+    @client.NotifyCallback
+    def _storage_notification(self, event, model, message):
+        """
+        Called when the service receives a notification from any storage
+        service process about a model which may be cached or watched.
+        Changes made by other processes are delivered to matching watches.
+
+        :param event: One of the commissaire.storage.client events
+        :type event: str
+        :param model: The created, updated or deleted model
+        :type model: commissaire.model.Model
+        :param message: A message instance
+        :type message: kombu.message.Message
+        """
+        self._discard_cached(model)
+        if self._notify_echoes is None:
+            return
+        # Store handlers notify with the lock held, so the notifications
+        # of this process are always expected by the time they return.
+        with self._notify_lock:
+            if not self._notify_echoes.consume(event, model):
+                self._record_event(event, model)
+
+    def _discard_cached(self, model_instance):
+        """
+        Forgets any cached state of a model.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        """
+        model_type_name = type(model_instance).__name__
+        self._negative_cache.discard(
+            model_type_name, model_instance.primary_key)
+        self._model_cache.discard(model_type_name, model_instance.primary_key)
+        self._flights.written(model_type_name)
+
+    def _on_notify(self, event_name, model_instance):
+        """
+        Called for every notification sent by a store handler.  Records
+        the change and delivers it to any matching watches.
+
+        :param event_name: One of the commissaire.storage.client events
+        :type event_name: str
+        :param model_instance: The created, updated or deleted model
+        :type model_instance: commissaire.model.Model
+        """
+        self._discard_cached(model_instance)
+        if self._notify_echoes is not None:
+            self._notify_echoes.expect(event_name, model_instance)
+        self._record_event(event_name, model_instance)
+
+    def _bus(self):
+        """
+        Returns the connection and producer for the calling thread.  The
+        service's own are used by the thread which created the service;
+        every other thread gets its own on first use.
+
+        :returns: ( connection, producer )
+        :rtype: tuple
+        """
+        if threading.current_thread() is self._owner_thread:
+            return self.connection, self.producer
+        bus = getattr(self._thread_bus, 'bus', None)
+        if bus is None:
+            connection = self.connection.clone()
+            bus = (connection, connection.Producer(exchange=self._exchange))
+            self._thread_bus.bus = bus
+        return bus
+
+    def _publish_notifications(self, routing_key, body):
+        """
+        Publishes store handler notifications.
+
+        :param routing_key: The routing key of the notifications
+        :type routing_key: str
+        :param body: The message body
+        :type body: dict
+        """
+        self._bus()[1].publish(body, routing_key=routing_key)
+
+    def _send_event(self, queue_name, event):
+        """
+        Delivers a watch event to a queue.  Failures are logged, never
+        raised, so a vanished watcher cannot fail a store operation.
+
+        :param queue_name: The name of the queue to use
+        :type queue_name: str
+        :param event: A watch event
+        :type event: dict
+        """
+        try:
+            send_queue = self._bus()[0].SimpleQueue(queue_name)
+            send_queue.put(event)
+            send_queue.close()
+        except Exception as error:
+            self.logger.warn(
+                'Unable to send event to "{}": {}: {}'.format(
+                    queue_name, type(error), error))
+
     def _get_handler(self, model):
         """
         Looks up, and if necessary instantiates, a StoreHandler instance
         for the given model.  Raises KeyError if no handler is registered
         for that type of model.
         """
+        with self._handler_lock:
+            return self._get_handler_locked(model)
+
+    def _get_handler_by_name(self, name):
+        """
+        Looks up, and if necessary instantiates, a StoreHandler instance
+        by name.  Raises KeyError if no handler is defined by that name.
+
+        :param name: Name of the store handler
+        :type name: str
+        :rtype: commissaire.storage.StoreHandlerBase
+        """
+        with self._handler_lock:
+            handler = self._handlers_by_name.get(name)
+            if handler is None:
+                handler = self._create_handler(self._definitions_by_name[name])
+            return handler
+
+    def _list_handlers(self, model_instance):
+        """
+        Returns the store handlers to list a list model from.  Hosts are
+        listed from the handler for the list model type, followed by every
+        handler which serves Hosts by "source".
+
+        :param model_instance: List model instance
+        :type model_instance: commissaire.model.ListModel
+        :returns: store handlers
+        :rtype: [commissaire.storage.StoreHandlerBase, ...]
+        """
+        handlers = [self._get_handler(model_instance)]
+        if type(model_instance) is models.Hosts:
+            for name, (_, _, model_types) in sorted(
+                    self._definitions_by_name.items()):
+                if not model_types or models.Host in model_types:
+                    handler = self._get_handler_by_name(name)
+                    if handler not in handlers:
+                        handlers.append(handler)
+        return handlers
+
+    def _get_handler_locked(self, model):
+        """
+        Implements _get_handler() with self._handler_lock held.
+        """
         handler = None
         model_type = type(model)
 
@@ -231,6 +762,31 @@ class StorageService(CommissaireService):
 
         return handler
 
+    def _handler_name(self, handler):
+        """
+        Returns the name a store handler instance was defined under.
+
+        :param handler: A store handler
+        :type handler: commissaire.storage.StoreHandlerBase
+        :rtype: str
+        """
+        return self._handler_names.get(id(handler), type(handler).__name__)
+
+    def _time_op(self, handler, model_instance, op):
+        """
+        Returns a context manager timing a store operation, for the
+        "latency" statistics.
+
+        :param handler: The store handler performing the operation
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: The model (or list model) operated on
+        :type model_instance: commissaire.model.Model
+        :param op: Name of the operation
+        :type op: str
+        """
+        return self._stats.timer(
+            self._handler_name(handler), type(model_instance).__name__, op)
+
     def _build_model(self, model_type_name, model_json_data):
         """
         Builds a model instance from a type name and model data, which may
@@ -248,53 +804,452 @@ class StorageService(CommissaireService):
             if not isinstance(model_json_data, dict):
                 raise json.decoder.JSONDecodeError(
                     'Model data expected to be a JSON object')
+        if REVISION_KEY in model_json_data:
+            # Revisions are passed explicitly, never as model data.
+            model_json_data = {k: v for k, v in model_json_data.items()
+                               if k != REVISION_KEY}
         model_type = self._model_types[model_type_name]
         return model_type.new(**model_json_data)
 
-    def _save_model(self, model_instance):
+    def _model_revision(self, model_instance, model_data=None):
+        """
+        Returns the revision of a model read from or saved to a store.
+        Store handlers with native revision support record it on the model
+        instance; otherwise the revision is derived from the model content.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        :param model_data: Dict representation of the model, if on hand
+        :type model_data: dict or None
+        :returns: A revision string
+        :rtype: str
+        """
+        revision = getattr(model_instance, REVISION_KEY, None)
+        if revision is None:
+            # Models from the model cache keep their content revision
+            # along with their encoded replies.
+            wire = getattr(model_instance, WIRE_KEY, None)
+            if wire is not None:
+                revision = wire.get(REVISION_KEY)
+            if revision is None:
+                if model_data is None:
+                    model_data = model_instance.to_dict()
+                revision = content_revision(model_data)
+                if wire is not None:
+                    wire[REVISION_KEY] = revision
+        return revision
+
+    def _model_reply(self, model_instance, with_revision=False):
+        """
+        Builds the reply representation of a model.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        :param with_revision: Whether to include the model revision
+        :type with_revision: bool
+        :returns: dict representation of the model
+        :rtype: dict
+        """
+        model_data = model_instance.to_dict()
+        if with_revision:
+            model_data[REVISION_KEY] = self._model_revision(
+                model_instance, model_data)
+        return model_data
+
+    def _model_wire_reply(self, model_instance, with_revision=False):
+        """
+        Builds the reply representation of a model for sending on the bus.
+        Models from the model cache carry their encoded replies, which are
+        built once and then reused until the model changes.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        :param with_revision: Whether to include the model revision
+        :type with_revision: bool
+        :returns: representation of the model
+        :rtype: dict or EncodedJSON
+        """
+        wire = getattr(model_instance, WIRE_KEY, None)
+        if wire is None:
+            return self._model_reply(model_instance, with_revision)
+        encoded = wire.get(with_revision)
+        if encoded is None:
+            encoded = EncodedJSON(
+                self._model_reply(model_instance, with_revision))
+            wire[with_revision] = encoded
+        return encoded
+
+    def _conditional_reply(self, model_instance, if_not_revision):
+        """
+        Builds the reply to a conditional get of a model.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        :param if_not_revision: The revision the caller already holds
+        :type if_not_revision: str or None
+        :returns: A "not modified" marker with the revision if the model
+                  is at that revision, or else the model with its revision
+        :rtype: dict or EncodedJSON
+        """
+        revision = self._model_revision(model_instance)
+        if if_not_revision is not None and revision == str(if_not_revision):
+            return {NOT_MODIFIED_KEY: True, REVISION_KEY: revision}
+        return self._model_wire_reply(model_instance, True)
+
+    def _validate_model(self, model_instance, handler, revision=None):
+        """
+        Validates a model, logging any validation error.  A model read
+        back at a store revision which was already validated is skipped.
+
+        :param model_instance: Model instance to validate
+        :type model_instance: commissaire.model.Model
+        :param handler: The store handler the model is saved to or read from
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param revision: Native store revision of the model, if known
+        :type revision: str or None
+        :raises commissaire.models.ValidationError: if the model is invalid
+        """
+        try:
+            with self._time_op(handler, model_instance, 'validate'):
+                self._validation.validate(model_instance, revision)
+        except models.ValidationError as ve:
+            self.logger.error(ve.args[0])
+            self.logger.error(ve.args[1])
+            raise ve
+
+    def _save_model(self, model_instance, revision=None, buffered=True):
         """
         Saves data to a store and returns back a saved model.
 
+        If a revision is given, the save only succeeds if the stored model
+        still has that revision, as enforced atomically by the store
+        handler.  Store handlers which are not RevisionedStoreHandlers can
+        not do so, and refuse revision checked saves.
+
+        Unchecked saves of model types with a write-behind window are
+        buffered, and the model is returned as given.
+
         :param model_instance: Model instance to save
         :type model_instance: commissaire.model.Model
+        :param revision: Optional expected revision of the stored model
+        :type revision: str or None
+        :param buffered: Whether the save may be buffered
+        :type buffered: bool
         :returns: The saved model instance
         :rtype: commissaire.model.Model
+        :raises StorageConflictError: if the revision does not match
+        :raises ValueError: if the store handler can not check revisions
         """
         handler = self._get_handler(model_instance)
+        model_type_name = type(model_instance).__name__
+        if revision is not None and not isinstance(
+                handler, RevisionedStoreHandler):
+            # A check made here would not be atomic with the write, so
+            # another process could save in between.
+            raise ValueError(
+                'Store handler "{}" can not check revisions of {}'.format(
+                    self._handler_name(handler), model_type_name))
+        self._stats.record_key(model_type_name, model_instance.primary_key)
         # Validate before saving
-        try:
-            model_instance._validate()
-        except models.ValidationError as ve:
-            self.logger.error(ve.args[0])
-            self.logger.error(ve.args[1])
-            raise ve
+        self._validate_model(model_instance, handler)
+        if buffered and self._write_behind.enabled(model_type_name):
+            if revision is None:
+                self.logger.debug('> SAVE {} (buffered)'.format(
+                    model_instance))
+                self._write_behind.put(model_instance)
+                self._discard_cached(model_instance)
+                return model_instance
+            # Checked saves compare against the last save.
+            self._write_behind.flush(
+                model_type_name, model_instance.primary_key)
+        if self._journaled(model_instance):
+            if revision is None:
+                return self._journal_operation(
+                    JOURNAL_SAVE, handler, model_instance)
+            # Checked saves compare against the last journaled operation,
+            # which therefore has to reach the store first.
+            if self._journal.get(model_type_name, model_instance.primary_key):
+                self._journal.replay()
+            if self._journal.get(model_type_name, model_instance.primary_key):
+                raise StorageConflictError(
+                    'Journaled operations pending for {} "{}"'.format(
+                        model_type_name, model_instance.primary_key),
+                    model_instance, revision)
+        return self._store_model(handler, model_instance, revision)
+
+    def _store_model(self, handler, model_instance, revision=None):
+        """
+        Implements the store write of _save_model().
+
+        :param handler: The store handler for the model
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.model.Model
+        :param revision: Optional expected revision of the stored model
+        :type revision: str or None
+        :returns: The saved model instance
+        :rtype: commissaire.model.Model
+        :raises StorageConflictError: if the revision does not match
+        """
         self.logger.debug('> SAVE {}'.format(model_instance))
-        model_instance = handler._save(model_instance)
+        ttl = None
+        if revision is None:
+            ttl = self._retention_ttl(handler, model_instance)
+        if ttl is not None:
+            with self._time_op(handler, model_instance, 'save'):
+                model_instance = handler._save_with_ttl(model_instance, ttl)
+        elif isinstance(handler, RevisionedStoreHandler):
+            with self._time_op(handler, model_instance, 'save'):
+                model_instance = handler._save_if_revision(
+                    model_instance, revision)
+        else:
+            with self._time_op(handler, model_instance, 'save'):
+                model_instance = handler._save(model_instance)
+        if isinstance(handler, RevisionedStoreHandler):
+            revision = getattr(model_instance, REVISION_KEY, None)
+            if revision is not None:
+                self._validation.remember(model_instance, revision)
+        self._discard_cached(model_instance)
         self.logger.debug('< SAVE {}'.format(model_instance))
         return model_instance
 
+    def _write_buffered(self, model_instance):
+        """
+        Writes a save from the write-behind buffer.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.model.Model
+        """
+        self._save_model(model_instance, buffered=False)
+
+    def _cached_model(self, model_instance):
+        """
+        Returns a model's pending save in the write-behind buffer, or else
+        its latest journaled save, or else the model from the model cache,
+        or None.
+
+        :param model_instance: Model instance to search
+        :type model_instance: commissaire.model.Model
+        :rtype: commissaire.model.Model or None
+        :raises StorageLookupError: if the model's deletion is journaled
+        """
+        model_type_name = type(model_instance).__name__
+        cached = self._write_behind.get(
+            model_type_name, model_instance.primary_key)
+        if cached is None and self._journal is not None:
+            journaled = self._journal.get(
+                model_type_name, model_instance.primary_key)
+            if journaled is not None:
+                op, cached = journaled
+                if op == JOURNAL_DELETE:
+                    raise StorageLookupError(
+                        'No {} "{}" (journaled delete)'.format(
+                            model_type_name, model_instance.primary_key),
+                        model_instance)
+        if cached is None:
+            cached = self._model_cache.get(
+                model_type_name, model_instance.primary_key)
+        return cached
+
     def _get_model(self, model_instance):
         """
         Returns data from a store and returns back a model.
 
+        Concurrent gets for the same model share a single store lookup,
+        so the returned model instance must not be modified.
+
         :param model_instance: Model instance to search and get
         :type model_instance: commissaire.model.Model
         :returns: The saved model instance
         :rtype: commissaire.model.Model
         """
         handler = self._get_handler(model_instance)
+        model_type_name = type(model_instance).__name__
+        self._stats.record_key(model_type_name, model_instance.primary_key)
+        if self._negative_cache.contains(
+                model_type_name, model_instance.primary_key):
+            self.logger.debug('< GET {} (cached miss)'.format(model_instance))
+            raise StorageLookupError(
+                'No {} "{}" (cached)'.format(
+                    model_type_name, model_instance.primary_key),
+                model_instance)
+        cached = self._cached_model(model_instance)
+        if cached is not None:
+            self.logger.debug('< GET {} (cached)'.format(cached))
+            return cached
+        key = ('get', model_type_name, model_instance.primary_key,
+               id(handler), self._flights.generation(model_type_name))
+        return self._flights.do(
+            key, self._get_model_from_handler, handler, model_instance)
+
+    def _get_model_from_handler(self, handler, model_instance):
+        """
+        Implements _get_model() for a particular store handler.
+
+        :param handler: The store handler for the model
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.model.Model
+        :returns: The saved model instance
+        :rtype: commissaire.model.Model
+        """
         self.logger.debug('> GET {}'.format(model_instance))
-        model_instance = handler._get(model_instance)
-        # Validate after getting
+        generation = self._negative_cache.generation
+        model_generation = self._model_cache.generation
         try:
-            model_instance._validate()
-        except models.ValidationError as ve:
-            self.logger.error(ve.args[0])
-            self.logger.error(ve.args[1])
-            raise ve
+            with self._time_op(handler, model_instance, 'get'):
+                if isinstance(handler, RevisionedStoreHandler):
+                    model_instance, revision = handler._get_with_revision(
+                        model_instance)
+                    setattr(model_instance, REVISION_KEY, revision)
+                else:
+                    model_instance = handler._get(model_instance)
+        except StorageLookupError:
+            self._negative_cache.add(
+                type(model_instance).__name__, model_instance.primary_key,
+                generation)
+            raise
+        # Validate after getting, unless this revision was validated when
+        # it was written or last read.
+        self._validate_model(
+            model_instance, handler,
+            getattr(model_instance, REVISION_KEY, None))
+        self._model_cache.add(model_instance, model_generation)
         self.logger.debug('< GET {}'.format(model_instance))
         return model_instance
 
+    def _get_models(self, model_instances):
+        """
+        Returns data for several models from their stores.  Models whose
+        store handler is a BulkStoreHandler are fetched in one call per
+        handler; the rest one at a time through _get_model().
+
+        :param model_instances: Model instances to search and get
+        :type model_instances: list
+        :returns: Stored model instances or exceptions, in order
+        :rtype: list
+        """
+        results = [None] * len(model_instances)
+        # { id(handler) : ( handler, [ index, ... ] ) }
+        batches = collections.OrderedDict()
+        for index, model_instance in enumerate(model_instances):
+            try:
+                handler = self._get_handler(model_instance)
+                if not isinstance(handler, BulkStoreHandler):
+                    results[index] = self._get_model(model_instance)
+                    continue
+                model_type_name = type(model_instance).__name__
+                self._stats.record_key(
+                    model_type_name, model_instance.primary_key)
+                cached = self._cached_model(model_instance)
+                if cached is not None:
+                    results[index] = cached
+                elif self._negative_cache.contains(
+                        model_type_name, model_instance.primary_key):
+                    results[index] = StorageLookupError(
+                        'No {} "{}" (cached)'.format(
+                            model_type_name, model_instance.primary_key),
+                        model_instance)
+                else:
+                    batch = batches.setdefault(id(handler), (handler, []))
+                    batch[1].append(index)
+            except Exception as error:
+                results[index] = error
+
+        for handler, indexes in batches.values():
+            batch = [model_instances[index] for index in indexes]
+            generation = self._negative_cache.generation
+            model_generation = self._model_cache.generation
+            self.logger.debug('> GET {} models'.format(len(batch)))
+            try:
+                with self._time_op(handler, batch[0], 'get_many'):
+                    outcomes = handler._get_many(batch)
+            except Exception as error:
+                outcomes = [error] * len(batch)
+            for index, model_instance, outcome in zip(
+                    indexes, batch, outcomes):
+                if isinstance(outcome, StorageLookupError):
+                    self._negative_cache.add(
+                        type(model_instance).__name__,
+                        model_instance.primary_key, generation)
+                elif not isinstance(outcome, Exception):
+                    try:
+                        self._validate_model(
+                            outcome, handler,
+                            getattr(outcome, REVISION_KEY, None))
+                        self._model_cache.add(outcome, model_generation)
+                    except models.ValidationError as error:
+                        outcome = error
+                results[index] = outcome
+            self.logger.debug('< GET {} models'.format(len(batch)))
+        return results
+
+    def _save_models(self, model_instances):
+        """
+        Saves several models to their stores.  Models whose store handler
+        is a BulkStoreHandler are saved in one call per handler; the rest,
+        those to be saved with a retention TTL and those to be journaled
+        behind pending operations, one at a time through _save_model().
+        Journaled models whose bulk save fails with an outage are
+        journaled.
+
+        :param model_instances: Model instances to save
+        :type model_instances: list
+        :returns: Saved model instances or exceptions, in order
+        :rtype: list
+        """
+        results = [None] * len(model_instances)
+        # { id(handler) : ( handler, [ index, ... ] ) }
+        batches = collections.OrderedDict()
+        for index, model_instance in enumerate(model_instances):
+            try:
+                handler = self._get_handler(model_instance)
+                if (isinstance(handler, BulkStoreHandler) and
+                        not self._write_behind.enabled(
+                            type(model_instance).__name__) and
+                        self._retention_ttl(
+                            handler, model_instance) is None and
+                        not (self._journaled(model_instance) and
+                             self._journal.backlog)):
+                    self._stats.record_key(
+                        type(model_instance).__name__,
+                        model_instance.primary_key)
+                    self._validate_model(model_instance, handler)
+                    batch = batches.setdefault(id(handler), (handler, []))
+                    batch[1].append(index)
+                else:
+                    results[index] = self._save_model(model_instance)
+            except Exception as error:
+                results[index] = error
+
+        for handler, indexes in batches.values():
+            batch = [model_instances[index] for index in indexes]
+            self.logger.debug('> SAVE {} models'.format(len(batch)))
+            try:
+                with self._time_op(handler, batch[0], 'save_many'):
+                    outcomes = handler._save_many(batch)
+            except Exception as error:
+                outcomes = [error] * len(batch)
+            for index, outcome in zip(indexes, outcomes):
+                if (isinstance(outcome, Exception) and
+                        is_outage_error(outcome) and
+                        self._journaled(model_instances[index])):
+                    try:
+                        outcome = self._journal_append(
+                            JOURNAL_SAVE, model_instances[index], outcome)
+                    except Exception as error:
+                        outcome = error
+                    results[index] = outcome
+                    continue
+                if not isinstance(outcome, Exception):
+                    self._discard_cached(outcome)
+                    revision = getattr(outcome, REVISION_KEY, None)
+                    if revision is not None:
+                        self._validation.remember(outcome, revision)
+                results[index] = outcome
+            self.logger.debug('< SAVE {} models'.format(len(batch)))
+        return results
+
     def _delete_model(self, model_instance):
         """
         Deletes data from a store.
@@ -303,26 +1258,247 @@ class StorageService(CommissaireService):
         :type model_instance:
         """
         handler = self._get_handler(model_instance)
+        self._stats.record_key(
+            type(model_instance).__name__, model_instance.primary_key)
+        self._write_behind.discard(
+            type(model_instance).__name__, model_instance.primary_key)
+        if self._journaled(model_instance):
+            self._journal_operation(JOURNAL_DELETE, handler, model_instance)
+        else:
+            self._remove_model(handler, model_instance)
+
+    def _remove_model(self, handler, model_instance):
+        """
+        Implements the store delete of _delete_model().
+
+        :param handler: The store handler for the model
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: Model instance to delete
+        :type model_instance: commissaire.model.Model
+        """
         self.logger.debug('> DELETE {}'.format(model_instance))
-        handler._delete(model_instance)
+        with self._time_op(handler, model_instance, 'delete'):
+            handler._delete(model_instance)
+        self._validation.forget(model_instance)
+        self._discard_cached(model_instance)
 
-    def _list_models(self, model_instance):
+    def _list_models(self, model_instance, stream_queue=None):
         """
         Lists data at a location in a store and returns back model instances.
 
+        Concurrent lists of the same model type share a single store
+        lookup, so the returned model instances must not be modified.
+
+        If the list model has several store handlers (see _list_handlers()),
+        they are listed in parallel and their results are merged, in
+        handler order, dropping later duplicates.  Handlers not done within
+        the list timeout are left out.  If stream_queue is given, each
+        handler's results are also sent to that queue as they arrive.
+
+        :param model_instance: List model instance indicating the data type
+                               to search for
+        :type model_instance: commissaire.model.ListModel
+        :param stream_queue: Optional queue for partial results
+        :type stream_queue: str or None
+        :returns: A list of models
+        :rtype: list
+        """
+        handlers = self._list_handlers(model_instance)
+        # Lists see all saves made so far.
+        self._write_behind.flush()
+        if len(handlers) == 1 and stream_queue is None:
+            return self._with_journaled(
+                model_instance,
+                self._list_models_shared(handlers[0], model_instance))
+
+        with self._handler_lock:
+            if self._fan_out_executor is None:
+                self._fan_out_executor = ThreadPoolExecutor(
+                    len(self._definitions_by_name))
+        futures = {
+            self._fan_out_executor.submit(
+                self._list_models_shared, handler, model_instance): index
+            for index, handler in enumerate(handlers)}
+        results = [[] for _ in handlers]
+        try:
+            for future in as_completed(futures, self._list_timeout):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception as error:
+                    self.logger.error(
+                        'Unable to list {} from {}: {}: {}'.format(
+                            model_instance,
+                            self._handler_name(handlers[index]),
+                            type(error), error))
+                    continue
+                if stream_queue is not None:
+                    self._send_event(stream_queue, {
+                        'handler': self._handler_name(handlers[index]),
+                        'models': [x.to_dict() for x in results[index]],
+                    })
+        except TimeoutError:
+            self.logger.warn('Timed out listing {} from: {}'.format(
+                model_instance, ', '.join(
+                    self._handler_name(handlers[index])
+                    for future, index in futures.items()
+                    if not future.done())))
+
+        merged = []
+        seen = set()
+        for result in results:
+            for item in result:
+                if item.primary_key not in seen:
+                    seen.add(item.primary_key)
+                    merged.append(item)
+        return self._with_journaled(model_instance, merged)
+
+    def _list_models_shared(self, handler, model_instance):
+        """
+        Lists data through one store handler, sharing the lookup with
+        identical concurrent lists.
+
+        :param handler: The store handler to list from
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: List model instance indicating the data type
+                               to search for
+        :type model_instance: commissaire.model.ListModel
+        :returns: A list of models
+        :rtype: list
+        """
+        model_type_name = list_type_name(model_instance)
+        key = ('list', model_type_name, id(handler),
+               self._flights.generation(model_type_name))
+        return self._flights.do(
+            key, self._list_models_from_handler, handler, model_instance)
+
+    def _list_models_from_handler(self, handler, model_instance):
+        """
+        Implements _list_models() for a particular store handler.
+
+        :param handler: The store handler for the model type
+        :type handler: commissaire.storage.StoreHandlerBase
         :param model_instance: List model instance indicating the data type
                                to search for
         :type model_instance: commissaire.model.ListModel
         :returns: A list of models
         :rtype: list
         """
-        handler = self._get_handler(model_instance)
         self.logger.debug('> LIST {}'.format(model_instance))
-        model_instance = handler._list(model_instance)
+        with self._time_op(handler, model_instance, 'list'):
+            model_instance = handler._list(model_instance)
         self.logger.debug('< LIST {}'.format(model_instance))
         return getattr(model_instance, model_instance._list_attr, [])
 
-    def on_save(self, message, model_type_name, model_json_data):
+    def on_message(self, body, message):
+        """
+        Called when a new message arrives.  With "storage_workers" above
+        1, the message is handled on a worker thread and acknowledged
+        once handled; otherwise it is handled as by CommissaireService.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        if self._executor is None:
+            super().on_message(body, message)
+            return
+
+        self._executor_slots.acquire()
+        try:
+            self._executor.submit(self._on_message_worker, body, message)
+        except Exception:
+            self._executor_slots.release()
+            raise
+
+    def _on_message_worker(self, body, message):
+        """
+        Handles a message on a worker thread.
+
+        :param body: Body of the message.
+        :type body: dict or json string
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        """
+        try:
+            response = self._process_message(body, message)
+            self._send_response(message, response)
+        except Exception as error:
+            self.logger.error(
+                'Unable to handle message "{}": {}: {}'.format(
+                    message.delivery_tag, type(error), error))
+        finally:
+            # Acknowledgements have to come from the consumer's thread.
+            self._handled.put(message)
+            self._executor_slots.release()
+
+    def on_iteration(self):
+        """
+        Acknowledges the messages handled by workers.  Called by
+        kombu.mixins.ConsumerMixin on the consumer's thread between
+        waits for messages.
+        """
+        while True:
+            try:
+                message = self._handled.get_nowait()
+            except queue.Empty:
+                return
+            message.ack()
+
+    def consume(self, *args, **kwargs):
+        """
+        Consumes messages, as by kombu.mixins.ConsumerMixin.  With worker
+        threads, waits for messages at most ACK_INTERVAL seconds at a time
+        so handled messages are acknowledged soon.
+        """
+        if self._executor is not None:
+            kwargs.setdefault('safety_interval', self.ACK_INTERVAL)
+        return super().consume(*args, **kwargs)
+
+    def _send_response(self, message, response):
+        """
+        Replies to a message with a jsonrpc response, if the sender
+        asked for a reply, on the calling thread's connection.
+
+        :param message: The message instance.
+        :type message: kombu.message.Message
+        :param response: The jsonrpc response.
+        :type response: dict
+        """
+        if message.properties.get('reply_to'):
+            self.logger.debug('Responding to {}'.format(
+                message.properties['reply_to']))
+            response_queue = self._bus()[0].SimpleQueue(
+                message.properties['reply_to'])
+            response_queue.put(self._encode_response(response))
+            response_queue.close()
+
+    def _encode_response(self, response):
+        """
+        Encodes a jsonrpc response for sending.  Encoded model replies in
+        the result are inserted as they are.
+
+        :param response: The jsonrpc response.
+        :type response: dict
+        :returns: The JSON encoded response.
+        :rtype: str
+        """
+        result = response.get('result')
+        if isinstance(result, list) and result and all(
+                isinstance(x, EncodedJSON) for x in result):
+            result_text = '[{}]'.format(', '.join(x.text for x in result))
+        elif isinstance(result, EncodedJSON):
+            result_text = result.text
+        else:
+            return json.dumps(response, default=encode_json_default)
+        text = json.dumps(
+            {k: v for k, v in response.items() if k != 'result'})
+        # Append the result to the encoded object.
+        return '{}, "result": {}}}'.format(text[:-1], result_text)
+
+    def on_save(self, message, model_type_name, model_json_data,
+                revision=None, with_revision=False):
         """
         Handler for the "storage.save" routing key.
 
@@ -334,26 +1510,49 @@ class StorageService(CommissaireService):
         which returns a list of full models; equivalent to calling the method
         once for each list item, with fewer bus messages.
 
+        If a revision is given (as returned by "storage.get"), the save
+        fails with a StorageConflictError unless the stored model still has
+        that revision.  Only store handlers which track revisions natively
+        accept revisions.  For a list of models, the revision argument must be
+        a list of the same length, with None for unchecked saves.  Replies
+        then include the new revision under the "_revision" key.
+
         :param message: A message instance
         :type message: kombu.message.Message
         :param model_type_name: Model type for the JSON data
         :type model_type_name: str
         :param model_json_data: JSON representation of one or more models
         :type model_json_data: dict, str, [dict, ...] or [str, ...]
+        :param revision: Expected revision(s) of the stored model(s)
+        :type revision: str, [str, ...] or None
+        :param with_revision: Include revisions in the reply
+        :type with_revision: bool
         :returns: full dict representation of the model(s)
         :rtype: dict or [dict, ...]
+        :raises StorageConflictError: if a revision does not match
         """
+        with_revision = with_revision or revision is not None
         if isinstance(model_json_data, list):
+            if revision is None:
+                revision = [None] * len(model_json_data)
+            elif (not isinstance(revision, list) or
+                    len(revision) != len(model_json_data)):
+                raise ValueError(
+                    'Expected {} revisions, got: {}'.format(
+                        len(model_json_data), revision))
             # Build all models first so we catch invalid input before
             # touching permanent storage.
             models = [self._build_model(model_type_name, x)
                       for x in model_json_data]
-            return [self._save_model(x).to_dict() for x in models]
+            return [self._model_reply(self._save_model(x, r), with_revision)
+                    for x, r in zip(models, revision)]
         else:
             model = self._build_model(model_type_name, model_json_data)
-            return self._save_model(model).to_dict()
+            return self._model_reply(
+                self._save_model(model, revision), with_revision)
 
-    def on_get(self, message, model_type_name, model_json_data):
+    def on_get(self, message, model_type_name, model_json_data,
+               with_revision=False, if_not_revision=None):
         """
         Handler for the "storage.get" routing key.
 
@@ -364,12 +1563,26 @@ class StorageService(CommissaireService):
         which returns a list of full models; equivalent to calling the method
         once for each list item, with fewer bus messages.
 
+        If with_revision is set, each model's revision is included under
+        the "_revision" key, to be passed back to "storage.save" for a
+        compare-and-swap write.
+
+        If if_not_revision is given, a model still at that revision is
+        answered with just {"not_modified": true, "_revision": ...}
+        instead of the full model, and a changed model is returned with
+        its revision.  For a list of models, if_not_revision is a list of
+        revisions (or None) in the same order.
+
         :param message: A message instance
         :type message: kombu.message.Message
         :param model_type_name: Model type for the JSON data
         :type model_type_name: str
         :param model_json_data: JSON identification of one or more models
         :type model_json_data: dict, str, [dict, ...] or [str, ...]
+        :param with_revision: Include revisions in the reply
+        :type with_revision: bool
+        :param if_not_revision: Revision(s) the caller already holds
+        :type if_not_revision: str, [str, ...] or None
         :returns: full dict representation of the model(s)
         :rtype: dict or [dict, ...]
         """
@@ -378,10 +1591,25 @@ class StorageService(CommissaireService):
             # touching permanent storage.
             models = [self._build_model(model_type_name, x)
                       for x in model_json_data]
-            return [self._get_model(x).to_dict() for x in models]
+            results = self._get_models(models)
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+            if if_not_revision is None:
+                return [self._model_wire_reply(x, with_revision)
+                        for x in results]
+            if (not isinstance(if_not_revision, list) or
+                    len(if_not_revision) != len(results)):
+                raise TypeError(
+                    'if_not_revision must list a revision for each model')
+            return [self._conditional_reply(x, revision)
+                    for x, revision in zip(results, if_not_revision)]
         else:
             model = self._build_model(model_type_name, model_json_data)
-            return self._get_model(model).to_dict()
+            model = self._get_model(model)
+            if if_not_revision is None:
+                return self._model_wire_reply(model, with_revision)
+            return self._conditional_reply(model, if_not_revision)
 
     def on_delete(self, message, model_type_name, model_json_data):
         """
@@ -410,21 +1638,29 @@ class StorageService(CommissaireService):
         for model_instance in models:
             self._delete_model(model_instance)
 
-    def on_list(self, message, model_type_name):
+    def on_list(self, message, model_type_name, stream_queue=None):
         """
         Handler for the "storage.list" routing key.
 
         Lists available data for the given model type from a store.
 
+        Hosts are listed from every store handler which can hold them,
+        including those serving Hosts by "source", in parallel.  If a
+        stream_queue is given, each store handler's results are also sent
+        there as soon as they arrive, as a dictionary with the 'handler'
+        name and its 'models'.
+
         :param message: A message instance
         :type message: kombu.message.Message
         :param model_type_name: Model type for the JSON data
         :type model_type_name: str
+        :param stream_queue: Optional queue for partial results
+        :type stream_queue: str or None
         :returns: a list of model representations as dicts
         :rtype: list
         """
         model_type = self._model_types[model_type_name]
-        model_list = self._list_models(model_type.new())
+        model_list = self._list_models(model_type.new(), stream_queue)
         return [model_instance.to_dict() for model_instance in model_list]
 
     def on_list_store_handlers(self, message):
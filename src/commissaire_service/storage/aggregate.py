@@ -0,0 +1,127 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Counting and grouping models for the StorageService.
+"""
+
+import commissaire.models as models
+
+from .base import AggregateStoreHandler, group_counts, list_type_name
+
+
+class AggregateMixin:
+    """
+    Handles the "storage.count" and "storage.aggregate" routing keys of
+    the StorageService.
+    """
+
+    def _new_list_model(self, model_type_name):
+        """
+        Returns a new list model instance of a list model type.
+
+        :param model_type_name: List model type name
+        :type model_type_name: str
+        :returns: A new list model instance
+        :rtype: commissaire.model.ListModel
+        :raises ValueError: if model_type_name is not a list model type
+        """
+        model_type = self._model_types[model_type_name]
+        if not issubclass(model_type, models.ListModel):
+            raise ValueError('{} is not a list model type'.format(
+                model_type_name))
+        return model_type.new()
+
+    def _aggregate_handler(self, model_instance):
+        """
+        Returns the store handler which can count and aggregate models of
+        a type itself, or None if they must be listed instead: when the
+        type is listed from several store handlers, or has journaled
+        operations the store does not know about yet.
+
+        :param model_instance: List model instance of the type
+        :type model_instance: commissaire.model.ListModel
+        :rtype: AggregateStoreHandler or None
+        """
+        handlers = self._list_handlers(model_instance)
+        if (len(handlers) != 1 or
+                not isinstance(handlers[0], AggregateStoreHandler)):
+            return None
+        if self._journal is not None and self._journal.pending(
+                list_type_name(model_instance)):
+            return None
+        return handlers[0]
+
+    def on_count(self, message, model_type_name):
+        """
+        Handler for the "storage.count" routing key.
+
+        Counts the available models of the given type in a store, without
+        sending them over the bus.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param model_type_name: List model type, as for "storage.list"
+        :type model_type_name: str
+        :returns: the number of models
+        :rtype: int
+        """
+        model_instance = self._new_list_model(model_type_name)
+        handler = self._aggregate_handler(model_instance)
+        if handler is not None:
+            self._write_behind.flush()
+            with self._time_op(handler, model_instance, 'count'):
+                return handler._count(model_instance)
+        return len(self._list_models(model_instance))
+
+    def on_aggregate(self, message, model_type_name, group_by):
+        """
+        Handler for the "storage.aggregate" routing key.
+
+        Counts the available models of the given type in a store by
+        distinct values of one or more model attributes, without sending
+        the models over the bus.  For example, grouping Hosts by "status"
+        may return:
+
+           [[["active"], 12], [["failed"], 1]]
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param model_type_name: List model type, as for "storage.list"
+        :type model_type_name: str
+        :param group_by: Model attribute name(s) to group by
+        :type group_by: str or [str, ...]
+        :returns: [ [ [ value, ... ], count ], ... ] sorted by descending
+                  count
+        :rtype: list
+        """
+        if isinstance(group_by, str):
+            group_by = [group_by]
+        if not group_by:
+            raise ValueError('No attributes to group by')
+        model_instance = self._new_list_model(model_type_name)
+        list_class = model_instance._list_class
+        for name in group_by:
+            if name not in list_class._attribute_map:
+                raise ValueError('{} has no attribute "{}"'.format(
+                    list_class.__name__, name))
+        handler = self._aggregate_handler(model_instance)
+        if handler is not None:
+            self._write_behind.flush()
+            with self._time_op(handler, model_instance, 'aggregate'):
+                return handler._aggregate(model_instance, group_by)
+
+        return group_counts(
+            [getattr(item, name) for name in group_by]
+            for item in self._list_models(model_instance))
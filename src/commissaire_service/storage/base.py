@@ -0,0 +1,317 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Optional store handler capabilities and errors used by the StorageService.
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+
+from commissaire.bus import RemoteProcedureCallError
+
+
+#: Key under which a model's revision is reported in replies.
+REVISION_KEY = '_revision'
+
+#: Key marking the reply to a conditional get of an unchanged model.
+NOT_MODIFIED_KEY = 'not_modified'
+
+#: JSON-RPC error code for a failed compare-and-swap save.
+#: (Implementation-defined server error range, see the JSON-RPC spec.)
+STORAGE_CONFLICT_ERROR_CODE = -32010
+
+
+class StorageConflictError(RemoteProcedureCallError):
+    """
+    Raised when a save names an expected revision that does not match
+    the revision currently held by the store.
+    """
+
+    code = STORAGE_CONFLICT_ERROR_CODE
+
+    def __init__(self, message, model=None, expected=None, actual=None):
+        """
+        Creates a new StorageConflictError.
+
+        :param message: Error message
+        :type message: str
+        :param model: The model instance which failed to save
+        :type model: commissaire.models.Model or None
+        :param expected: The revision the caller expected
+        :type expected: str or None
+        :param actual: The revision currently held by the store
+        :type actual: str or None
+        """
+        data = {
+            'expected': expected,
+            'actual': actual,
+        }
+        if model is not None:
+            data['model_type'] = type(model).__name__
+            data['primary_key'] = model.primary_key
+        super().__init__(message, data)
+
+
+def list_type_name(model_instance):
+    """
+    Returns the name of the model type a list model holds.
+
+    :param model_instance: List model instance
+    :type model_instance: commissaire.models.ListModel
+    :rtype: str
+    """
+    return model_instance._list_class.__name__
+
+
+def content_revision(model_data):
+    """
+    Derives a revision string from the content of a model.  Used for
+    store handlers which do not track revisions natively.
+
+    :param model_data: Dict representation of a model
+    :type model_data: dict
+    :returns: A revision string
+    :rtype: str
+    """
+    data = json.dumps(model_data, sort_keys=True)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def group_counts(rows, counts=None):
+    """
+    Counts rows of model attribute values by distinct values, as returned
+    by AggregateStoreHandler._aggregate().  Unhashable values (lists,
+    dicts) are grouped by their JSON representation.
+
+    :param rows: The attribute values of each model, in field order
+    :type rows: iterable
+    :param counts: Number of models of each row, if already grouped
+    :type counts: iterable or None
+    :returns: [ [ [ value, ... ], count ], ... ] sorted by descending count
+    :rtype: list
+    """
+    if counts is None:
+        counts = itertools.repeat(1)
+    histogram = collections.Counter()
+    for row, count in zip(rows, counts):
+        histogram[tuple(
+            json.dumps(value, sort_keys=True)
+            if isinstance(value, (list, dict)) else value
+            for value in row)] += count
+    return [[list(values), count]
+            for values, count in histogram.most_common()]
+
+
+class RevisionedStoreHandler:
+    """
+    Mixin for store handlers which track model revisions natively and can
+    enforce them atomically, such as etcd's modifiedIndex.
+
+    Models from handlers without this mixin are reported with content
+    revisions, and revision checked saves to them are refused, as the
+    StorageService can not check a revision atomically with the write.
+    """
+
+    def _get_with_revision(self, model_instance):
+        """
+        Retrieves a model along with its current revision in a single
+        read from the store.
+
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.models.Model
+        :returns: The stored model instance and its revision
+        :rtype: tuple
+        :raises commissaire.bus.StorageLookupError: if the model is missing
+        """
+        raise NotImplementedError(
+            '{}._get_with_revision() must be overridden.'.format(
+                self.__class__.__name__))
+
+    def _save_if_revision(self, model_instance, revision):
+        """
+        Saves a model only if the stored revision still matches the given
+        revision, or unconditionally if the revision is None.  The returned
+        model instance carries its new revision in the "_revision" attribute.
+
+        The StorageService saves through this method instead of _save() so
+        that every reply can report a native revision.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param revision: The expected current revision
+        :type revision: str or None
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        :raises StorageConflictError: if the revision does not match
+        """
+        raise NotImplementedError(
+            '{}._save_if_revision() must be overridden.'.format(
+                self.__class__.__name__))
+
+
+class BulkStoreHandler:
+    """
+    Mixin for store handlers which can get or save many models in fewer
+    round trips than one per model.
+
+    Results are returned in the order of the given models.  A model that
+    fails is represented by the exception instead of raising it, so one
+    failure does not hide the outcome of the others.
+
+    Handlers which are also RevisionedStoreHandlers record each model's
+    revision in its "_revision" attribute.
+    """
+
+    def _get_many(self, model_instances):
+        """
+        Retrieves several models.
+
+        :param model_instances: Model instances to search and get
+        :type model_instances: list
+        :returns: Stored model instances or exceptions, in order
+        :rtype: list
+        """
+        raise NotImplementedError(
+            '{}._get_many() must be overridden.'.format(
+                self.__class__.__name__))
+
+    def _save_many(self, model_instances):
+        """
+        Saves several models.
+
+        :param model_instances: Model instances to save
+        :type model_instances: list
+        :returns: Saved model instances or exceptions, in order
+        :rtype: list
+        """
+        raise NotImplementedError(
+            '{}._save_many() must be overridden.'.format(
+                self.__class__.__name__))
+
+
+class AggregateStoreHandler:
+    """
+    Mixin for store handlers which can count and group models without
+    building and sending every model to the StorageService, such as from
+    an index.  Group values are as given by group_counts().
+
+    The StorageService checks that the fields are model attributes.
+    """
+
+    def _count(self, model_instance):
+        """
+        Counts the models of a list model's type.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :returns: The number of models
+        :rtype: int
+        """
+        raise NotImplementedError(
+            '{}._count() must be overridden.'.format(
+                self.__class__.__name__))
+
+    def _aggregate(self, model_instance, fields):
+        """
+        Counts the models of a list model's type by distinct values of
+        the given fields.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param fields: Model attribute names to group by
+        :type fields: [str, ...]
+        :returns: [ [ [ value, ... ], count ], ... ]
+        :rtype: list
+        """
+        raise NotImplementedError(
+            '{}._aggregate() must be overridden.'.format(
+                self.__class__.__name__))
+
+
+class RangeDeleteStoreHandler:
+    """
+    Mixin for store handlers which can delete every model of a type whose
+    primary key starts with a prefix in one store operation, such as a
+    recursive delete of an etcd directory or an SQL range delete.
+    """
+
+    def _delete_prefix(self, model_instance, prefix):
+        """
+        Deletes the models of a list model's type whose primary keys start
+        with a prefix, notifying each deletion as _delete() does.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param prefix: Primary key prefix; "" deletes all of the type
+        :type prefix: str
+        :returns: The deleted model instances
+        :rtype: list
+        """
+        raise NotImplementedError(
+            '{}._delete_prefix() must be overridden.'.format(
+                self.__class__.__name__))
+
+
+class ScanStoreHandler:
+    """
+    Mixin for store handlers which can read the models of a type a page at
+    a time, so that walking every model, as for a snapshot export, keeps
+    only one page in memory.
+    """
+
+    def _scan(self, model_instance, page_size):
+        """
+        Iterates over the models of a list model's type in primary key
+        order, reading at most page_size models from the store at a time.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param page_size: Most models read at a time
+        :type page_size: int
+        :returns: model instances
+        :rtype: generator
+        """
+        raise NotImplementedError(
+            '{}._scan() must be overridden.'.format(
+                self.__class__.__name__))
+
+
+class ExpiringStoreHandler:
+    """
+    Mixin for store handlers which can delete models by themselves after
+    a time-to-live, such as etcd's key TTLs.
+
+    The StorageService uses this to enforce "ttl" retention policies
+    natively.  Expiry by the store sends no notifications.
+    """
+
+    def _save_with_ttl(self, model_instance, ttl):
+        """
+        Saves a model which the store deletes after ttl seconds.  Handlers
+        which are also RevisionedStoreHandlers record the new revision in
+        the "_revision" attribute.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param ttl: Seconds until the model is deleted
+        :type ttl: int
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        """
+        raise NotImplementedError(
+            '{}._save_with_ttl() must be overridden.'.format(
+                self.__class__.__name__))
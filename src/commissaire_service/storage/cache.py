@@ -0,0 +1,273 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Model caches for the StorageService.
+"""
+
+import collections
+import json
+import threading
+import time
+
+
+#: Attribute of cached model instances holding their encoded replies.
+WIRE_KEY = '_wire'
+
+
+class EncodedJSON:
+    """
+    A JSON-compatible value together with its JSON encoding, so that the
+    encoding can be reused for every reply sending the value.
+    """
+
+    __slots__ = ('data', 'text')
+
+    def __init__(self, data):
+        """
+        Creates a new EncodedJSON.
+
+        :param data: A JSON-compatible value
+        :type data: dict or list
+        """
+        self.data = data
+        self.text = json.dumps(data)
+
+    def __str__(self):
+        return self.text
+
+
+def encode_json_default(value):
+    """
+    json.dumps() hook encoding EncodedJSON values nested in other values.
+
+    :param value: A value json.dumps() could not encode
+    :type value: object
+    :returns: A JSON-compatible replacement
+    :raises TypeError: if the value is not an EncodedJSON
+    """
+    if isinstance(value, EncodedJSON):
+        return value.data
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
+class NegativeCache:
+    """
+    Remembers, for a short time, which models were not found in a store.
+
+    Each model type has its own time-to-live; types without one are never
+    cached.  Any invalidation bumps a generation counter, and lookups that
+    started before an invalidation are not cached, so a miss racing with
+    a save can never be remembered after the save.
+    """
+
+    def __init__(self, ttls):
+        """
+        Creates a new NegativeCache.
+
+        :param ttls: Seconds to remember a miss, by model type name
+        :type ttls: dict
+        """
+        self._ttls = {k: v for k, v in ttls.items() if v and v > 0}
+        self._lock = threading.Lock()
+        self._expires = {}
+        self._adds = 0
+        #: Incremented by every invalidation.
+        self.generation = 0
+        #: Number of lookups answered from the cache.
+        self.hits = 0
+
+    def enabled(self, model_type_name):
+        """
+        Returns whether misses of a model type are cached.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :rtype: bool
+        """
+        return model_type_name in self._ttls
+
+    def contains(self, model_type_name, key):
+        """
+        Returns whether a model is known to be missing.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        :rtype: bool
+        """
+        if not self._ttls:
+            return False
+        cache_key = (model_type_name, key)
+        with self._lock:
+            expires = self._expires.get(cache_key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._expires[cache_key]
+                return False
+            self.hits += 1
+            return True
+
+    def add(self, model_type_name, key, generation):
+        """
+        Remembers a model as missing, unless anything was invalidated since
+        the lookup began.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        :param generation: The generation read before the lookup began
+        :type generation: int
+        """
+        ttl = self._ttls.get(model_type_name)
+        if ttl is None:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            now = time.monotonic()
+            self._expires[(model_type_name, key)] = now + ttl
+            # Keep expired entries from piling up.
+            self._adds += 1
+            if self._adds % 1024 == 0:
+                self._expires = {k: v for k, v in self._expires.items()
+                                 if v >= now}
+
+    def discard(self, model_type_name, key):
+        """
+        Forgets that a model is missing.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        """
+        if model_type_name not in self._ttls:
+            return
+        with self._lock:
+            self.generation += 1
+            self._expires.pop((model_type_name, key), None)
+
+
+class ModelCache:
+    """
+    Keeps recently read models, with their encoded replies, for a short
+    time.
+
+    Each model type has its own time-to-live; types without one are never
+    cached.  At most "size" models are kept, dropping the least recently
+    used.  Invalidation works as for NegativeCache.
+
+    Cached model instances are shared and must not be modified.  Encoded
+    replies are kept on the instance under WIRE_KEY, as a dictionary
+    filled by the caller.
+    """
+
+    def __init__(self, ttls, size=1024):
+        """
+        Creates a new ModelCache.
+
+        :param ttls: Seconds to keep a model, by model type name
+        :type ttls: dict
+        :param size: Maximum number of models to keep
+        :type size: int
+        """
+        self._ttls = {k: v for k, v in ttls.items() if v and v > 0}
+        self._size = size
+        self._lock = threading.Lock()
+        # { ( model_type_name, key ) : ( expires, model_instance ) }
+        self._entries = collections.OrderedDict()
+        #: Incremented by every invalidation.
+        self.generation = 0
+        #: Number of lookups answered from the cache.
+        self.hits = 0
+
+    def enabled(self, model_type_name):
+        """
+        Returns whether models of a type are cached.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :rtype: bool
+        """
+        return model_type_name in self._ttls
+
+    def get(self, model_type_name, key):
+        """
+        Returns a cached model, or None.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        :rtype: commissaire.model.Model or None
+        """
+        if not self._ttls:
+            return None
+        cache_key = (model_type_name, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None:
+                return None
+            expires, model_instance = entry
+            if expires < time.monotonic():
+                del self._entries[cache_key]
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return model_instance
+
+    def add(self, model_instance, generation):
+        """
+        Keeps a model read from a store, unless anything was invalidated
+        since the read began.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        :param generation: The generation read before the read began
+        :type generation: int
+        """
+        model_type_name = type(model_instance).__name__
+        ttl = self._ttls.get(model_type_name)
+        if ttl is None:
+            return
+        cache_key = (model_type_name, model_instance.primary_key)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if getattr(model_instance, WIRE_KEY, None) is None:
+                setattr(model_instance, WIRE_KEY, {})
+            self._entries[cache_key] = (
+                time.monotonic() + ttl, model_instance)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+    def discard(self, model_type_name, key):
+        """
+        Forgets a cached model.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        """
+        if model_type_name not in self._ttls:
+            return
+        with self._lock:
+            self.generation += 1
+            self._entries.pop((model_type_name, key), None)
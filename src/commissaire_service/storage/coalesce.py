@@ -0,0 +1,132 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Request coalescing for the StorageService.
+"""
+
+import threading
+
+
+class _Flight:
+    """
+    A call in progress and its eventual outcome.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent calls.  While a call for a key is in
+    progress, further calls for the same key wait for it and share its
+    result (or exception) instead of calling again.
+
+    Shared results must be treated as read-only by all callers.
+
+    Callers that write data include generation(scope) in their keys and
+    call written(scope) after each write, so calls made after a write
+    never share the outcome of a call that started before it.
+    """
+
+    def __init__(self):
+        """
+        Creates a new SingleFlight.
+        """
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._generations = {}
+        #: Number of calls actually made.
+        self.calls = 0
+        #: Number of calls answered by sharing another call's outcome.
+        self.shared = 0
+
+    def do(self, key, func, *args):
+        """
+        Calls func(*args) unless a call for key is already in progress,
+        in which case that call's outcome is returned.
+
+        :param key: Identifies equivalent calls
+        :type key: hashable
+        :param func: Function to call
+        :type func: callable
+        :param args: Arguments for func
+        :type args: tuple
+        :returns: The result of the call
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = _Flight()
+                self._flights[key] = flight
+                self.calls += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func(*args)
+            return flight.result
+        except Exception as error:
+            flight.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def generation(self, scope):
+        """
+        Returns the write generation of a scope.
+
+        :param scope: Identifies the data written
+        :type scope: hashable
+        :returns: The number of writes recorded for scope
+        :rtype: int
+        """
+        with self._lock:
+            return self._generations.get(scope, 0)
+
+    def written(self, scope):
+        """
+        Records a write to a scope.
+
+        :param scope: Identifies the data written
+        :type scope: hashable
+        """
+        with self._lock:
+            self._generations[scope] = self._generations.get(scope, 0) + 1
+
+    def stats(self):
+        """
+        Returns call counters.
+
+        :returns: backend_calls and saved_calls
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'backend_calls': self.calls,
+                'saved_calls': self.shared,
+            }
@@ -16,48 +16,413 @@
 Custodia based StoreHandler.
 """
 
+import collections
+import json
+import logging
+import random
+import socket
+import threading
+import time
+
 import requests
+import urllib3
 
-from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, unquote, urlparse
 
 from commissaire.bus import StorageLookupError
 from commissaire.storage import StoreHandlerBase
-from commissaire.util.unixadapter import UnixAdapter
+from commissaire.util.config import ConfigurationError
+
+from .base import BulkStoreHandler
 
 
 HTTP_SOCKET_PREFIX = 'http+unix://'
 DEFAULT_SOCKET_PATH = '/var/run/custodia/custodia.sock'
 
 
-class CustodiaStoreHandler(StoreHandlerBase):
+class UnixHTTPConnection(urllib3.connection.HTTPConnection):
+    """
+    An HTTP connection over a unix socket.
+    """
+
+    def __init__(self, *args, socket_path=None, **kwargs):
+        self.socket_path = socket_path
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        timeout = self.timeout
+        if timeout is not None and not isinstance(timeout, (int, float)):
+            timeout = socket.getdefaulttimeout()
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+
+class UnixHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    """
+    A pool of HTTP connections over a unix socket.
+    """
+
+    ConnectionCls = UnixHTTPConnection
+
+
+class PooledUnixAdapter(requests.adapters.HTTPAdapter):
+    """
+    Transport adapter for "http+unix://" URLs, which keeps up to
+    pool_size persistent connections to each socket.  Threads needing a
+    connection while all are in use wait for one to be returned.
+    """
+
+    def __init__(self, pool_size=10):
+        """
+        Creates a new PooledUnixAdapter.
+
+        :param pool_size: Maximum connections per unix socket
+        :type pool_size: int
+        """
+        super().__init__()
+        self._pool_size = pool_size
+        self._pools = {}
+        self._pools_lock = threading.Lock()
+
+    def get_connection(self, url, proxies=None):
+        """
+        Returns the connection pool for a URL's unix socket.
+
+        :param url: An "http+unix://" URL
+        :type url: str
+        :param proxies: Ignored
+        :type proxies: dict or None
+        :rtype: UnixHTTPConnectionPool
+        """
+        socket_path = unquote(urlparse(url).netloc)
+        with self._pools_lock:
+            pool = self._pools.get(socket_path)
+            if pool is None:
+                pool = UnixHTTPConnectionPool(
+                    'localhost', maxsize=self._pool_size, block=True,
+                    socket_path=socket_path)
+                self._pools[socket_path] = pool
+        return pool
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                        cert=None):
+        # Used instead of get_connection() by newer versions of requests.
+        return self.get_connection(request.url, proxies)
+
+    def close(self):
+        super().close()
+        with self._pools_lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
+
+
+class SecretCache:
+    """
+    Keeps secrets read from Custodia for a short time, by key URL.
+
+    At most "size" secrets are kept, evicting the least recently used,
+    and each for at most "ttl" seconds.  The cached bytes are overwritten
+    with zeros when evicted, expired or invalidated.  Expired secrets are
+    purged whenever the cache is used.
+
+    Any invalidation bumps a generation counter, and reads that started
+    before an invalidation are not cached, so a read racing with a save
+    can never be cached after the save.
+    """
+
+    def __init__(self, ttl, size):
+        """
+        Creates a new SecretCache.
+
+        :param ttl: Seconds to keep a secret; 0 disables the cache
+        :type ttl: int or float
+        :param size: Maximum number of secrets kept
+        :type size: int
+        """
+        self._ttl = ttl
+        self._size = size
+        self._lock = threading.Lock()
+        # { url : ( expires, bytearray ) }
+        self._entries = collections.OrderedDict()
+        #: Bumped by every invalidation.
+        self.generation = 0
+        #: Number of reads answered from the cache.
+        self.hits = 0
+
+    @property
+    def enabled(self):
+        """
+        Whether secrets are cached at all.
+        """
+        return self._ttl > 0 and self._size > 0
+
+    def get(self, url):
+        """
+        Returns a copy of a cached secret, or None.
+
+        :param url: The key URL
+        :type url: str
+        :rtype: bytes or None
+        """
+        with self._lock:
+            self._purge()
+            entry = self._entries.get(url)
+            if entry is None:
+                return None
+            self._entries.move_to_end(url)
+            self.hits += 1
+            return bytes(entry[1])
+
+    def add(self, url, content, generation):
+        """
+        Caches a secret, unless the cache was invalidated since the read
+        which returned it started.
+
+        :param url: The key URL
+        :type url: str
+        :param content: The secret as read from Custodia
+        :type content: bytes
+        :param generation: The generation when the read started
+        :type generation: int
+        """
+        with self._lock:
+            self._purge()
+            if generation != self.generation:
+                return
+            self._evict(url)
+            self._entries[url] = (
+                time.monotonic() + self._ttl, bytearray(content))
+            while len(self._entries) > self._size:
+                self._evict(next(iter(self._entries)))
+
+    def discard(self, url):
+        """
+        Invalidates a cached secret, such as when it is saved or deleted.
+
+        :param url: The key URL
+        :type url: str
+        """
+        with self._lock:
+            self.generation += 1
+            self._evict(url)
+
+    def clear(self):
+        """
+        Evicts all cached secrets.
+        """
+        with self._lock:
+            self.generation += 1
+            for url in list(self._entries):
+                self._evict(url)
+
+    def _evict(self, url):
+        """
+        Removes a secret and zeroes its bytes.  Called with the lock held.
+
+        :param url: The key URL
+        :type url: str
+        """
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            data = entry[1]
+            data[:] = bytes(len(data))
+
+    def _purge(self):
+        """
+        Evicts expired secrets.  Called with the lock held.
+        """
+        now = time.monotonic()
+        for url in [k for k, (expires, _) in self._entries.items()
+                    if expires <= now]:
+            self._evict(url)
+
+
+class CustodiaStoreHandler(BulkStoreHandler, StoreHandlerBase):
     """
     Handler for securely storing secrets via a local Custodia service.
+
+    The handler may be used from several threads at once.  Each thread
+    has its own requests.Session, and all of them share a pool of at most
+    "pool_size" persistent connections (10 by default); with "keep_alive"
+    set to false, a new connection is made for every request.
+
+    Requests time out after "timeout" seconds, either one number or a
+    [connect, read] pair, which "timeouts" may override by operation:
+    "get", "save" or "delete".  Requests failing to connect or timing out
+    are retried up to "retries" times (2 by default), after a random
+    delay of up to "retry_backoff" seconds (0.1 by default) doubled for
+    each retry.
+
+    Bulk gets and saves are spread over "bulk_connections" persistent
+    connections (4 by default), one request per model at a time on each.
+
+    Secrets read are cached for "cache_ttl" seconds, at most "cache_size"
+    of them (64 by default), if "cache_ttl" is set.  Caching is off by
+    default, since it keeps secrets in this process's memory.
     """
 
     # Connection should be nearly instantaneous.
     CUSTODIA_TIMEOUT = (1.0, 5.0)  # seconds
 
+    #: Operations which may be given their own timeout.
+    OPERATIONS = ('get', 'save', 'delete')
+
     @classmethod
     def check_config(cls, config):
         """
-        This store handler has no configuration checks.
+        Examines the configuration parameters for a CustodiaStoreHandler
+        and throws a ConfigurationError if any parameters are invalid.
+
+        :param config: Configuration parameters
+        :type config: dict
+        :raises: commissaire.util.config.ConfigurationError
+        """
+        for key in ('pool_size', 'retries', 'bulk_connections',
+                    'cache_size'):
+            value = config.get(key, 0)
+            if not isinstance(value, int) or value < 0:
+                raise ConfigurationError(
+                    'Custodia "{}" must be a positive integer: {}'.format(
+                        key, value))
+        for key in ('retry_backoff', 'cache_ttl'):
+            value = config.get(key, 0)
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ConfigurationError(
+                    'Custodia "{}" must be a positive number: {}'.format(
+                        key, value))
+        timeouts = config.get('timeouts', {})
+        if not isinstance(timeouts, dict):
+            raise ConfigurationError(
+                'Custodia "timeouts" must be a JSON object: {}'.format(
+                    timeouts))
+        unknown = set(timeouts) - set(cls.OPERATIONS)
+        if unknown:
+            raise ConfigurationError(
+                'Unknown Custodia operations in "timeouts": {}'.format(
+                    ', '.join(sorted(unknown))))
+        for timeout in [config.get('timeout')] + list(timeouts.values()):
+            cls._parse_timeout(timeout)
+
+    @classmethod
+    def _parse_timeout(cls, timeout):
+        """
+        Converts a configured timeout to a requests timeout.
+
+        :param timeout: Seconds, [connect, read] seconds, or None
+        :type timeout: int, float, list or None
+        :returns: A requests timeout
+        :rtype: float or tuple
+        :raises: commissaire.util.config.ConfigurationError
         """
-        pass
+        if timeout is None:
+            return cls.CUSTODIA_TIMEOUT
+        if isinstance(timeout, (int, float)) and timeout > 0:
+            return timeout
+        if (isinstance(timeout, (list, tuple)) and len(timeout) == 2 and
+                all(isinstance(x, (int, float)) and x > 0
+                    for x in timeout)):
+            return tuple(timeout)
+        raise ConfigurationError(
+            'Custodia timeouts must be a number of seconds or a '
+            '[connect, read] pair: {}'.format(timeout))
 
     def __init__(self, config):
         """
         Creates a new instance of CustodiaStoreHandler.
-        :param config: Not applicable to this handler
-        :type config: None
+
+        :param config: Configuration parameters
+        :type config: dict
         """
         super().__init__(config)
+        self.logger = logging.getLogger('CustodiaStoreHandler')
 
-        self.session = requests.Session()
-        self.session.headers['REMOTE_USER'] = 'commissaire'
-        self.session.mount(HTTP_SOCKET_PREFIX, UnixAdapter())
         socket_path = config.get('socket_path', DEFAULT_SOCKET_PATH)
         self.socket_url = HTTP_SOCKET_PREFIX + quote(socket_path, safe='')
 
+        pool_size = max(1, config.get('pool_size', 10))
+        self._adapter = PooledUnixAdapter(pool_size)
+        self._keep_alive = config.get('keep_alive', True)
+        self._local = threading.local()
+
+        timeout = self._parse_timeout(config.get('timeout'))
+        self._timeouts = {op: timeout for op in self.OPERATIONS}
+        for op, timeout in config.get('timeouts', {}).items():
+            self._timeouts[op] = self._parse_timeout(timeout)
+        self._retries = config.get('retries', 2)
+        self._retry_backoff = config.get('retry_backoff', 0.1)
+
+        # URLs of key containers known to exist, so saves need not try
+        # to create them again.  Set operations are atomic, so no lock is
+        # needed to share this between threads.
+        self._known_containers = set()
+
+        # Thread pool for bulk requests, created on first use.
+        self._bulk_connections = min(
+            int(config.get('bulk_connections', 4)), pool_size)
+        self._bulk_executor = None
+        self._bulk_lock = threading.Lock()
+
+        self._cache = SecretCache(
+            config.get('cache_ttl', 0), int(config.get('cache_size', 64)))
+
+    def _session(self):
+        """
+        Returns the calling thread's session, creating it if needed.
+
+        :rtype: requests.Session
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.headers['REMOTE_USER'] = 'commissaire'
+            if not self._keep_alive:
+                session.headers['Connection'] = 'close'
+            session.mount(HTTP_SOCKET_PREFIX, self._adapter)
+            self._local.session = session
+        return session
+
+    def _request(self, op, method, url, **kwargs):
+        """
+        Makes a request to Custodia with the operation's timeout, retrying
+        if it fails to connect or times out.
+
+        :param op: The operation: "get", "save" or "delete"
+        :type op: str
+        :param method: The HTTP method
+        :type method: str
+        :param url: The URL to request
+        :type url: str
+        :param kwargs: Other arguments for requests.Session.request()
+        :type kwargs: dict
+        :returns: The response
+        :rtype: requests.Response
+        :raises requests.RequestException: if the last attempt fails
+        """
+        attempt = 0
+        while True:
+            try:
+                return self._session().request(
+                    method, url, timeout=self._timeouts[op], **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as error:
+                if attempt >= self._retries:
+                    raise
+                # Full jitter keeps retrying threads from moving in step.
+                delay = random.uniform(
+                    0, self._retry_backoff * 2 ** attempt)
+                attempt += 1
+                self.logger.debug(
+                    'Retrying {} {} in {:.3f}s: {}: {}'.format(
+                        method, url, delay, type(error), error))
+                time.sleep(delay)
+
     def _build_key_container_url(self, model_instance):
         """
         Builds a Custodia key container URL for the given SecretModel.
@@ -93,23 +458,9 @@ class CustodiaStoreHandler(StoreHandlerBase):
         :rtype: commissaire.model.SecretModel
         :raises requests.HTTPError: if the request fails
         """
-        # Create a key container for the model.  If it already exists,
-        # catch the failure and move on.  This operation should really
-        # be idempotent, but Custodia returns a 409 Conflict.
-        # (see https://github.com/latchset/custodia/issues/206)
-        try:
-            url = self._build_key_container_url(model_instance)
-
-            response = self.session.request(
-                'POST', url, timeout=self.CUSTODIA_TIMEOUT)
-            response.raise_for_status()
-        except requests.HTTPError as error:
-            # XXX bool(response) defers to response.ok, which is a misfeature.
-            #     Have to explicitly test "if response is None" to know if the
-            #     object is there.
-            have_response = response is not None
-            if not (have_response and error.response.status_code == 409):
-                raise error
+        container_url = self._build_key_container_url(model_instance)
+        if container_url not in self._known_containers:
+            self._create_key_container(container_url)
 
         data = model_instance.to_json()
         headers = {
@@ -118,13 +469,48 @@ class CustodiaStoreHandler(StoreHandlerBase):
         }
         url = self._build_key_url(model_instance)
 
-        response = self.session.request(
-            'PUT', url, headers=headers, data=data,
-            timeout=self.CUSTODIA_TIMEOUT)
+        # Invalidate the cached secret again once written, so reads made
+        # while writing are not cached.
+        self._cache.discard(url)
+        try:
+            response = self._request(
+                'save', 'PUT', url, headers=headers, data=data)
+            if response.status_code == 404:
+                # The key container was removed behind our back.
+                self._known_containers.discard(container_url)
+                self._create_key_container(container_url)
+                response = self._request(
+                    'save', 'PUT', url, headers=headers, data=data)
+        finally:
+            self._cache.discard(url)
         response.raise_for_status()
 
         return model_instance
 
+    def _create_key_container(self, container_url):
+        """
+        Creates a Custodia key container, and remembers that it exists.
+
+        :param container_url: The key container URL
+        :type container_url: str
+        :raises requests.HTTPError: if the request fails
+        """
+        # If the key container already exists, catch the failure and
+        # move on.  This operation should really be idempotent, but
+        # Custodia returns a 409 Conflict.
+        # (see https://github.com/latchset/custodia/issues/206)
+        try:
+            response = self._request('save', 'POST', container_url)
+            response.raise_for_status()
+        except requests.HTTPError as error:
+            # XXX bool(response) defers to response.ok, which is a misfeature.
+            #     Have to explicitly test "if response is None" to know if the
+            #     object is there.
+            have_response = response is not None
+            if not (have_response and error.response.status_code == 409):
+                raise error
+        self._known_containers.add(container_url)
+
     def _get(self, model_instance):
         """
         Retrieves a serialized SecretModel string from Custodia and constructs
@@ -142,12 +528,18 @@ class CustodiaStoreHandler(StoreHandlerBase):
         }
         url = self._build_key_url(model_instance)
 
+        if self._cache.enabled:
+            content = self._cache.get(url)
+            if content is not None:
+                return model_instance.new(**json.loads(content.decode()))
+        generation = self._cache.generation
+
         try:
-            response = self.session.request(
-                'GET', url, headers=headers,
-                timeout=self.CUSTODIA_TIMEOUT)
+            response = self._request('get', 'GET', url, headers=headers)
             response.raise_for_status()
 
+            if self._cache.enabled:
+                self._cache.add(url, response.content, generation)
             return model_instance.new(**response.json())
         except requests.HTTPError as error:
             # XXX bool(response) defers to response.ok, which is a misfeature.
@@ -170,9 +562,9 @@ class CustodiaStoreHandler(StoreHandlerBase):
         """
         url = self._build_key_url(model_instance)
 
+        self._cache.discard(url)
         try:
-            response = self.session.request(
-                'DELETE', url, timeout=self.CUSTODIA_TIMEOUT)
+            response = self._request('delete', 'DELETE', url)
             response.raise_for_status()
         except requests.HTTPError as error:
             # XXX bool(response) defers to response.ok, which is a misfeature.
@@ -183,3 +575,55 @@ class CustodiaStoreHandler(StoreHandlerBase):
                 raise StorageLookupError(str(error), model_instance)
             else:
                 raise error
+        finally:
+            self._cache.discard(url)
+
+    def _get_many(self, model_instances):
+        """
+        Retrieves several serialized SecretModel strings from Custodia,
+        with requests spread over several connections.
+
+        :param model_instances: SecretModel instances to search and get
+        :type model_instances: list
+        :returns: Saved model instances or exceptions, in order
+        :rtype: list
+        """
+        return self._bulk(self._get, model_instances)
+
+    def _save_many(self, model_instances):
+        """
+        Submits several serialized SecretModel strings to Custodia, with
+        requests spread over several connections.
+
+        :param model_instances: SecretModel instances to save
+        :type model_instances: list
+        :returns: Saved model instances or exceptions, in order
+        :rtype: list
+        """
+        return self._bulk(self._save, model_instances)
+
+    def _bulk(self, method, model_instances):
+        """
+        Calls a per-model method for several models on the bulk thread
+        pool.
+
+        :param method: The method to call with each model instance
+        :type method: callable
+        :param model_instances: Model instances to pass
+        :type model_instances: list
+        :returns: Results or exceptions, in order
+        :rtype: list
+        """
+        def call(model_instance):
+            try:
+                return method(model_instance)
+            except Exception as error:
+                return error
+
+        if len(model_instances) < 2 or self._bulk_connections < 2:
+            return [call(x) for x in model_instances]
+        with self._bulk_lock:
+            if self._bulk_executor is None:
+                self._bulk_executor = ThreadPoolExecutor(
+                    self._bulk_connections)
+        return list(self._bulk_executor.map(call, model_instances))
@@ -0,0 +1,167 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Deadline buffering shared by the StorageService's buffers.
+"""
+
+import logging
+import threading
+import time
+
+
+class DeadlineBuffer:
+    """
+    Holds entries for a short window, by model type, and hands each one
+    to _handle() once its deadline passes.
+
+    Each model type has its own window, in seconds; types without one are
+    never buffered.  An entry is handled at most one window after it was
+    added, by a background thread started on first use.  Handling is
+    serialized, so entries are handled in the order they fell due.
+
+    Subclasses implement _handle().
+    """
+
+    #: Name of the background thread and logger.
+    name = 'DeadlineBuffer'
+
+    def __init__(self, windows):
+        """
+        Creates a new DeadlineBuffer.
+
+        :param windows: Seconds to hold entries, by model type name
+        :type windows: dict
+        """
+        self.logger = logging.getLogger(self.name)
+        self._windows = {k: v for k, v in windows.items() if v and v > 0}
+        self._lock = threading.Condition()
+        self._handle_lock = threading.Lock()
+        # { key : [ deadline, value ] }
+        self._pending = {}
+        self._thread = None
+        self._closed = False
+
+    def enabled(self, model_type_name):
+        """
+        Returns whether entries of a model type are buffered.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :rtype: bool
+        """
+        return model_type_name in self._windows and not self._closed
+
+    def close(self):
+        """
+        Stops buffering and handles all pending entries.
+        """
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._handle_entries(None)
+
+    def _entry(self, model_type_name, key, value):
+        """
+        Returns the pending entry for a key, adding one holding value if
+        there is none.  Called with the lock held.
+
+        :param model_type_name: The model type name, for the window
+        :type model_type_name: str
+        :param key: Identifies the entry
+        :type key: hashable
+        :param value: Value of a new entry
+        :type value: object
+        :returns: The [ deadline, value ] entry
+        :rtype: list
+        """
+        entry = self._pending.get(key)
+        if entry is None:
+            deadline = time.monotonic() + self._windows[model_type_name]
+            entry = [deadline, value]
+            self._pending[key] = entry
+            self._lock.notify()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=self.name)
+            self._thread.daemon = True
+            self._thread.start()
+        return entry
+
+    def _handle_entries(self, keys):
+        """
+        Takes pending entries and handles them now.
+
+        :param keys: Keys of the entries to handle, or None for all
+        :type keys: list or None
+        :raises Exception: the first error raised by _handle(), once all
+                           the entries were handled
+        """
+        if not self._pending:
+            return
+        with self._handle_lock:
+            with self._lock:
+                if keys is None:
+                    keys = list(self._pending)
+                entries = [(k, self._pending.pop(k)[1])
+                           for k in keys if k in self._pending]
+            first_error = None
+            for key, value in entries:
+                try:
+                    self._handle(key, value)
+                except Exception as error:
+                    first_error = first_error or error
+            if first_error is not None:
+                raise first_error
+
+    def _handle(self, key, value):
+        """
+        Handles an entry.  Called with the handle lock held.  Errors are
+        raised from flushes and close(), but not from the background
+        thread, so implementations should log them.
+
+        :param key: Identifies the entry
+        :type key: hashable
+        :param value: The entry's value
+        :type value: object
+        """
+        raise NotImplementedError(
+            '{}._handle must be overridden'.format(type(self).__name__))
+
+    def _run(self):
+        """
+        Handles pending entries as their deadlines pass.
+        """
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                now = time.monotonic()
+                due = [k for k, (deadline, _) in self._pending.items()
+                       if deadline <= now]
+            if due:
+                try:
+                    self._handle_entries(due)
+                except Exception:
+                    # _handle() reports its own errors.
+                    pass
+            with self._lock:
+                if self._closed:
+                    return
+                if self._pending:
+                    timeout = max(0, min(
+                        deadline for deadline, _ in self._pending.values()
+                    ) - time.monotonic())
+                else:
+                    timeout = None
+                self._lock.wait(timeout)
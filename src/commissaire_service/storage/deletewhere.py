@@ -0,0 +1,125 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Bulk deletes by attribute values for the StorageService.
+"""
+
+import contextlib
+
+from commissaire.bus import StorageLookupError
+
+from .base import RangeDeleteStoreHandler
+
+
+class DeleteWhereMixin:
+    """
+    Handles the "storage.delete_where" routing key of the StorageService.
+    """
+
+    def on_delete_where(self, message, model_type_name, where=None,
+                        prefix=None):
+        """
+        Handler for the "storage.delete_where" routing key.
+
+        Deletes every model of the given type whose attributes equal those
+        in "where" and whose primary key starts with "prefix".  At least
+        one of them must be given.  Store handlers which are
+        RangeDeleteStoreHandlers delete by prefix in one store operation;
+        otherwise the matching models are listed and deleted one at a time.
+
+        Subscribers are sent one notification per deleted model, as for
+        "storage.delete".  For model types with a "notify_batch_ms"
+        window, the deletions are published right away as one batch.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param model_type_name: Model type to delete from
+        :type model_type_name: str
+        :param where: Attribute values models must have to be deleted
+        :type where: dict or None
+        :param prefix: Primary key prefix of models to delete
+        :type prefix: str or None
+        :returns: the number of models deleted
+        :rtype: int
+        """
+        if not where and prefix is None:
+            raise ValueError('No "where" or "prefix" to delete by')
+        model_type = self._model_types[model_type_name]
+        for name in where or {}:
+            if name not in model_type._attribute_map:
+                raise ValueError('{} has no attribute "{}"'.format(
+                    model_type_name, name))
+        list_type = self._list_model_type(model_type)
+        if list_type is None:
+            raise ValueError('{} models can not be listed'.format(
+                model_type_name))
+        list_instance = list_type.new()
+        handlers = self._list_handlers(list_instance)
+        # Pending saves are written first so they are deleted too.
+        self._write_behind.flush()
+
+        with contextlib.ExitStack() as stack:
+            collected = []
+            if self._notify_batcher.enabled(model_type_name):
+                collected = [
+                    stack.enter_context(handler.notify.collecting())
+                    for handler in handlers]
+            if (not where and len(handlers) == 1 and
+                    isinstance(handlers[0], RangeDeleteStoreHandler) and
+                    not self._journaled(model_type.new())):
+                handler = handlers[0]
+                with self._time_op(handler, list_instance, 'delete_where'):
+                    deleted = handler._delete_prefix(list_instance, prefix)
+                for model_instance in deleted:
+                    self._validation.forget(model_instance)
+                    self._discard_cached(model_instance)
+                count = len(deleted)
+            else:
+                count = self._delete_matching(
+                    list_instance, where or {}, prefix or '')
+
+        self._notify_batcher.publish(
+            model_type_name, [x for notifications in collected
+                              for x in notifications])
+        return count
+
+    def _delete_matching(self, list_instance, where, prefix):
+        """
+        Implements on_delete_where() by listing models and deleting those
+        which match one at a time.
+
+        :param list_instance: List model instance of the type to delete
+        :type list_instance: commissaire.model.ListModel
+        :param where: Attribute values models must have to be deleted
+        :type where: dict
+        :param prefix: Primary key prefix of models to delete
+        :type prefix: str
+        :returns: the number of models deleted
+        :rtype: int
+        """
+        count = 0
+        for model_instance in self._list_models(list_instance):
+            if not str(model_instance.primary_key).startswith(prefix):
+                continue
+            if any(getattr(model_instance, k) != v
+                   for k, v in where.items()):
+                continue
+            try:
+                self._delete_model(model_instance)
+                count += 1
+            except StorageLookupError:
+                # Deleted by someone else in the meantime.
+                pass
+        return count
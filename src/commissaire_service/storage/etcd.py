@@ -0,0 +1,331 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Etcd based StoreHandler with native revision and TTL support.
+
+Register it in storage.conf with:
+
+    {"type": "commissaire_service.storage.etcd", ...}
+
+Gets are hedged to other etcd cluster members when they are listed as
+"endpoints" (see EtcdStoreHandler).
+"""
+
+import json
+
+from urllib.parse import urlparse
+
+import etcd
+
+from commissaire.bus import StorageLookupError
+from commissaire.storage import etcd as base_etcd
+from commissaire.util.config import ConfigurationError
+
+from commissaire_service.storage.base import (
+    AggregateStoreHandler, ExpiringStoreHandler, RevisionedStoreHandler,
+    StorageConflictError, group_counts)
+from commissaire_service.storage.hedge import HedgedReader
+
+
+class EtcdStoreHandler(RevisionedStoreHandler, ExpiringStoreHandler,
+                       AggregateStoreHandler, base_etcd.EtcdStoreHandler):
+    """
+    Etcd store handler which exposes etcd's modifiedIndex as the model
+    revision, enforces expected revisions with prevIndex writes, and
+    expires models with etcd key TTLs.
+
+    Counts and groups are made from one read of the model type's etcd
+    directory without building models, since the etcd v2 API has no
+    server-side aggregation.
+
+    With the server URLs of other etcd cluster members listed as
+    "endpoints", gets are hedged: a get from "server_url" slower than the
+    "hedge_percentile" (default 95) of recent gets, and at least
+    "hedge_min_ms" milliseconds (default 5), is also sent to one of the
+    other members and the first answer wins.  At most "hedge_budget"
+    (default 0.05) of gets are hedged.  Members may lag behind, so a
+    hedged answer from a member which has not yet applied this handler's
+    last save is ignored.  Everything else goes to "server_url" only.
+    """
+
+    @classmethod
+    def check_config(cls, config):
+        """
+        Examines the configuration parameters for an EtcdStoreHandler
+        and throws a ConfigurationError if any parameters are invalid.
+
+        :param config: Configuration parameters
+        :type config: dict
+        :raises: commissaire.util.config.ConfigurationError
+        """
+        super().check_config(config)
+        endpoints = config.get('endpoints', [])
+        if (not isinstance(endpoints, list) or
+                not all(isinstance(x, str) for x in endpoints)):
+            raise ConfigurationError(
+                'Etcd "endpoints" must be a list of server URLs: {}'.format(
+                    endpoints))
+        percentile = config.get('hedge_percentile', 95)
+        if not isinstance(percentile, (int, float)) or not (
+                0 < percentile < 100):
+            raise ConfigurationError(
+                'Etcd "hedge_percentile" must be between 0 and 100: '
+                '{}'.format(percentile))
+        budget = config.get('hedge_budget', 0.05)
+        if not isinstance(budget, (int, float)) or not 0 <= budget <= 1:
+            raise ConfigurationError(
+                'Etcd "hedge_budget" must be between 0 and 1: {}'.format(
+                    budget))
+
+    def __init__(self, config):
+        """
+        Creates a new instance of EtcdStoreHandler.
+
+        :param config: Configuration parameters
+        :type config: dict
+        """
+        super().__init__(config)
+        # Highest etcd index saved through this handler.
+        self._written_index = 0
+        self._hedge = None
+        server_url = config.get('server_url', '').rstrip('/')
+        endpoints = [x for x in config.get('endpoints', [])
+                     if x.rstrip('/') != server_url]
+        if endpoints:
+            min_ms = config.get('hedge_min_ms')
+            self._hedge = HedgedReader(
+                [self._endpoint_client(config, x) for x in endpoints],
+                config.get('hedge_percentile'),
+                config.get('hedge_budget'),
+                None if min_ms is None else min_ms / 1000.0)
+
+    @staticmethod
+    def _endpoint_client(config, server_url):
+        """
+        Creates an etcd client for one cluster member, with the handler's
+        certificates.
+
+        :param config: Configuration parameters
+        :type config: dict
+        :param server_url: Server URL of the cluster member
+        :type server_url: str
+        :returns: An etcd client
+        :rtype: etcd.Client
+        """
+        parsed = urlparse(server_url)
+        client_kwargs = {
+            'host': parsed.hostname,
+            'port': parsed.port or 2379,
+            'protocol': parsed.scheme or 'http',
+        }
+        if 'certificate_path' in config:
+            client_kwargs['cert'] = (
+                config['certificate_path'], config['certificate_key_path'])
+        if 'certificate_ca_path' in config:
+            client_kwargs['ca_cert'] = config['certificate_ca_path']
+        return etcd.Client(**client_kwargs)
+
+    def hedge_stats(self):
+        """
+        Returns hedged get counters (see HedgedReader.stats()).
+
+        :returns: counters, or None if gets are not hedged
+        :rtype: dict or None
+        """
+        if self._hedge is None:
+            return None
+        return self._hedge.stats()
+
+    def _model_key(self, model_instance):
+        """
+        Builds the etcd key for the given model.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.models.Model
+        :returns: An etcd key
+        :rtype: str
+        """
+        return model_instance._key.format(model_instance.primary_key)
+
+    def _directory_values(self, model_instance):
+        """
+        Reads the stored JSON of all models of a list model's type.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :returns: The JSON values of the model keys
+        :rtype: list
+        """
+        try:
+            etcd_resp = self._store.read(model_instance._key)
+        except etcd.EtcdKeyNotFound:
+            return []
+        # An empty directory lists itself as its only leaf.
+        return [x.value for x in etcd_resp.leaves if not x.dir and x.value]
+
+    def _count(self, model_instance):
+        """
+        Counts the models of a list model's type.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :returns: The number of models
+        :rtype: int
+        """
+        return len(self._directory_values(model_instance))
+
+    def _aggregate(self, model_instance, fields):
+        """
+        Counts the models of a list model's type by distinct values of
+        the given fields, from their stored JSON.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param fields: Model attribute names to group by
+        :type fields: [str, ...]
+        :returns: [ [ [ value, ... ], count ], ... ]
+        :rtype: list
+        """
+        return group_counts(
+            [data.get(name) for name in fields]
+            for data in (json.loads(x)
+                         for x in self._directory_values(model_instance)))
+
+    def _get_with_revision(self, model_instance):
+        """
+        Retrieves a model and its modifiedIndex in a single etcd read.
+
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.models.Model
+        :returns: The stored model instance and its revision
+        :rtype: tuple
+        :raises StorageLookupError: if the key does not exist
+        """
+        key = self._model_key(model_instance)
+        written_index = self._written_index
+
+        def read(client):
+            etcd_resp = client.read(key)
+            if client is not self._store and (
+                    etcd_resp.etcd_index < written_index):
+                raise etcd.EtcdException(
+                    'Member is behind etcd index {}'.format(written_index))
+            return etcd_resp
+
+        try:
+            if self._hedge is None:
+                etcd_resp = self._store.read(key)
+            else:
+                etcd_resp = self._hedge.read(read, self._store)
+        except etcd.EtcdKeyNotFound as error:
+            raise StorageLookupError(str(error), model_instance)
+        model = model_instance.new(**json.loads(etcd_resp.value))
+        return model, str(etcd_resp.modifiedIndex)
+
+    def _get(self, model_instance):
+        """
+        Retrieves a model.
+
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.models.Model
+        :returns: The stored model instance
+        :rtype: commissaire.models.Model
+        :raises StorageLookupError: if the key does not exist
+        """
+        return self._get_with_revision(model_instance)[0]
+
+    def _save(self, model_instance):
+        """
+        Writes a model.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        """
+        return self._write(model_instance)
+
+    def _save_if_revision(self, model_instance, revision):
+        """
+        Writes a model, with prevIndex set to the expected revision if one
+        is given, so etcd rejects the write if anyone else modified the key
+        in between.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param revision: The expected current revision
+        :type revision: str or None
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        :raises StorageConflictError: if the revision does not match
+        """
+        return self._write(model_instance, revision=revision)
+
+    def _save_with_ttl(self, model_instance, ttl):
+        """
+        Writes a model with an etcd TTL, after which etcd deletes it.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param ttl: Seconds until the model is deleted
+        :type ttl: int
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        """
+        return self._write(model_instance, ttl=ttl)
+
+    def _write(self, model_instance, revision=None, ttl=None):
+        """
+        Writes a model and sends the matching notification.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param revision: The expected current revision
+        :type revision: str or None
+        :param ttl: Seconds until the model is deleted
+        :type ttl: int or None
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        :raises StorageConflictError: if the revision does not match
+        """
+        write_kwargs = {}
+        if ttl is not None:
+            write_kwargs['ttl'] = ttl
+        if revision is not None:
+            try:
+                write_kwargs['prevIndex'] = int(revision)
+            except (TypeError, ValueError):
+                raise StorageConflictError(
+                    'Invalid etcd revision: {}'.format(revision),
+                    model_instance, revision)
+        try:
+            etcd_resp = self._store.write(
+                self._model_key(model_instance),
+                model_instance.to_json(),
+                **write_kwargs)
+        except (etcd.EtcdCompareFailed, etcd.EtcdKeyNotFound) as error:
+            raise StorageConflictError(
+                str(error), model_instance, revision)
+        model_instance._revision = str(etcd_resp.modifiedIndex)
+        self._written_index = max(
+            self._written_index, etcd_resp.modifiedIndex)
+        if getattr(etcd_resp, 'newKey', False):
+            self.notify.created(model_instance)
+        else:
+            self.notify.updated(model_instance)
+        return model_instance
+
+
+PluginClass = EtcdStoreHandler
@@ -0,0 +1,213 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Hedged reads across the endpoints of a replicated store.
+"""
+
+import collections
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .journal import is_outage_error
+
+
+class HedgedReader:
+    """
+    Reads from a primary endpoint.  If a read has not answered within the
+    hedge delay, it is also sent to one of the hedge endpoints, taking
+    turns, and the first answer wins.  Hedge endpoints may lag behind the
+    primary, so an error from a hedge is never the answer, and neither is
+    an outage error from the primary while the hedge is pending.
+
+    The hedge delay is a percentile of recent read latencies, so only the
+    slowest reads are hedged.  A budget caps hedges at a fraction of all
+    reads: each read earns that fraction of a hedge, up to a small burst,
+    and each hedge spends one.
+    """
+
+    #: Default percentile of read latencies to hedge after.
+    DEFAULT_PERCENTILE = 95
+
+    #: Default fraction of reads which may be hedged.
+    DEFAULT_BUDGET = 0.05
+
+    #: Default least hedge delay, in seconds.
+    DEFAULT_MIN_DELAY = 0.005
+
+    #: Number of recent read latencies the delay is derived from.
+    WINDOW = 1000
+
+    #: Reads between recomputing the hedge delay.
+    RECOMPUTE_EVERY = 50
+
+    #: Most unspent hedges kept in the budget.
+    MAX_BURST = 10
+
+    #: Most threads running primary and hedged reads.
+    MAX_WORKERS = 32
+
+    def __init__(self, hedges, percentile=None, budget=None,
+                 min_delay=None):
+        """
+        Creates a new HedgedReader.
+
+        :param hedges: Hedge endpoint clients, passed to read functions
+        :type hedges: list
+        :param percentile: Percentile of read latencies to hedge after
+        :type percentile: int or float or None
+        :param budget: Fraction of reads which may be hedged
+        :type budget: float or None
+        :param min_delay: Least hedge delay, in seconds
+        :type min_delay: float or None
+        """
+        if percentile is None:
+            percentile = self.DEFAULT_PERCENTILE
+        if budget is None:
+            budget = self.DEFAULT_BUDGET
+        if min_delay is None:
+            min_delay = self.DEFAULT_MIN_DELAY
+        self._hedges = list(hedges)
+        self._percentile = percentile
+        self._budget = budget
+        self._min_delay = min_delay
+        self._lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=self.WINDOW)
+        self._recorded = 0
+        self._delay = None
+        self._tokens = 0.0
+        self._next = 0
+        self._executor = ThreadPoolExecutor(self.MAX_WORKERS)
+        #: Number of reads.
+        self.reads = 0
+        #: Number of reads hedged.
+        self.hedged = 0
+        #: Number of hedged reads answered by the hedge.
+        self.hedge_wins = 0
+        #: Number of hedges the budget did not allow.
+        self.denied = 0
+
+    @property
+    def delay(self):
+        """
+        The current hedge delay in seconds, or None while there are too
+        few latencies to derive it from.
+        """
+        return self._delay
+
+    def read(self, function, primary):
+        """
+        Reads from the primary endpoint, hedging if it is slow.
+
+        :param function: Called with an endpoint client to read from it
+        :type function: callable
+        :param primary: The primary endpoint client
+        :type primary: object
+        :returns: The result of the first answer
+        :raises: The error of the primary read
+        """
+        with self._lock:
+            self.reads += 1
+            self._tokens = min(self._tokens + self._budget, self.MAX_BURST)
+            delay = self._delay
+        if delay is None or not self._hedges:
+            return self._timed(function, primary)
+
+        primary = self._executor.submit(self._timed, function, primary)
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._spend():
+            return primary.result()
+
+        with self._lock:
+            endpoint = self._hedges[self._next]
+            self._next = (self._next + 1) % len(self._hedges)
+        hedge = self._executor.submit(function, endpoint)
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            answers = [x for x in done if x.exception() is None or (
+                x is primary and not is_outage_error(x.exception()))]
+            if answers or not pending:
+                future = answers[0] if answers else primary
+                if future is hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                return future.result()
+
+    def _spend(self):
+        """
+        Spends one hedge from the budget.
+
+        :returns: Whether the budget allowed the hedge
+        :rtype: bool
+        """
+        with self._lock:
+            if self._tokens < 1.0:
+                self.denied += 1
+                return False
+            self._tokens -= 1.0
+            self.hedged += 1
+            return True
+
+    def _timed(self, function, endpoint):
+        """
+        Reads from an endpoint and records the latency of the read.
+
+        :param function: Called with the endpoint client
+        :type function: callable
+        :param endpoint: The endpoint client
+        :type endpoint: object
+        :returns: The result of the read
+        """
+        start = time.monotonic()
+        try:
+            return function(endpoint)
+        finally:
+            self._record(time.monotonic() - start)
+
+    def _record(self, seconds):
+        """
+        Records a read latency, recomputing the hedge delay from time to
+        time.
+
+        :param seconds: The latency of a read
+        :type seconds: float
+        """
+        with self._lock:
+            self._latencies.append(seconds)
+            self._recorded += 1
+            if self._recorded % self.RECOMPUTE_EVERY:
+                return
+            latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * self._percentile / 100.0),
+                    len(latencies) - 1)
+        self._delay = max(latencies[index], self._min_delay)
+
+    def stats(self):
+        """
+        Returns hedging counters.
+
+        :returns: reads, hedged, hedge_wins, denied and delay_seconds
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'reads': self.reads,
+                'hedged': self.hedged,
+                'hedge_wins': self.hedge_wins,
+                'denied': self.denied,
+                'delay_seconds': self._delay,
+            }
@@ -0,0 +1,498 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Local write journal for the StorageService.
+"""
+
+import fcntl
+import fnmatch
+import json
+import logging
+import os
+import threading
+import time
+
+import commissaire.models as models
+
+from commissaire.bus import StorageLookupError
+from commissaire.util.config import ConfigurationError
+
+from .base import list_type_name
+
+
+#: Journal operation saving a model.
+JOURNAL_SAVE = 'save'
+
+#: Journal operation deleting a model.
+JOURNAL_DELETE = 'delete'
+
+#: Maximum number of journal files sharing a configured path.
+MAX_JOURNAL_FILES = 100
+
+
+def is_outage_error(error):
+    """
+    Returns whether an error means the store could not be reached, as
+    opposed to the store rejecting the operation.
+
+    :param error: An exception raised by a store handler
+    :type error: Exception
+    :rtype: bool
+    """
+    if isinstance(error, OSError):
+        return True
+    # Client libraries have their own connection and timeout errors,
+    # such as etcd.EtcdConnectionFailed.
+    return any('Connection' in cls.__name__ or 'Timeout' in cls.__name__
+               for cls in type(error).__mro__)
+
+
+class _Entry:
+    """
+    A journaled operation.
+    """
+
+    __slots__ = ('op', 'model_instance')
+
+    def __init__(self, op, model_instance):
+        self.op = op
+        self.model_instance = model_instance
+
+    @property
+    def key(self):
+        return (type(self.model_instance).__name__,
+                self.model_instance.primary_key)
+
+    def to_json(self):
+        return json.dumps({
+            'op': self.op,
+            'model_type': type(self.model_instance).__name__,
+            'model': self.model_instance.to_dict(),
+        })
+
+
+class WriteJournal:
+    """
+    An append-only file of saves and deletes which could not reach their
+    store, replayed in order once it is reachable again.
+
+    Every entry is flushed to disk before append() returns, and the file
+    is loaded again on start, so journaled operations survive a restart.
+    Replayed entries are removed by atomically rewriting the file.
+
+    Each process holds a lock on the file it uses, so processes sharing a
+    configured path use the first free one of "path", "path.1", "path.2"
+    and so on.  A restarted process takes over the journal of a process
+    which has exited.
+
+    While the journal holds entries, the latest journaled operation on
+    each model is what reads should see.
+    """
+
+    def __init__(self, path, model_type_names, max_entries, replay, build):
+        """
+        Creates a new WriteJournal and loads any entries left in the file.
+
+        :param path: Path of the journal file; see above
+        :type path: str
+        :param model_type_names: Model types to journal
+        :type model_type_names: set
+        :param max_entries: Maximum number of entries to hold
+        :type max_entries: int
+        :param replay: Called with the operation and model instance of
+                       each entry to write it to its store
+        :type replay: callable
+        :param build: Called with a model type name and model data to
+                      build model instances from the file
+        :type build: callable
+        """
+        self.logger = logging.getLogger('WriteJournal')
+        self._lock_file = None
+        self._path = self._claim(path)
+        self._model_type_names = set(model_type_names)
+        self._max_entries = max_entries
+        self._replay = replay
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._entries = []
+        # { ( model_type_name, key ) : latest _Entry }
+        self._latest = {}
+        self._file = None
+        #: Number of operations journaled.
+        self.journaled = 0
+        #: Number of entries written to their store.
+        self.replayed = 0
+        #: Number of entries the store rejected on replay.
+        self.dropped = 0
+        #: Number of operations refused because the journal was full.
+        self.refused = 0
+
+        if os.path.exists(self._path):
+            self._load(build)
+        self._file = open(self._path, 'a')
+
+    def _claim(self, path):
+        """
+        Locks the first journal file for path not in use by another
+        process.
+
+        :param path: Configured path of the journal file
+        :type path: str
+        :returns: Path of the journal file to use
+        :rtype: str
+        :raises OSError: if all the journal files are in use
+        """
+        for number in range(MAX_JOURNAL_FILES):
+            candidate = path if not number else '{}.{}'.format(path, number)
+            lock_file = open(candidate + '.lock', 'a')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue
+            self._lock_file = lock_file
+            if number:
+                self.logger.info('Using journal {}'.format(candidate))
+            return candidate
+        raise OSError('All {} journal files for {} are in use'.format(
+            MAX_JOURNAL_FILES, path))
+
+    def _load(self, build):
+        """
+        Loads entries from the journal file.
+
+        :param build: Builds model instances, as given to __init__()
+        :type build: callable
+        """
+        with open(self._path) as journal:
+            for number, line in enumerate(journal, 1):
+                try:
+                    data = json.loads(line)
+                    entry = _Entry(
+                        data['op'], build(data['model_type'], data['model']))
+                except Exception as error:
+                    # A crash can leave a partial last line.
+                    self.logger.warn(
+                        'Skipping journal line {}: {}: {}'.format(
+                            number, type(error), error))
+                    continue
+                self._entries.append(entry)
+                self._latest[entry.key] = entry
+        if self._entries:
+            self.logger.info('Loaded {} journaled operations'.format(
+                len(self._entries)))
+
+    @property
+    def backlog(self):
+        """
+        The number of entries waiting to be replayed.
+        """
+        return len(self._entries)
+
+    def enabled(self, model_type_name):
+        """
+        Returns whether operations on a model type are journaled.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :rtype: bool
+        """
+        return model_type_name in self._model_type_names
+
+    def append(self, op, model_instance):
+        """
+        Journals an operation.
+
+        :param op: JOURNAL_SAVE or JOURNAL_DELETE
+        :type op: str
+        :param model_instance: The model saved or deleted
+        :type model_instance: commissaire.model.Model
+        :returns: Whether the operation was journaled; False if full
+        :rtype: bool
+        """
+        entry = _Entry(op, model_instance)
+        with self._lock:
+            if len(self._entries) >= self._max_entries:
+                self.refused += 1
+                return False
+            self._file.write(entry.to_json() + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._entries.append(entry)
+            self._latest[entry.key] = entry
+            self.journaled += 1
+        return True
+
+    def get(self, model_type_name, key):
+        """
+        Returns the latest journaled operation on a model.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        :returns: The operation and model, or None if there is none
+        :rtype: tuple or None
+        """
+        if not self._entries:
+            return None
+        with self._lock:
+            entry = self._latest.get((model_type_name, key))
+            if entry is None:
+                return None
+            return entry.op, entry.model_instance
+
+    def pending(self, model_type_name):
+        """
+        Returns the latest journaled operation on each model of a type.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :returns: ( op, model_instance ) pairs
+        :rtype: list
+        """
+        if not self._entries:
+            return []
+        with self._lock:
+            return [(entry.op, entry.model_instance)
+                    for key, entry in self._latest.items()
+                    if key[0] == model_type_name]
+
+    def replay(self):
+        """
+        Writes journaled entries to their stores, oldest first, until the
+        journal is empty or a store is still unreachable.  Entries a store
+        rejects are logged and dropped.
+
+        :returns: Number of entries removed from the journal
+        :rtype: int
+        """
+        removed = 0
+        with self._replay_lock:
+            while self._entries:
+                entry = self._entries[0]
+                try:
+                    self._replay(entry.op, entry.model_instance)
+                    self.replayed += 1
+                except Exception as error:
+                    if is_outage_error(error):
+                        break
+                    self.dropped += 1
+                    self.logger.error(
+                        'Dropping journaled {} of {}: {}: {}'.format(
+                            entry.op, entry.model_instance,
+                            type(error), error))
+                with self._lock:
+                    self._entries.pop(0)
+                    if self._latest.get(entry.key) is entry:
+                        del self._latest[entry.key]
+                removed += 1
+            if removed:
+                self._rewrite()
+        return removed
+
+    def _rewrite(self):
+        """
+        Replaces the journal file with the remaining entries.
+        """
+        with self._lock:
+            temporary = self._path + '.tmp'
+            with open(temporary, 'w') as journal:
+                for entry in self._entries:
+                    journal.write(entry.to_json() + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            self._file.close()
+            os.replace(temporary, self._path)
+            self._file = open(self._path, 'a')
+
+    def close(self):
+        """
+        Closes the journal file.  Remaining entries stay in the file.
+        """
+        with self._lock:
+            self._file.close()
+            self._lock_file.close()
+
+    def stats(self):
+        """
+        Returns journal counters.
+
+        :returns: backlog, journaled, replayed, dropped and refused
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'backlog': len(self._entries),
+                'journaled': self.journaled,
+                'replayed': self.replayed,
+                'dropped': self.dropped,
+                'refused': self.refused,
+            }
+
+
+class JournalMixin:
+    """
+    Journals the StorageService's writes while their store is
+    unreachable, and replays them.
+    """
+
+    def _create_journal(self, config):
+        """
+        Creates the write journal from its configuration.
+
+        :param config: The "storage_journal" configuration
+        :type config: dict
+        :returns: The write journal
+        :rtype: WriteJournal
+        :raises: commissaire.util.config.ConfigurationError
+        """
+        if not isinstance(config, dict) or 'path' not in config:
+            raise ConfigurationError(
+                'Storage journal configuration needs a "path": {}'.format(
+                    config))
+        journaled_names = set()
+        configurable_model_names = [
+            k for k, v in self._model_types.items()
+            if not issubclass(v, models.SecretModel)]
+        for pattern in config.get('models', ['*']):
+            matches = fnmatch.filter(configurable_model_names, pattern)
+            if not matches:
+                raise ConfigurationError(
+                    'No match for model: {}'.format(pattern))
+            journaled_names.update(matches)
+        self._journal_retry_seconds = config.get('retry_seconds', 5)
+        return WriteJournal(
+            config['path'], journaled_names,
+            int(config.get('max_entries', 10000)),
+            self._replay_journal_entry, self._build_model)
+
+    def _journal_replayer(self):  # pragma: no cover
+        """
+        Replays the write journal periodically until the service stops.
+        """
+        while not self.should_stop:
+            time.sleep(self._journal_retry_seconds)
+            if self._journal.backlog:
+                replayed = self._journal.replay()
+                if replayed:
+                    self.logger.info(
+                        'Replayed {} journaled operations, {} left'.format(
+                            replayed, self._journal.backlog))
+
+    def _replay_journal_entry(self, op, model_instance):
+        """
+        Writes a journaled operation to its store.
+
+        :param op: JOURNAL_SAVE or JOURNAL_DELETE
+        :type op: str
+        :param model_instance: The model saved or deleted
+        :type model_instance: commissaire.model.Model
+        """
+        handler = self._get_handler(model_instance)
+        if op == JOURNAL_SAVE:
+            self._store_model(handler, model_instance)
+        else:
+            try:
+                self._remove_model(handler, model_instance)
+            except StorageLookupError:
+                pass
+
+    def _journaled(self, model_instance):
+        """
+        Returns whether operations on a model go through the journal.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        :rtype: bool
+        """
+        return (self._journal is not None and
+                self._journal.enabled(type(model_instance).__name__))
+
+    def _journal_operation(self, op, handler, model_instance):
+        """
+        Writes an operation to its store, or journals it if the store can
+        not be reached.  While the journal holds operations, new ones are
+        journaled behind them to keep their order.
+
+        :param op: JOURNAL_SAVE or JOURNAL_DELETE
+        :type op: str
+        :param handler: The store handler for the model
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: The model to save or delete
+        :type model_instance: commissaire.model.Model
+        :returns: The saved model instance
+        :rtype: commissaire.model.Model
+        """
+        write = self._store_model if op == JOURNAL_SAVE else self._remove_model
+        error = None
+        if not self._journal.backlog:
+            try:
+                return write(handler, model_instance)
+            except Exception as ex:
+                if not is_outage_error(ex):
+                    raise
+                error = ex
+        return self._journal_append(op, model_instance, error)
+
+    def _journal_append(self, op, model_instance, error=None):
+        """
+        Journals an operation which did not reach its store.
+
+        :param op: JOURNAL_SAVE or JOURNAL_DELETE
+        :type op: str
+        :param model_instance: The model to save or delete
+        :type model_instance: commissaire.model.Model
+        :param error: The outage error of the store write, if any
+        :type error: Exception or None
+        :returns: The model instance
+        :rtype: commissaire.model.Model
+        :raises: The error, or RuntimeError, if the journal is full
+        """
+        if not self._journal.append(op, model_instance):
+            if error is not None:
+                raise error
+            raise RuntimeError('Storage journal is full ({} entries)'.format(
+                self._journal.backlog))
+        self.logger.debug('< {} {} (journaled)'.format(
+            op.upper(), model_instance))
+        self._discard_cached(model_instance)
+        return model_instance
+
+    def _with_journaled(self, model_instance, items):
+        """
+        Applies journaled saves and deletes which have not reached their
+        store yet to listed models.
+
+        :param model_instance: List model instance of the listed models
+        :type model_instance: commissaire.model.ListModel
+        :param items: The listed models, which are not changed
+        :type items: list
+        :returns: The models as reads should see them
+        :rtype: list
+        """
+        if self._journal is None:
+            return items
+        pending = self._journal.pending(list_type_name(model_instance))
+        if not pending:
+            return items
+        latest = {x.primary_key: (op, x) for op, x in pending}
+        result = []
+        for item in items:
+            op, item = latest.pop(item.primary_key, (JOURNAL_SAVE, item))
+            if op == JOURNAL_SAVE:
+                result.append(item)
+        result.extend(x for op, x in latest.values() if op == JOURNAL_SAVE)
+        return result
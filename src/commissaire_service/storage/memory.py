@@ -0,0 +1,273 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+In-memory StoreHandler, for tests, benchmarks and single-node deployments
+which need not keep data across restarts.
+
+Register it in storage.conf with:
+
+    {"type": "commissaire_service.storage.memory", ...}
+"""
+
+import json
+import threading
+
+from commissaire.bus import StorageLookupError
+from commissaire.storage import StoreHandlerBase
+
+from commissaire_service.storage.base import (
+    AggregateStoreHandler, BulkStoreHandler, RangeDeleteStoreHandler,
+    RevisionedStoreHandler, StorageConflictError, group_counts,
+    list_type_name)
+
+
+class MemoryStoreHandler(RevisionedStoreHandler, BulkStoreHandler,
+                         RangeDeleteStoreHandler, AggregateStoreHandler,
+                         StoreHandlerBase):
+    """
+    Keeps models in this process's memory, as JSON so stored models are
+    never shared with callers.  Every write is given a revision from a
+    counter for the whole store.
+    """
+
+    @classmethod
+    def check_config(cls, config):
+        """
+        This store handler has no configuration checks.
+        """
+        pass
+
+    def __init__(self, config):
+        """
+        Creates a new instance of MemoryStoreHandler.
+
+        :param config: Not applicable to this handler
+        :type config: dict
+        """
+        super().__init__(config)
+        self._lock = threading.Lock()
+        # { model_type_name : { key : ( revision, json ) } }
+        self._models = {}
+        self._last_revision = 0
+
+    def _get(self, model_instance):
+        """
+        Retrieves a model.
+
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.models.Model
+        :returns: The stored model instance
+        :rtype: commissaire.models.Model
+        :raises StorageLookupError: if the model does not exist
+        """
+        return self._get_with_revision(model_instance)[0]
+
+    def _get_with_revision(self, model_instance):
+        """
+        Retrieves a model and its revision.
+
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.models.Model
+        :returns: The stored model instance and its revision
+        :rtype: tuple
+        :raises StorageLookupError: if the model does not exist
+        """
+        table = self._models.get(type(model_instance).__name__, {})
+        with self._lock:
+            entry = table.get(model_instance.primary_key)
+        if entry is None:
+            raise StorageLookupError(
+                'No {} "{}"'.format(
+                    type(model_instance).__name__,
+                    model_instance.primary_key),
+                model_instance)
+        revision, data = entry
+        return model_instance.new(**json.loads(data)), str(revision)
+
+    def _save(self, model_instance):
+        """
+        Saves a model.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        """
+        return self._save_if_revision(model_instance, None)
+
+    def _save_if_revision(self, model_instance, revision):
+        """
+        Saves a model if its stored revision matches, or unconditionally
+        if the revision is None.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param revision: The expected current revision
+        :type revision: str or None
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        :raises StorageConflictError: if the revision does not match
+        """
+        data = model_instance.to_json()
+        key = model_instance.primary_key
+        with self._lock:
+            table = self._models.setdefault(
+                type(model_instance).__name__, {})
+            entry = table.get(key)
+            if revision is not None:
+                actual = None if entry is None else str(entry[0])
+                if actual != revision:
+                    raise StorageConflictError(
+                        'Revision mismatch', model_instance,
+                        revision, actual)
+            self._last_revision += 1
+            table[key] = (self._last_revision, data)
+            model_instance._revision = str(self._last_revision)
+        if entry is None:
+            self.notify.created(model_instance)
+        else:
+            self.notify.updated(model_instance)
+        return model_instance
+
+    def _delete(self, model_instance):
+        """
+        Deletes a model.
+
+        :param model_instance: Model instance to delete
+        :type model_instance: commissaire.models.Model
+        :raises StorageLookupError: if the model does not exist
+        """
+        table = self._models.get(type(model_instance).__name__, {})
+        with self._lock:
+            entry = table.pop(model_instance.primary_key, None)
+        if entry is None:
+            raise StorageLookupError(
+                'No {} "{}"'.format(
+                    type(model_instance).__name__,
+                    model_instance.primary_key),
+                model_instance)
+        self.notify.deleted(model_instance)
+
+    def _delete_prefix(self, model_instance, prefix):
+        """
+        Deletes the models of a list model's type whose primary keys start
+        with a prefix.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param prefix: Primary key prefix; "" deletes all of the type
+        :type prefix: str
+        :returns: The deleted model instances
+        :rtype: list
+        """
+        list_class = model_instance._list_class
+        table = self._models.get(list_type_name(model_instance), {})
+        with self._lock:
+            keys = sorted(k for k in table if str(k).startswith(prefix))
+            entries = [table.pop(k) for k in keys]
+        deleted = [list_class.new(**json.loads(data))
+                   for _, data in entries]
+        for item in deleted:
+            self.notify.deleted(item)
+        return deleted
+
+    def _list(self, model_instance):
+        """
+        Lists all models of a list model's type, ordered by primary key.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :returns: The list model instance holding the models
+        :rtype: commissaire.models.ListModel
+        """
+        list_class = model_instance._list_class
+        table = self._models.get(list_type_name(model_instance), {})
+        with self._lock:
+            entries = sorted(table.items())
+        items = []
+        for _, (revision, data) in entries:
+            item = list_class.new(**json.loads(data))
+            item._revision = str(revision)
+            items.append(item)
+        return model_instance.new(**{model_instance._list_attr: items})
+
+    def _count(self, model_instance):
+        """
+        Counts the models of a list model's type.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :returns: The number of models
+        :rtype: int
+        """
+        return len(self._models.get(list_type_name(model_instance), {}))
+
+    def _aggregate(self, model_instance, fields):
+        """
+        Counts the models of a list model's type by distinct values of
+        the given fields, from their stored JSON.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param fields: Model attribute names to group by
+        :type fields: [str, ...]
+        :returns: [ [ [ value, ... ], count ], ... ]
+        :rtype: list
+        """
+        table = self._models.get(list_type_name(model_instance), {})
+        with self._lock:
+            entries = list(table.values())
+        return group_counts(
+            [data.get(name) for name in fields]
+            for data in (json.loads(x) for _, x in entries))
+
+    def _get_many(self, model_instances):
+        """
+        Retrieves several models.
+
+        :param model_instances: Model instances to search and get
+        :type model_instances: list
+        :returns: Stored model instances or exceptions, in order
+        :rtype: list
+        """
+        results = []
+        for model_instance in model_instances:
+            try:
+                model, revision = self._get_with_revision(model_instance)
+                model._revision = revision
+                results.append(model)
+            except Exception as error:
+                results.append(error)
+        return results
+
+    def _save_many(self, model_instances):
+        """
+        Saves several models.
+
+        :param model_instances: Model instances to save
+        :type model_instances: list
+        :returns: Saved model instances or exceptions, in order
+        :rtype: list
+        """
+        results = []
+        for model_instance in model_instances:
+            try:
+                results.append(self._save(model_instance))
+            except Exception as error:
+                results.append(error)
+        return results
+
+
+PluginClass = MemoryStoreHandler
@@ -0,0 +1,155 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Mixed storage operations in one message for the StorageService.
+"""
+
+
+class MultiMixin:
+    """
+    Handles the "storage.multi" routing key of the StorageService.
+    """
+
+    def on_multi(self, message, operations, stop_on_error=False):
+        """
+        Handler for the "storage.multi" routing key.
+
+        Runs several storage operations, in order, in one bus message.
+        Each operation is a dictionary:
+
+           'op'         : "get", "save", "delete" or "list"
+           'model_type' : Model type name
+           'data'       : Model data, as for the matching routing key
+                          (omitted for "list")
+
+        Any other keys are passed on as keyword arguments, such as
+        'revision' or 'with_revision'.
+
+        Returns one dictionary per operation, holding either a 'result' or
+        an 'error' in JSON-RPC error form.  If stop_on_error is set, no
+        operation after the first failed one is run, and the results end
+        there.
+
+        Consecutive gets, and consecutive unchecked saves when not stopping
+        on errors, are grouped so that BulkStoreHandlers can serve them in
+        one call per handler.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param operations: Operations to run
+        :type operations: [dict, ...]
+        :param stop_on_error: Stop at the first failed operation
+        :type stop_on_error: bool
+        :returns: results of the operations
+        :rtype: [dict, ...]
+        """
+        def batch_op(operation):
+            op = operation.get('op')
+            if isinstance(operation.get('data'), list):
+                return None
+            if op == 'get':
+                return op
+            if (op == 'save' and not stop_on_error and
+                    operation.get('revision') is None):
+                return op
+            return None
+
+        results = []
+        start = 0
+        while start < len(operations):
+            op = batch_op(operations[start])
+            end = start + 1
+            if op is None:
+                batch_results = [
+                    self._multi_operation(message, operations[start])]
+            else:
+                while (end < len(operations) and
+                        batch_op(operations[end]) == op):
+                    end += 1
+                batch_results = self._multi_batch(
+                    op, operations[start:end])
+            for result in batch_results:
+                results.append(result)
+                if stop_on_error and 'error' in result:
+                    return results
+            start = end
+        return results
+
+    def _multi_operation(self, message, operation):
+        """
+        Runs a single "storage.multi" operation.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param operation: The operation to run
+        :type operation: dict
+        :returns: 'result' or 'error' of the operation
+        :rtype: dict
+        """
+        try:
+            op = operation.get('op')
+            if op not in ('get', 'save', 'delete', 'list'):
+                raise ValueError('Unknown storage operation: {}'.format(op))
+            method = getattr(self, 'on_{}'.format(op))
+            kwargs = {k: v for k, v in operation.items()
+                      if k not in ('op', 'model_type', 'data')}
+            args = [operation.get('model_type')]
+            if op != 'list':
+                args.append(operation.get('data'))
+            return {'result': method(message, *args, **kwargs)}
+        except Exception as error:
+            return {'error': self._build_error(error)}
+
+    def _multi_batch(self, op, operations):
+        """
+        Runs a group of "storage.multi" gets or saves through _get_models()
+        or _save_models().  Gets with an 'if_not_revision' are answered as
+        by on_get().
+
+        :param op: "get" or "save"
+        :type op: str
+        :param operations: The operations to run
+        :type operations: [dict, ...]
+        :returns: 'result' or 'error' of each operation
+        :rtype: [dict, ...]
+        """
+        outcomes = [None] * len(operations)
+        built = []
+        for index, operation in enumerate(operations):
+            try:
+                built.append((index, self._build_model(
+                    operation.get('model_type'), operation.get('data'))))
+            except Exception as error:
+                outcomes[index] = error
+
+        model_instances = [model_instance for _, model_instance in built]
+        if op == 'get':
+            batch_outcomes = self._get_models(model_instances)
+        else:
+            batch_outcomes = self._save_models(model_instances)
+        for (index, _), outcome in zip(built, batch_outcomes):
+            outcomes[index] = outcome
+
+        results = []
+        for operation, outcome in zip(operations, outcomes):
+            if isinstance(outcome, Exception):
+                results.append({'error': self._build_error(outcome)})
+            elif op == 'get' and operation.get('if_not_revision') is not None:
+                results.append({'result': self._conditional_reply(
+                    outcome, operation['if_not_revision'])})
+            else:
+                results.append({'result': self._model_reply(
+                    outcome, operation.get('with_revision', False))})
+        return results
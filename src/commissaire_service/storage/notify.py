@@ -0,0 +1,186 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Batched store handler notifications.
+"""
+
+import functools
+
+from .deadline import DeadlineBuffer
+
+
+#: Routing key of notifications, by model type name and event, as
+#: published by commissaire.storage.notify.
+NOTIFY_ROUTING_KEY = 'notify.storage.{}.{}'
+
+#: Message body key holding the notifications of a batch.
+NOTIFY_BATCH_KEY = 'notifications'
+
+
+def notify_body(event_name, model_instance):
+    """
+    Builds the message body of a single notification.
+
+    :param event_name: One of the commissaire.storage.client events
+    :type event_name: str
+    :param model_instance: The created, updated or deleted model
+    :type model_instance: commissaire.model.Model
+    :rtype: dict
+    """
+    return {
+        'event': event_name,
+        'class': type(model_instance).__name__,
+        'model': model_instance.to_dict(),
+    }
+
+
+def unbatch(callback):
+    """
+    Wraps a notification callback, such as a method decorated with
+    commissaire.storage.client.NotifyCallback, so that it receives the
+    notifications of a batch one at a time.  Other messages are passed
+    through unchanged.
+
+    Usage::
+
+        storage.register_callback(
+            unbatch(self._config_notification), models.Host)
+
+    :param callback: Called with a message body and message
+    :type callback: callable
+    :returns: The wrapped callback
+    :rtype: callable
+    """
+    @functools.wraps(callback)
+    def wrapper(body, message):
+        if isinstance(body, dict) and NOTIFY_BATCH_KEY in body:
+            for notification in body[NOTIFY_BATCH_KEY]:
+                callback(notification, message)
+        else:
+            callback(body, message)
+    return wrapper
+
+
+class NotifyBatcher(DeadlineBuffer):
+    """
+    Holds notifications for a short window and publishes those of each
+    model type together.
+
+    Each model type has its own window, in seconds; types without one are
+    never batched.  Within a batch, consecutive notifications of the same
+    event are published as one message on that event's routing key, so
+    subscribers filtering by event still receive them, in order.
+    """
+
+    name = 'NotifyBatcher'
+
+    def __init__(self, windows, publish):
+        """
+        Creates a new NotifyBatcher.
+
+        :param windows: Seconds to hold notifications, by model type name
+        :type windows: dict
+        :param publish: Called with a routing key and message body
+        :type publish: callable
+        """
+        super().__init__(windows)
+        self._publish = publish
+        #: Number of notifications batched.
+        self.notifications = 0
+        #: Number of messages published.
+        self.messages = 0
+        #: Number of messages which failed to publish.
+        self.errors = 0
+
+    def put(self, event_name, model_instance):
+        """
+        Adds a notification to the pending batch of its model type.
+
+        :param event_name: One of the commissaire.storage.client events
+        :type event_name: str
+        :param model_instance: The created, updated or deleted model
+        :type model_instance: commissaire.model.Model
+        """
+        model_type_name = type(model_instance).__name__
+        with self._lock:
+            self.notifications += 1
+            self._entry(model_type_name, model_type_name, [])[1].append(
+                (event_name, model_instance))
+
+    def flush(self):
+        """
+        Publishes all pending notifications now.
+        """
+        self._handle_entries(None)
+
+    def publish(self, model_type_name, notifications):
+        """
+        Publishes notifications now as a batch, whether or not their model
+        type is batched.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param notifications: ( event, model_instance ) pairs, in order
+        :type notifications: list
+        """
+        if not notifications:
+            return
+        with self._handle_lock:
+            with self._lock:
+                self.notifications += len(notifications)
+            self._handle(model_type_name, notifications)
+
+    def stats(self):
+        """
+        Returns batching counters.
+
+        :returns: notifications, messages, errors and pending
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'notifications': self.notifications,
+                'messages': self.messages,
+                'errors': self.errors,
+                'pending': sum(
+                    len(n) for _, n in self._pending.values()),
+            }
+
+    def _handle(self, model_type_name, notifications):
+        """
+        Publishes a batch, one message per run of the same event.  Called
+        with the handle lock held.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param notifications: ( event, model_instance ) pairs, in order
+        :type notifications: list
+        """
+        runs = []
+        for event_name, model_instance in notifications:
+            if not runs or runs[-1][0] != event_name:
+                runs.append((event_name, []))
+            runs[-1][1].append(notify_body(event_name, model_instance))
+        for event_name, bodies in runs:
+            try:
+                self._publish(
+                    NOTIFY_ROUTING_KEY.format(model_type_name, event_name),
+                    {NOTIFY_BATCH_KEY: bodies})
+            except Exception as error:
+                self.errors += 1
+                self.logger.error(
+                    'Unable to publish {} {} notifications: {}: {}'.format(
+                        len(bodies), model_type_name, type(error), error))
+            self.messages += 1
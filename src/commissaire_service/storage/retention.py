@@ -0,0 +1,251 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Retention policies for completed operation records.
+"""
+
+import json
+import math
+import time
+
+from datetime import datetime
+
+import commissaire.models as models
+
+from commissaire import constants as C
+from commissaire.bus import StorageLookupError
+from commissaire.util.config import ConfigurationError
+
+from .base import ExpiringStoreHandler
+
+
+class RetentionPolicy:
+    """
+    Decides which completed records of a model type to remove.
+
+    Records count as completed once their "finished_at" attribute is set.
+    A policy may give:
+
+       'ttl'       : Seconds to keep a record after it finished
+       'keep_last' : Number of most recently finished records to keep
+       'archive'   : Path of a file to append removed records to, one
+                     JSON object per line
+    """
+
+    def __init__(self, model_type, config):
+        """
+        Creates a new RetentionPolicy.
+
+        :param model_type: The model type the policy applies to
+        :type model_type: type
+        :param config: Policy configuration
+        :type config: dict
+        :raises: commissaire.util.config.ConfigurationError
+        """
+        name = model_type.__name__
+        if not isinstance(config, dict):
+            raise ConfigurationError(
+                'Retention policy for {} must be a JSON object: {}'.format(
+                    name, config))
+        unknown = set(config) - set(('ttl', 'keep_last', 'archive'))
+        if unknown:
+            raise ConfigurationError(
+                'Unknown retention policy keys for {}: {}'.format(
+                    name, ', '.join(sorted(unknown))))
+        if 'finished_at' not in getattr(model_type, '_attribute_map', {}):
+            raise ConfigurationError(
+                'Model {} has no "finished_at" to retain by'.format(name))
+        self.model_type = model_type
+        self.ttl = config.get('ttl')
+        self.keep_last = config.get('keep_last')
+        self.archive = config.get('archive')
+        for key in ('ttl', 'keep_last'):
+            value = getattr(self, key)
+            if value is not None and (
+                    not isinstance(value, (int, float)) or value < 0):
+                raise ConfigurationError(
+                    'Retention policy "{}" for {} must be a positive '
+                    'number: {}'.format(key, name, value))
+        if self.ttl is None and self.keep_last is None:
+            raise ConfigurationError(
+                'Retention policy for {} needs "ttl" or "keep_last"'.format(
+                    name))
+
+    @staticmethod
+    def finished_at(model_instance):
+        """
+        Returns when a record finished, or None if it has not.
+
+        :param model_instance: A record
+        :type model_instance: commissaire.models.Model
+        :rtype: datetime.datetime or None
+        """
+        value = getattr(model_instance, 'finished_at', None)
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, C.DATE_FORMAT)
+        except (TypeError, ValueError):
+            return None
+
+    def remaining_ttl(self, model_instance, now):
+        """
+        Returns the seconds left before a record expires under the "ttl"
+        setting, or None if it does not expire.
+
+        :param model_instance: A record
+        :type model_instance: commissaire.models.Model
+        :param now: The current UTC time
+        :type now: datetime.datetime
+        :rtype: int or None
+        """
+        finished = self.finished_at(model_instance)
+        if self.ttl is None or finished is None:
+            return None
+        remaining = self.ttl - (now - finished).total_seconds()
+        # Stores take whole seconds; never let a record expire early.
+        return max(1, int(math.ceil(remaining)))
+
+    def expired(self, model_instances, now):
+        """
+        Returns the records to remove.
+
+        :param model_instances: All records of the model type
+        :type model_instances: list
+        :param now: The current UTC time
+        :type now: datetime.datetime
+        :rtype: list
+        """
+        finished = []
+        for model_instance in model_instances:
+            finished_at = self.finished_at(model_instance)
+            if finished_at is not None:
+                finished.append((finished_at, model_instance))
+        finished.sort(key=lambda item: item[0], reverse=True)
+
+        expired = []
+        for index, (finished_at, model_instance) in enumerate(finished):
+            if self.keep_last is not None and index >= self.keep_last:
+                expired.append(model_instance)
+            elif (self.ttl is not None and
+                    (now - finished_at).total_seconds() > self.ttl):
+                expired.append(model_instance)
+        return expired
+
+    def archive_records(self, model_instances):
+        """
+        Appends records to the archive file, if there is one.
+
+        :param model_instances: Records about to be removed
+        :type model_instances: list
+        """
+        if not self.archive or not model_instances:
+            return
+        with open(self.archive, 'a') as archive:
+            for model_instance in model_instances:
+                archive.write(json.dumps({
+                    'model_type': self.model_type.__name__,
+                    'model': model_instance.to_dict(),
+                }, sort_keys=True) + '\n')
+
+
+class RetentionMixin:
+    """
+    Enforces the retention policies of the StorageService.
+    """
+
+    def _retention_sweeper(self):  # pragma: no cover
+        """
+        Applies retention policies periodically until the service stops.
+        """
+        while not self.should_stop:
+            time.sleep(self._retention_interval)
+            try:
+                self._sweep_retention()
+            except Exception as error:
+                self.logger.error(
+                    'Unable to apply retention policies: {}: {}'.format(
+                        type(error), error))
+
+    def _sweep_retention(self):
+        """
+        Removes, and archives if configured, the records which retention
+        policies no longer keep.
+
+        :returns: Number of records removed
+        :rtype: int
+        """
+        removed = 0
+        now = datetime.utcnow()
+        for name, policy in sorted(self._retention.items()):
+            expired = policy.expired(
+                self._retention_records(policy.model_type), now)
+            if not expired:
+                continue
+            self.logger.info('Removing {} {} record(s) by retention '
+                             'policy'.format(len(expired), name))
+            policy.archive_records(expired)
+            for model_instance in expired:
+                try:
+                    self._delete_model(model_instance)
+                    removed += 1
+                except StorageLookupError:
+                    # Expired natively in the meantime.
+                    pass
+        return removed
+
+    def _retention_records(self, model_type):
+        """
+        Returns all records of a model type subject to retention.  They
+        are listed through the list model type for it if there is one, or
+        else looked up for each Cluster by name.
+
+        :param model_type: A model type
+        :type model_type: type
+        :returns: model instances
+        :rtype: list
+        """
+        list_type = self._list_model_type(model_type)
+        if list_type is not None:
+            return list(self._list_models(list_type.new()))
+
+        records = []
+        for cluster in self._list_models(models.Clusters.new()):
+            try:
+                records.append(self._get_model(
+                    model_type.new(name=cluster.name)))
+            except StorageLookupError:
+                pass
+        return records
+
+    def _retention_ttl(self, handler, model_instance):
+        """
+        Returns the time-to-live to save a model with, if the model's
+        retention policy has a "ttl" which the store handler can enforce
+        natively, and the model has finished.
+
+        :param handler: The store handler for the model
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.model.Model
+        :returns: Seconds until the store deletes the model, or None
+        :rtype: int or None
+        """
+        if not isinstance(handler, ExpiringStoreHandler):
+            return None
+        policy = self._retention.get(type(model_instance).__name__)
+        if policy is None:
+            return None
+        return policy.remaining_ttl(model_instance, datetime.utcnow())
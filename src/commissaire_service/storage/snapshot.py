@@ -0,0 +1,279 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Snapshot files of stored models, for the StorageService's export and
+import.
+
+A snapshot holds one model per line, as the JSON object:
+
+    {"model_type": "Host", "model": {...}}
+
+Snapshots whose names end in ".gz" are gzip compressed.  They are written
+and read one line at a time.
+"""
+
+import gzip
+import json
+import os
+
+import commissaire.models as models
+
+from .base import ScanStoreHandler
+
+
+#: File name suffix of compressed snapshots.
+COMPRESSED_SUFFIX = '.gz'
+
+#: Number of models saved per bulk write when importing a snapshot.
+IMPORT_BATCH_SIZE = 500
+
+
+def open_snapshot(path, mode, compressed):
+    """
+    Opens a snapshot file as text.
+
+    :param path: Path of the snapshot file
+    :type path: str
+    :param mode: "r" or "w"
+    :type mode: str
+    :param compressed: Whether the file is gzip compressed
+    :type compressed: bool
+    :returns: A file object
+    :rtype: io.TextIOBase
+    """
+    if compressed:
+        return gzip.open(path, mode + 't', compresslevel=6, encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class SnapshotWriter:
+    """
+    Writes a snapshot to a temporary file beside its path, which replaces
+    the path only once complete, so an interrupted export never leaves a
+    partial snapshot behind.  Used as a context manager.
+    """
+
+    def __init__(self, path):
+        """
+        Creates a new SnapshotWriter.
+
+        :param path: Path of the snapshot file
+        :type path: str
+        """
+        self._path = path
+        self._temporary = path + '.tmp'
+        self._file = None
+        #: Number of models written.
+        self.count = 0
+
+    def __enter__(self):
+        self._file = open_snapshot(
+            self._temporary, 'w', self._path.endswith(COMPRESSED_SUFFIX))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._file.close()
+        if exc_type is None:
+            os.replace(self._temporary, self._path)
+        else:
+            os.unlink(self._temporary)
+
+    def write(self, model_instance):
+        """
+        Writes a model to the snapshot.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        """
+        self._file.write(json.dumps({
+            'model_type': type(model_instance).__name__,
+            'model': model_instance.to_dict(),
+        }, separators=(',', ':')) + '\n')
+        self.count += 1
+
+
+def parse_line(line):
+    """
+    Parses a line of a snapshot.
+
+    :param line: A line of a snapshot
+    :type line: str
+    :returns: ( model type name, model data )
+    :rtype: tuple
+    :raises ValueError: if the line is not a snapshot entry
+    """
+    try:
+        data = json.loads(line)
+        return data['model_type'], data['model']
+    except (ValueError, KeyError, TypeError) as error:
+        raise ValueError('Invalid snapshot entry: {}'.format(error))
+
+
+def read_snapshot(path, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Reads a snapshot in batches of lines.  Lines are left to be parsed
+    with parse_line(), so a malformed line does not end the read.
+
+    :param path: Path of the snapshot file
+    :type path: str
+    :param batch_size: Most lines per batch
+    :type batch_size: int
+    :returns: Lists of ( line number, line )
+    :rtype: generator
+    """
+    with open_snapshot(
+            path, 'r', path.endswith(COMPRESSED_SUFFIX)) as snapshot:
+        batch = []
+        for number, line in enumerate(snapshot, 1):
+            batch.append((number, line))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+class SnapshotMixin:
+    """
+    Handles the "storage.export" and "storage.import" routing keys of
+    the StorageService.
+    """
+
+    def _snapshot_path(self, name):
+        """
+        Returns the path of a snapshot file in the snapshot directory.
+
+        :param name: File name of the snapshot
+        :type name: str
+        :returns: The path of the snapshot file
+        :rtype: str
+        :raises ValueError: if snapshots are disabled or the name is bad
+        """
+        if not self._snapshot_dir:
+            raise ValueError('Snapshots require "storage_snapshot_dir"')
+        if (not isinstance(name, str) or not name or name.startswith('.') or
+                os.path.basename(name) != name):
+            raise ValueError('Invalid snapshot name: {}'.format(name))
+        return os.path.join(self._snapshot_dir, name)
+
+    def _scan_models(self, handler, model_instance):
+        """
+        Iterates over the models of a list model's type in one store.
+        ScanStoreHandlers are read a page at a time; other handlers are
+        listed whole.
+
+        :param handler: The store handler to read from
+        :type handler: commissaire.storage.StoreHandlerBase
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.model.ListModel
+        :returns: model instances
+        :rtype: generator
+        """
+        if isinstance(handler, ScanStoreHandler):
+            yield from handler._scan(model_instance, IMPORT_BATCH_SIZE)
+        else:
+            yield from self._list_models_from_handler(handler, model_instance)
+
+    def on_export(self, message, name):
+        """
+        Handler for the "storage.export" routing key.
+
+        Writes every model of every listable model type, from every store
+        handler holding them, to the snapshot file of the given name in
+        the "storage_snapshot_dir" directory, one JSON line per model.
+        The file is gzip compressed if its name ends in ".gz".  Secrets
+        are never exported.
+
+        Models are written as they are read, so memory use does not grow
+        with the size of stores which are ScanStoreHandlers; other store
+        handlers are read one model type at a time.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param name: File name of the snapshot
+        :type name: str
+        :returns: the number of models exported by model type
+        :rtype: dict
+        """
+        path = self._snapshot_path(name)
+        # Exports see all saves made so far.
+        self._write_behind.flush()
+        counts = {}
+        with SnapshotWriter(path) as writer:
+            for _, list_type in sorted(self._model_types.items()):
+                model_type = getattr(list_type, '_list_class', None)
+                if (not issubclass(list_type, models.ListModel) or
+                        model_type is None or
+                        issubclass(model_type, models.SecretModel)):
+                    continue
+                list_instance = list_type.new()
+                start = writer.count
+                for handler in self._list_handlers(list_instance):
+                    for model_instance in self._scan_models(
+                            handler, list_instance):
+                        writer.write(model_instance)
+                counts[model_type.__name__] = writer.count - start
+        self.logger.info('Exported {} models to {}'.format(
+            writer.count, path))
+        return counts
+
+    def on_import(self, message, name):
+        """
+        Handler for the "storage.import" routing key.
+
+        Saves every model in the snapshot file of the given name in the
+        "storage_snapshot_dir" directory, as written by "storage.export".
+        Models are read and saved IMPORT_BATCH_SIZE at a time, so that
+        BulkStoreHandlers write each batch in one call and memory use does
+        not grow with the size of the snapshot.
+
+        Lines which are malformed, or whose models fail to build or save,
+        are logged and counted, and do not stop the import.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param name: File name of the snapshot
+        :type name: str
+        :returns: the number of models 'saved' and 'failed'
+        :rtype: dict
+        """
+        path = self._snapshot_path(name)
+        saved = 0
+        failed = 0
+        for batch in read_snapshot(path, IMPORT_BATCH_SIZE):
+            numbers = []
+            model_instances = []
+            for number, line in batch:
+                try:
+                    model_instances.append(
+                        self._build_model(*parse_line(line)))
+                    numbers.append(number)
+                except Exception as error:
+                    failed += 1
+                    self.logger.error(
+                        'Unable to import line {} of {}: {}: {}'.format(
+                            number, path, type(error), error))
+            outcomes = self._save_models(model_instances)
+            for number, outcome in zip(numbers, outcomes):
+                if isinstance(outcome, Exception):
+                    failed += 1
+                    self.logger.error(
+                        'Unable to import line {} of {}: {}: {}'.format(
+                            number, path, type(outcome), outcome))
+                else:
+                    saved += 1
+        self.logger.info('Imported {} models from {}, {} failed'.format(
+            saved, path, failed))
+        return {'saved': saved, 'failed': failed}
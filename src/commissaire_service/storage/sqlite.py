@@ -0,0 +1,519 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+SQLite based StoreHandler, for single-node deployments with no external
+store.
+
+Register it in storage.conf with:
+
+    {"type": "commissaire_service.storage.sqlite",
+     "path": "/var/lib/commissaire/storage.db", ...}
+"""
+
+import json
+import sqlite3
+import sys
+import threading
+
+from commissaire.bus import StorageLookupError
+from commissaire.storage import StoreHandlerBase
+from commissaire.util.config import ConfigurationError
+
+from commissaire_service.storage.base import (
+    AggregateStoreHandler, BulkStoreHandler, RangeDeleteStoreHandler,
+    RevisionedStoreHandler, ScanStoreHandler, StorageConflictError,
+    group_counts, list_type_name)
+
+
+#: Statements creating the database schema.  The primary key index on
+#: ( model_type, key ) serves lookups, listing and counting a model type.
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS models ('
+    ' model_type TEXT NOT NULL,'
+    ' key TEXT NOT NULL,'
+    ' revision INTEGER NOT NULL,'
+    ' data TEXT NOT NULL,'
+    ' PRIMARY KEY (model_type, key)'
+    ')',
+    'CREATE TABLE IF NOT EXISTS revision (last INTEGER NOT NULL)',
+    'INSERT INTO revision (last)'
+    ' SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM revision)',
+)
+
+#: Statements adding to the schema where SQLite has JSON support.  The
+#: status index serves counting a model type by status.
+JSON_SCHEMA = (
+    'CREATE INDEX IF NOT EXISTS models_status ON models'
+    ' (model_type, json_extract(data, \'$.status\'),'
+    ' json_type(data, \'$.status\'))',
+)
+
+#: Oldest SQLite version with the JSON1 extension and indexes on
+#: expressions.
+JSON_SQLITE_VERSION = (3, 9, 0)
+
+#: Most keys looked up in one statement; SQLite allows 999 parameters.
+MAX_KEYS_PER_QUERY = 500
+
+#: Python values of JSON literals, by json_type().
+JSON_LITERALS = {'true': True, 'false': False, 'null': None}
+
+
+def json_available(connection):
+    """
+    Returns whether SQL statements can use the JSON1 functions, which
+    older SQLite versions, such as those of EL7, lack.
+
+    :param connection: A database connection
+    :type connection: sqlite3.Connection
+    :rtype: bool
+    """
+    if sqlite3.sqlite_version_info < JSON_SQLITE_VERSION:
+        return False
+    try:
+        connection.execute('SELECT json_type(\'{}\')')
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+def key_upper_bound(prefix):
+    """
+    Returns the least key greater than every key starting with a prefix,
+    for range queries on the primary key index.
+
+    :param prefix: Primary key prefix
+    :type prefix: str
+    :returns: The upper bound, or None if there is none
+    :rtype: str or None
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    code_point = ord(prefix[-1]) + 1
+    # Surrogates can not be encoded; the next character is U+E000.
+    if 0xD800 <= code_point <= 0xDFFF:
+        code_point = 0xE000
+    return prefix[:-1] + chr(code_point)
+
+
+class SqliteStoreHandler(RevisionedStoreHandler, BulkStoreHandler,
+                         RangeDeleteStoreHandler, ScanStoreHandler,
+                         AggregateStoreHandler, StoreHandlerBase):
+    """
+    Keeps models as JSON in an SQLite database file at "path", in WAL
+    mode so other processes can read while this one writes.  Every write
+    is given a revision from a counter for the whole database.
+
+    One connection is shared by all threads, one statement at a time.
+
+    Without the JSON1 extension of SQLite 3.9, models are grouped in
+    Python rather than by SQLite, and there is no status index.
+    """
+
+    @classmethod
+    def check_config(cls, config):
+        """
+        Examines the configuration parameters for an SqliteStoreHandler
+        and throws a ConfigurationError if any parameters are invalid.
+
+        :param config: Configuration parameters
+        :type config: dict
+        :raises: commissaire.util.config.ConfigurationError
+        """
+        if not isinstance(config.get('path'), str) or not config['path']:
+            raise ConfigurationError(
+                'SQLite store handler requires a "path": {}'.format(config))
+
+    def __init__(self, config):
+        """
+        Creates a new instance of SqliteStoreHandler, creating the database
+        if it does not exist.
+
+        :param config: Configuration parameters
+        :type config: dict
+        """
+        super().__init__(config)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            config['path'], check_same_thread=False)
+        self._json = json_available(self._connection)
+        with self._lock, self._connection:
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            # Durable as of the last checkpoint; safe with WAL.
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA + (JSON_SCHEMA if self._json else ()):
+                self._connection.execute(statement)
+
+    def _get(self, model_instance):
+        """
+        Retrieves a model.
+
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.models.Model
+        :returns: The stored model instance
+        :rtype: commissaire.models.Model
+        :raises StorageLookupError: if the model does not exist
+        """
+        return self._get_with_revision(model_instance)[0]
+
+    def _get_with_revision(self, model_instance):
+        """
+        Retrieves a model and its revision.
+
+        :param model_instance: Model instance to search and get
+        :type model_instance: commissaire.models.Model
+        :returns: The stored model instance and its revision
+        :rtype: tuple
+        :raises StorageLookupError: if the model does not exist
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT revision, data FROM models'
+                ' WHERE model_type = ? AND key = ?',
+                (type(model_instance).__name__,
+                 str(model_instance.primary_key))).fetchone()
+        if row is None:
+            raise StorageLookupError(
+                'No {} "{}"'.format(
+                    type(model_instance).__name__,
+                    model_instance.primary_key),
+                model_instance)
+        return model_instance.new(**json.loads(row[1])), str(row[0])
+
+    def _save(self, model_instance):
+        """
+        Saves a model.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        """
+        return self._save_if_revision(model_instance, None)
+
+    def _save_if_revision(self, model_instance, revision):
+        """
+        Saves a model if its stored revision matches, or unconditionally
+        if the revision is None.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param revision: The expected current revision
+        :type revision: str or None
+        :returns: The saved model instance
+        :rtype: commissaire.models.Model
+        :raises StorageConflictError: if the revision does not match
+        """
+        with self._lock, self._connection:
+            created = self._write(model_instance, revision)
+        self._notify_saved(model_instance, created)
+        return model_instance
+
+    def _write(self, model_instance, revision=None):
+        """
+        Writes a model in the current transaction.  Called with the lock
+        held.
+
+        The revision counter is updated first, which takes the database's
+        write lock before the stored revision is read, so no other process
+        can write in between.
+
+        :param model_instance: Model instance to save
+        :type model_instance: commissaire.models.Model
+        :param revision: The expected current revision
+        :type revision: str or None
+        :returns: Whether the model was created
+        :rtype: bool
+        :raises StorageConflictError: if the revision does not match
+        """
+        data = model_instance.to_json()
+        params = (type(model_instance).__name__,
+                  str(model_instance.primary_key))
+        self._connection.execute('UPDATE revision SET last = last + 1')
+        row = self._connection.execute(
+            'SELECT revision FROM models WHERE model_type = ? AND key = ?',
+            params).fetchone()
+        if revision is not None:
+            actual = None if row is None else str(row[0])
+            if actual != revision:
+                raise StorageConflictError(
+                    'Revision mismatch', model_instance, revision, actual)
+        new_revision = self._connection.execute(
+            'SELECT last FROM revision').fetchone()[0]
+        self._connection.execute(
+            'INSERT OR REPLACE INTO models (model_type, key, revision, data)'
+            ' VALUES (?, ?, ?, ?)',
+            params + (new_revision, data))
+        model_instance._revision = str(new_revision)
+        return row is None
+
+    def _notify_saved(self, model_instance, created):
+        """
+        Sends the notification for a saved model.
+
+        :param model_instance: The saved model instance
+        :type model_instance: commissaire.models.Model
+        :param created: Whether the model was created
+        :type created: bool
+        """
+        if created:
+            self.notify.created(model_instance)
+        else:
+            self.notify.updated(model_instance)
+
+    def _delete(self, model_instance):
+        """
+        Deletes a model.
+
+        :param model_instance: Model instance to delete
+        :type model_instance: commissaire.models.Model
+        :raises StorageLookupError: if the model does not exist
+        """
+        with self._lock, self._connection:
+            cursor = self._connection.execute(
+                'DELETE FROM models WHERE model_type = ? AND key = ?',
+                (type(model_instance).__name__,
+                 str(model_instance.primary_key)))
+        if cursor.rowcount == 0:
+            raise StorageLookupError(
+                'No {} "{}"'.format(
+                    type(model_instance).__name__,
+                    model_instance.primary_key),
+                model_instance)
+        self.notify.deleted(model_instance)
+
+    def _delete_prefix(self, model_instance, prefix):
+        """
+        Deletes the models of a list model's type whose primary keys start
+        with a prefix, as a range of the primary key index.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param prefix: Primary key prefix; "" deletes all of the type
+        :type prefix: str
+        :returns: The deleted model instances
+        :rtype: list
+        """
+        where = 'model_type = ?'
+        params = [list_type_name(model_instance)]
+        if prefix:
+            where += ' AND key >= ?'
+            params.append(prefix)
+            upper = key_upper_bound(prefix)
+            if upper is not None:
+                where += ' AND key < ?'
+                params.append(upper)
+        with self._lock, self._connection:
+            rows = self._connection.execute(
+                'SELECT data FROM models WHERE {} ORDER BY key'.format(where),
+                params).fetchall()
+            self._connection.execute(
+                'DELETE FROM models WHERE {}'.format(where), params)
+        list_class = model_instance._list_class
+        deleted = [list_class.new(**json.loads(data)) for data, in rows]
+        for item in deleted:
+            self.notify.deleted(item)
+        return deleted
+
+    def _list(self, model_instance):
+        """
+        Lists all models of a list model's type, ordered by primary key.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :returns: The list model instance holding the models
+        :rtype: commissaire.models.ListModel
+        """
+        list_class = model_instance._list_class
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT revision, data FROM models WHERE model_type = ?'
+                ' ORDER BY key',
+                (list_type_name(model_instance),)).fetchall()
+        items = []
+        for revision, data in rows:
+            item = list_class.new(**json.loads(data))
+            item._revision = str(revision)
+            items.append(item)
+        return model_instance.new(**{model_instance._list_attr: items})
+
+    def _scan(self, model_instance, page_size):
+        """
+        Iterates over the models of a list model's type in primary key
+        order, one page of the primary key index at a time.  The lock is
+        released between pages.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param page_size: Most models read at a time
+        :type page_size: int
+        :returns: model instances
+        :rtype: generator
+        """
+        list_class = model_instance._list_class
+        model_type_name = list_type_name(model_instance)
+        last_key = ''
+        while True:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT key, revision, data FROM models'
+                    ' WHERE model_type = ? AND key > ?'
+                    ' ORDER BY key LIMIT ?',
+                    (model_type_name, last_key, page_size)).fetchall()
+            for key, revision, data in rows:
+                item = list_class.new(**json.loads(data))
+                item._revision = str(revision)
+                yield item
+            if len(rows) < page_size:
+                return
+            last_key = rows[-1][0]
+
+    def _count(self, model_instance):
+        """
+        Counts the models of a list model's type from the primary key
+        index.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :returns: The number of models
+        :rtype: int
+        """
+        with self._lock:
+            return self._connection.execute(
+                'SELECT COUNT(*) FROM models WHERE model_type = ?',
+                (list_type_name(model_instance),)).fetchone()[0]
+
+    def _aggregate(self, model_instance, fields):
+        """
+        Counts the models of a list model's type by distinct values of
+        the given fields, grouped by SQLite where it supports JSON.
+
+        :param model_instance: List model instance indicating the data type
+        :type model_instance: commissaire.models.ListModel
+        :param fields: Model attribute names to group by
+        :type fields: [str, ...]
+        :returns: [ [ [ value, ... ], count ], ... ]
+        :rtype: list
+        """
+        for name in fields:
+            if not name.isidentifier():
+                raise ValueError('Invalid attribute "{}"'.format(name))
+        if not self._json:
+            with self._lock:
+                rows = self._connection.execute(
+                    'SELECT data FROM models WHERE model_type = ?',
+                    (list_type_name(model_instance),)).fetchall()
+            return group_counts(
+                [json.loads(data).get(name) for name in fields]
+                for data, in rows)
+        columns = []
+        for name in fields:
+            # JSON types tell true from 1 and objects from strings.
+            columns.append(
+                "json_extract(data, '$.{0}'), json_type(data, '$.{0}')".format(
+                    name))
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT COUNT(*), {} FROM models WHERE model_type = ?'
+                ' GROUP BY {}'.format(
+                    ', '.join(columns),
+                    ', '.join(str(x) for x in range(2, 2 * len(fields) + 2))),
+                (list_type_name(model_instance),)).fetchall()
+        values = []
+        for row in rows:
+            value = []
+            for extracted, json_type in zip(row[1::2], row[2::2]):
+                if json_type in JSON_LITERALS:
+                    extracted = JSON_LITERALS[json_type]
+                elif json_type in ('array', 'object'):
+                    extracted = json.loads(extracted)
+                value.append(extracted)
+            values.append(value)
+        return group_counts(values, (row[0] for row in rows))
+
+    def _get_many(self, model_instances):
+        """
+        Retrieves several models, with one query per model type for up to
+        MAX_KEYS_PER_QUERY models.
+
+        :param model_instances: Model instances to search and get
+        :type model_instances: list
+        :returns: Stored model instances or exceptions, in order
+        :rtype: list
+        """
+        # { ( model_type_name, key ) : ( revision, data ) }
+        found = {}
+        by_type = {}
+        for model_instance in model_instances:
+            by_type.setdefault(type(model_instance).__name__, set()).add(
+                str(model_instance.primary_key))
+        with self._lock:
+            for model_type_name, keys in by_type.items():
+                keys = sorted(keys)
+                for start in range(0, len(keys), MAX_KEYS_PER_QUERY):
+                    chunk = keys[start:start + MAX_KEYS_PER_QUERY]
+                    rows = self._connection.execute(
+                        'SELECT key, revision, data FROM models'
+                        ' WHERE model_type = ? AND key IN ({})'.format(
+                            ', '.join('?' * len(chunk))),
+                        [model_type_name] + chunk)
+                    for key, revision, data in rows:
+                        found[(model_type_name, key)] = (revision, data)
+
+        results = []
+        for model_instance in model_instances:
+            entry = found.get((type(model_instance).__name__,
+                               str(model_instance.primary_key)))
+            if entry is None:
+                results.append(StorageLookupError(
+                    'No {} "{}"'.format(
+                        type(model_instance).__name__,
+                        model_instance.primary_key),
+                    model_instance))
+                continue
+            try:
+                model = model_instance.new(**json.loads(entry[1]))
+                model._revision = str(entry[0])
+                results.append(model)
+            except Exception as error:
+                results.append(error)
+        return results
+
+    def _save_many(self, model_instances):
+        """
+        Saves several models in one transaction.
+
+        :param model_instances: Model instances to save
+        :type model_instances: list
+        :returns: Saved model instances or exceptions, in order
+        :rtype: list
+        """
+        results = []
+        saved = []
+        with self._lock, self._connection:
+            for model_instance in model_instances:
+                try:
+                    created = self._write(model_instance)
+                    saved.append((model_instance, created))
+                    results.append(model_instance)
+                except Exception as error:
+                    results.append(error)
+        for model_instance, created in saved:
+            self._notify_saved(model_instance, created)
+        return results
+
+
+PluginClass = SqliteStoreHandler
@@ -0,0 +1,258 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Storage operation statistics for the StorageService.
+"""
+
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+from commissaire.bus import StorageLookupError
+
+
+#: Upper bounds, in seconds, of the latency histogram buckets.
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class LatencyHistogram:
+    """
+    Counts operation latencies in fixed buckets, along with errors and
+    lookup misses.
+    """
+
+    def __init__(self):
+        """
+        Creates a new LatencyHistogram.
+        """
+        # The last bucket counts everything above LATENCY_BUCKETS[-1].
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.misses = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        """
+        Records one operation.
+
+        :param seconds: How long the operation took
+        :type seconds: float
+        """
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def to_dict(self):
+        """
+        Returns a JSON-compatible representation.
+
+        :rtype: dict
+        """
+        bounds = [str(b) for b in LATENCY_BUCKETS] + ['+Inf']
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'misses': self.misses,
+            'total_seconds': self.total_seconds,
+            'max_seconds': self.max_seconds,
+            'buckets': dict(zip(bounds, self.buckets)),
+        }
+
+
+class StorageStats:
+    """
+    Collects latency histograms by (store handler name, model type name,
+    operation), and tracks the most frequently accessed primary keys.
+
+    Key counts are halved whenever more than hot_key_capacity keys are
+    tracked, which bounds memory and lets the ranking follow changes in
+    the access pattern.
+    """
+
+    def __init__(self, hot_key_capacity=1024):
+        """
+        Creates a new StorageStats.
+
+        :param hot_key_capacity: Number of keys tracked before decaying
+        :type hot_key_capacity: int
+        """
+        self._lock = threading.Lock()
+        self._histograms = collections.defaultdict(LatencyHistogram)
+        self._hot_keys = collections.Counter()
+        self._hot_key_capacity = hot_key_capacity
+
+    @contextlib.contextmanager
+    def timer(self, handler_name, model_type_name, op):
+        """
+        Times the enclosed block as one operation.  StorageLookupErrors
+        count as misses and other exceptions as errors; both are
+        re-raised.
+
+        :param handler_name: Name of the store handler
+        :type handler_name: str
+        :param model_type_name: Name of the model type
+        :type model_type_name: str
+        :param op: Name of the operation
+        :type op: str
+        """
+        start = time.monotonic()
+        failure = None
+        try:
+            yield
+        except StorageLookupError:
+            failure = 'misses'
+            raise
+        except Exception:
+            failure = 'errors'
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            with self._lock:
+                histogram = self._histograms[
+                    (handler_name, model_type_name, op)]
+                histogram.add(elapsed)
+                if failure is not None:
+                    setattr(histogram, failure,
+                            getattr(histogram, failure) + 1)
+
+    def record_key(self, model_type_name, key):
+        """
+        Records an access to a primary key.
+
+        :param model_type_name: Name of the model type
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        """
+        with self._lock:
+            self._hot_keys[(model_type_name, key)] += 1
+            if len(self._hot_keys) > self._hot_key_capacity:
+                for hot_key, count in list(self._hot_keys.items()):
+                    if count > 1:
+                        self._hot_keys[hot_key] = count // 2
+                    else:
+                        del self._hot_keys[hot_key]
+
+    def to_dict(self, hot_key_count=10):
+        """
+        Returns a JSON-compatible snapshot.
+
+        :param hot_key_count: Number of hot keys to report
+        :type hot_key_count: int
+        :returns: 'latency' rows and 'hot_keys' rows
+        :rtype: dict
+        """
+        with self._lock:
+            latency = []
+            for (handler_name, model_type_name, op), histogram in sorted(
+                    self._histograms.items()):
+                row = histogram.to_dict()
+                row.update({
+                    'handler': handler_name,
+                    'model_type': model_type_name,
+                    'op': op,
+                })
+                latency.append(row)
+            hot_keys = [
+                {'model_type': model_type_name, 'key': key, 'count': count}
+                for (model_type_name, key), count in
+                self._hot_keys.most_common(hot_key_count)]
+        return {
+            'latency': latency,
+            'hot_keys': hot_keys,
+        }
+
+
+class StatsMixin:
+    """
+    Handles the "storage.stats" routing key of the StorageService.
+    """
+
+    def on_stats(self, message):
+        """
+        Handler for the "storage.stats" routing key.
+
+        Returns runtime statistics of this storage service process.
+
+           'handlers'       : Warm-up 'ready', 'warm_up_seconds' and
+                              'error' by store handler name (only with
+                              "storage_eager_handlers" set)
+           'coalescing'     : 'backend_calls' made for get and list
+                              requests, and 'saved_calls' answered by
+                              sharing the result of an identical request
+                              in progress
+           'negative_cache' : 'hits' answered from cached lookup misses
+           'model_cache'    : 'hits' answered from cached models
+           'write_behind'   : 'saves' buffered, 'writes' made to stores,
+                              'saved_writes' avoided by merging saves,
+                              failed writes ('errors') and 'pending' saves
+           'notify_batches' : 'notifications' batched, 'messages'
+                              published, failed ones ('errors') and
+                              'pending' notifications
+           'journal'        : Operations waiting in the write journal
+                              ('backlog'), 'journaled', 'replayed',
+                              'dropped' when rejected by the store, and
+                              'refused' when full (None if disabled)
+           'latency'        : One entry per store 'handler' name,
+                              'model_type' and 'op' ("get", "save",
+                              "validate", ...) with the 'count', 'errors',
+                              lookup 'misses', 'total_seconds',
+                              'max_seconds' and a histogram of 'buckets'
+                              by upper bound in seconds
+           'hot_keys'       : The most frequently accessed models, as
+                              'model_type', 'key' and (decayed) 'count'
+           'validation'     : Validations 'skipped' for models read back
+                              at an already validated revision, passed by
+                              'compiled' type checks, and 'full' ones
+           'hedged_reads'   : By store handler name, for handlers hedging
+                              gets across endpoints: 'reads', 'hedged'
+                              ones, 'hedge_wins', hedges 'denied' by the
+                              budget and the current 'delay_seconds'
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :returns: statistics by category
+        :rtype: dict
+        """
+        result = {
+            'handlers': self._handler_status,
+            'coalescing': self._flights.stats(),
+            'negative_cache': {
+                'hits': self._negative_cache.hits,
+            },
+            'model_cache': {
+                'hits': self._model_cache.hits,
+            },
+            'write_behind': self._write_behind.stats(),
+            'notify_batches': self._notify_batcher.stats(),
+            'journal': (self._journal.stats()
+                        if self._journal is not None else None),
+        }
+        result.update(self._stats.to_dict())
+        result['validation'] = self._validation.stats()
+        result['hedged_reads'] = {}
+        for name, handler in sorted(self._handlers_by_name.items()):
+            hedge_stats = getattr(handler, 'hedge_stats', None)
+            stats = hedge_stats() if callable(hedge_stats) else None
+            if isinstance(stats, dict):
+                result['hedged_reads'][name] = stats
+        return result
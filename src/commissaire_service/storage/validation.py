@@ -0,0 +1,176 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Model validation for the StorageService.
+"""
+
+import collections
+import threading
+
+import commissaire.models as models
+
+
+class TypeValidator:
+    """
+    Validates instances of one model type.
+
+    For model types which rely on commissaire.models.Model._validate()
+    alone, the attribute type checks are compiled into a list once, and
+    valid instances pass without calling _validate().  Instances failing
+    the compiled checks, and all instances of model types with their own
+    validation, go through _validate() as usual, so errors are reported
+    exactly as before.
+    """
+
+    def __init__(self, model_type):
+        """
+        Creates a new TypeValidator.
+
+        :param model_type: The model type to validate
+        :type model_type: type
+        """
+        self._checks = None
+        if model_type._validate is models.Model._validate:
+            try:
+                attribute_map = model_type._attribute_map
+                self._checks = [
+                    (name, spec['type'])
+                    for name, spec in sorted(attribute_map.items())]
+            except (AttributeError, KeyError, TypeError):
+                pass
+
+    def validate(self, model_instance):
+        """
+        Validates a model instance.
+
+        :param model_instance: Model instance to validate
+        :type model_instance: commissaire.model.Model
+        :returns: Whether the compiled checks were sufficient
+        :rtype: bool
+        :raises commissaire.models.ValidationError: if the model is invalid
+        """
+        if self._checks is not None:
+            for name, expected_type in self._checks:
+                if not isinstance(
+                        getattr(model_instance, name, None), expected_type):
+                    break
+            else:
+                return True
+        model_instance._validate()
+        return False
+
+
+class ModelValidation:
+    """
+    Validates models, keeping a TypeValidator per model type.
+
+    It also remembers the store revision at which each model was last
+    validated.  A model read back at a revision already validated has not
+    changed since, and is not validated again.  Only revisions assigned by
+    the store, which change with every write from any process, may be used.
+    """
+
+    def __init__(self, capacity=4096):
+        """
+        Creates a new ModelValidation.
+
+        :param capacity: Number of validated revisions to remember
+        :type capacity: int
+        """
+        self._lock = threading.Lock()
+        self._validators = {}
+        self._revisions = collections.OrderedDict()
+        self._capacity = capacity
+        #: Validations skipped because the revision was validated before.
+        self.skipped = 0
+        #: Validations passed by the compiled checks alone.
+        self.compiled = 0
+        #: Validations which called the model's _validate().
+        self.full = 0
+
+    def validate(self, model_instance, revision=None):
+        """
+        Validates a model instance, unless it was already validated at the
+        given revision.
+
+        :param model_instance: Model instance to validate
+        :type model_instance: commissaire.model.Model
+        :param revision: Store revision of the model, if known
+        :type revision: str or None
+        :raises commissaire.models.ValidationError: if the model is invalid
+        """
+        model_type = type(model_instance)
+        key = (model_type.__name__, model_instance.primary_key)
+        if revision is not None:
+            with self._lock:
+                if self._revisions.get(key) == revision:
+                    self._revisions.move_to_end(key)
+                    self.skipped += 1
+                    return
+
+        validator = self._validators.get(model_type)
+        if validator is None:
+            validator = TypeValidator(model_type)
+            self._validators[model_type] = validator
+        compiled = validator.validate(model_instance)
+
+        with self._lock:
+            if compiled:
+                self.compiled += 1
+            else:
+                self.full += 1
+        if revision is not None:
+            self.remember(model_instance, revision)
+
+    def remember(self, model_instance, revision):
+        """
+        Records that a model was validated at a revision.
+
+        :param model_instance: A validated model instance
+        :type model_instance: commissaire.model.Model
+        :param revision: Store revision of the model
+        :type revision: str
+        """
+        key = (type(model_instance).__name__, model_instance.primary_key)
+        with self._lock:
+            self._revisions[key] = revision
+            self._revisions.move_to_end(key)
+            while len(self._revisions) > self._capacity:
+                self._revisions.popitem(last=False)
+
+    def forget(self, model_instance):
+        """
+        Forgets the validated revision of a model.
+
+        :param model_instance: A model instance
+        :type model_instance: commissaire.model.Model
+        """
+        key = (type(model_instance).__name__, model_instance.primary_key)
+        with self._lock:
+            self._revisions.pop(key, None)
+
+    def stats(self):
+        """
+        Returns validation counters.
+
+        :returns: skipped, compiled and full
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'skipped': self.skipped,
+                'compiled': self.compiled,
+                'full': self.full,
+            }
@@ -0,0 +1,470 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Model change subscriptions for the StorageService.
+"""
+
+import collections
+import contextlib
+import fnmatch
+import threading
+import time
+import uuid
+
+import commissaire.models as models
+
+from commissaire.storage import client
+
+from .base import content_revision
+from .notify import NOTIFY_ROUTING_KEY, notify_body
+
+
+class NotifyTap:
+    """
+    Wraps a store handler's notify object.  Notifications are forwarded
+    unchanged, or to a NotifyBatcher for model types it batches, or
+    collected while a thread is within collecting(), and also reported to
+    a callback as (event, model_instance).
+
+    Given a publish function, notifications are published through it as
+    the notify object would, instead of on the notify object's channel,
+    which can only be used from one thread.
+    """
+
+    def __init__(self, notify, callback, lock, batcher=None, publish=None):
+        """
+        Creates a new NotifyTap.
+
+        :param notify: The store handler's notify object
+        :type notify: object
+        :param callback: Called with the event name and model instance
+        :type callback: callable
+        :param lock: Held while notifying and calling the callback
+        :type lock: threading.RLock
+        :param batcher: Optional batcher of notifications
+        :type batcher: commissaire_service.storage.notify.NotifyBatcher
+        :param publish: Optional function called with a routing key and
+                        message body to publish a notification
+        :type publish: callable
+        """
+        self._notify = notify
+        self._callback = callback
+        self._lock = lock
+        self._batcher = batcher
+        self._publish = publish
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(self._notify, name)
+
+    def _forward(self, event_name, model_instance, notify):
+        """
+        Forwards a notification and reports it to the callback.
+
+        :param event_name: One of the commissaire.storage.client events
+        :type event_name: str
+        :param model_instance: The created, updated or deleted model
+        :type model_instance: commissaire.model.Model
+        :param notify: The notify object's method for the event
+        :type notify: callable
+        """
+        collected = getattr(self._local, 'collected', None)
+        with self._lock:
+            if collected is not None:
+                collected.append((event_name, model_instance))
+            elif (self._batcher is not None and
+                    self._batcher.enabled(type(model_instance).__name__)):
+                self._batcher.put(event_name, model_instance)
+            elif self._publish is not None:
+                self._publish(
+                    NOTIFY_ROUTING_KEY.format(
+                        type(model_instance).__name__, event_name),
+                    notify_body(event_name, model_instance))
+            else:
+                notify(model_instance)
+            self._callback(event_name, model_instance)
+
+    @contextlib.contextmanager
+    def collecting(self):
+        """
+        Collects the notifications sent from the calling thread within the
+        context instead of forwarding them, so the caller can publish them
+        together.  They are still reported to the callback.
+
+        :returns: A list to which ( event, model_instance ) pairs are added
+        :rtype: list
+        """
+        collected = []
+        self._local.collected = collected
+        try:
+            yield collected
+        finally:
+            self._local.collected = None
+
+    def created(self, model_instance):
+        self._forward(
+            client.NOTIFY_EVENT_CREATED, model_instance, self._notify.created)
+
+    def updated(self, model_instance):
+        self._forward(
+            client.NOTIFY_EVENT_UPDATED, model_instance, self._notify.updated)
+
+    def deleted(self, model_instance):
+        self._forward(
+            client.NOTIFY_EVENT_DELETED, model_instance, self._notify.deleted)
+
+
+class NotifyEchoes:
+    """
+    Remembers the notifications this process sent, so that their echoes
+    from the notify exchange can be told apart from the notifications of
+    other StorageService processes.  Only the most recent are remembered.
+    """
+
+    #: Most notifications remembered.
+    MAX_PENDING = 10000
+
+    def __init__(self):
+        """
+        Creates a new NotifyEchoes.
+        """
+        self._lock = threading.Lock()
+        # { ( event, model_type_name, content_revision ) : count }
+        self._pending = collections.OrderedDict()
+
+    @staticmethod
+    def _key(event_name, model_instance):
+        return (event_name, type(model_instance).__name__,
+                content_revision(model_instance.to_dict()))
+
+    def expect(self, event_name, model_instance):
+        """
+        Remembers a notification sent by this process.
+
+        :param event_name: One of the commissaire.storage.client events
+        :type event_name: str
+        :param model_instance: The created, updated or deleted model
+        :type model_instance: commissaire.model.Model
+        """
+        key = self._key(event_name, model_instance)
+        with self._lock:
+            self._pending[key] = self._pending.pop(key, 0) + 1
+            while len(self._pending) > self.MAX_PENDING:
+                self._pending.popitem(last=False)
+
+    def consume(self, event_name, model_instance):
+        """
+        Returns whether a received notification is the echo of one sent
+        by this process, forgetting it if so.
+
+        :param event_name: One of the commissaire.storage.client events
+        :type event_name: str
+        :param model_instance: The created, updated or deleted model
+        :type model_instance: commissaire.model.Model
+        :rtype: bool
+        """
+        key = self._key(event_name, model_instance)
+        with self._lock:
+            count = self._pending.pop(key, 0)
+            if count > 1:
+                self._pending[key] = count - 1
+            return count > 0
+
+
+class Watch:
+    """
+    A single subscription to model change events.
+    """
+
+    def __init__(self, watch_id, model_type_name, key_filter, queue_name,
+                 expires):
+        """
+        Creates a new Watch.
+
+        :param watch_id: Unique identifier of the watch
+        :type watch_id: str
+        :param model_type_name: Model type to watch
+        :type model_type_name: str
+        :param key_filter: Optional fnmatch pattern for primary keys
+        :type key_filter: str or None
+        :param queue_name: Queue to deliver events to
+        :type queue_name: str
+        :param expires: Time (as from time.monotonic()) the watch lapses
+        :type expires: float
+        """
+        self.watch_id = watch_id
+        self.model_type_name = model_type_name
+        self.key_filter = key_filter
+        self.queue_name = queue_name
+        self.expires = expires
+
+    def matches(self, event):
+        """
+        Returns whether an event is of interest to this watch.
+
+        :param event: An event as recorded by WatchRegistry
+        :type event: dict
+        :rtype: bool
+        """
+        if event['model_type'] != self.model_type_name:
+            return False
+        if self.key_filter is None:
+            return True
+        return fnmatch.fnmatchcase(str(event['key']), self.key_filter)
+
+
+class WatchRegistry:
+    """
+    Keeps a bounded log of recent model change events, each stamped with
+    a sequence number, and the watches interested in them.  A client that
+    reconnects can resume from the last sequence number it saw, as long as
+    the events since then are still in the log.  Sequence numbers restart
+    with each registry, which is identified by its epoch.
+
+    Events and watches are local to one StorageService process, which
+    records the changes made by other processes from their notifications
+    if configured to.
+    """
+
+    #: Default number of events kept for resuming watches.
+    DEFAULT_BACKLOG_SIZE = 1000
+
+    #: Default seconds a watch lives without being renewed.
+    DEFAULT_TIMEOUT = 300
+
+    def __init__(self, backlog_size=None, timeout=None):
+        """
+        Creates a new WatchRegistry.
+
+        :param backlog_size: Number of events kept for resuming
+        :type backlog_size: int or None
+        :param timeout: Seconds a watch lives without being renewed
+        :type timeout: int or float or None
+        """
+        if backlog_size is None:
+            backlog_size = self.DEFAULT_BACKLOG_SIZE
+        if timeout is None:
+            timeout = self.DEFAULT_TIMEOUT
+        self.timeout = timeout
+        self.epoch = str(uuid.uuid4())
+        self._lock = threading.Lock()
+        self._events = collections.deque(maxlen=backlog_size)
+        self._sequence = 0
+        self._watches = {}
+
+    @property
+    def sequence(self):
+        """
+        The sequence number of the most recent event.
+        """
+        return self._sequence
+
+    def record(self, event_name, model_type_name, key, model_data):
+        """
+        Records a model change event.
+
+        :param event_name: One of the commissaire.storage.client events
+        :type event_name: str
+        :param model_type_name: Model type of the changed model
+        :type model_type_name: str
+        :param key: Primary key of the changed model
+        :type key: str
+        :param model_data: Model representation sent to watchers
+        :type model_data: dict or None
+        :returns: The event and the queue names to deliver it to
+        :rtype: tuple
+        """
+        with self._lock:
+            self._sequence += 1
+            event = {
+                'sequence': self._sequence,
+                'event': event_name,
+                'model_type': model_type_name,
+                'key': key,
+                'model': model_data,
+            }
+            self._events.append(event)
+            self._expire()
+            queue_names = [w.queue_name for w in self._watches.values()
+                           if w.matches(event)]
+        return event, queue_names
+
+    def add(self, model_type_name, queue_name, key_filter=None, since=None,
+            epoch=None, watch_id=None):
+        """
+        Adds or renews a watch.
+
+        :param model_type_name: Model type to watch
+        :type model_type_name: str
+        :param queue_name: Queue to deliver events to
+        :type queue_name: str
+        :param key_filter: Optional fnmatch pattern for primary keys
+        :type key_filter: str or None
+        :param since: Resume after this sequence number
+        :type since: int or None
+        :param epoch: Registry epoch the sequence number belongs to
+        :type epoch: str or None
+        :param watch_id: Identifier of a watch to renew
+        :type watch_id: str or None
+        :returns: The watch, missed events, and whether events were lost
+        :rtype: tuple
+        """
+        with self._lock:
+            if watch_id is None:
+                watch_id = str(uuid.uuid4())
+            watch = Watch(
+                watch_id, model_type_name, key_filter, queue_name,
+                time.monotonic() + self.timeout)
+            self._watches[watch_id] = watch
+
+            backlog = []
+            reset = False
+            if since is not None:
+                since = int(since)
+                oldest = self._events[0]['sequence'] if self._events else (
+                    self._sequence + 1)
+                # Events between "since" and the oldest logged event
+                # have been dropped, or the sequence numbers belong to
+                # another registry; either way the client must start over.
+                reset = (since + 1 < oldest or since > self._sequence or
+                         (epoch is not None and epoch != self.epoch))
+                if not reset:
+                    backlog = [e for e in self._events
+                               if e['sequence'] > since and watch.matches(e)]
+        return watch, backlog, reset
+
+    def remove(self, watch_id):
+        """
+        Removes a watch.
+
+        :param watch_id: Identifier of the watch
+        :type watch_id: str
+        :returns: Whether the watch existed
+        :rtype: bool
+        """
+        with self._lock:
+            return self._watches.pop(watch_id, None) is not None
+
+    def _expire(self):
+        """
+        Drops lapsed watches.  Called with the lock held.
+        """
+        now = time.monotonic()
+        for watch_id in [k for k, v in self._watches.items()
+                         if v.expires < now]:
+            del self._watches[watch_id]
+
+
+class WatchMixin:
+    """
+    Handles the "storage.watch" and "storage.unwatch" routing keys of
+    the StorageService, delivering changes to watches.
+    """
+
+    def _record_event(self, event_name, model_instance):
+        """
+        Records a change and delivers it to any matching watches.
+
+        :param event_name: One of the commissaire.storage.client events
+        :type event_name: str
+        :param model_instance: The created, updated or deleted model
+        :type model_instance: commissaire.model.Model
+        """
+        # Never hand out secrets through watches.
+        if isinstance(model_instance, models.SecretModel):
+            model_data = None
+        else:
+            model_data = self._model_reply(
+                model_instance, event_name != client.NOTIFY_EVENT_DELETED)
+        event, queue_names = self._watches.record(
+            event_name, type(model_instance).__name__,
+            model_instance.primary_key, model_data)
+        for queue_name in queue_names:
+            self._send_event(queue_name, event)
+
+    def on_watch(self, message, model_type_name, queue_name,
+                 key_filter=None, since=None, epoch=None, watch_id=None):
+        """
+        Handler for the "storage.watch" routing key.
+
+        Subscribes a queue to created, updated and deleted events for a
+        model type, optionally limited to primary keys matching an fnmatch
+        pattern.  Each event is a dictionary:
+
+           'sequence'   : Position of the event in the stream
+           'event'      : "created", "updated" or "deleted"
+           'model_type' : Model type name
+           'key'        : Primary key of the model
+           'model'      : Model data, including its "_revision"
+                          (None for secret models)
+
+        Watches lapse after "timeout" seconds unless renewed by calling
+        this method again with the returned watch_id.
+
+        Events are sent for changes made through this process and, with
+        the "watch_remote" setting, through other storage service
+        processes such as shards.  Models changed by other processes are
+        given content revisions.
+
+        To resume after a reconnect, pass the last sequence number seen
+        and the epoch returned here; missed events are sent before any new
+        ones.  If they can no longer be replayed, "reset" is true in the
+        result and the client should re-list the models.
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param model_type_name: Model type to watch
+        :type model_type_name: str
+        :param queue_name: Queue to deliver events to
+        :type queue_name: str
+        :param key_filter: Optional fnmatch pattern for primary keys
+        :type key_filter: str or None
+        :param since: Resume after this sequence number
+        :type since: int or None
+        :param epoch: Epoch returned by a previous call
+        :type epoch: str or None
+        :param watch_id: Identifier of a watch to renew
+        :type watch_id: str or None
+        :returns: watch_id, epoch, sequence, reset and timeout
+        :rtype: dict
+        """
+        # Let this raise a KeyError for an unknown model type.
+        self._model_types[model_type_name]
+        watch, backlog, reset = self._watches.add(
+            model_type_name, queue_name, key_filter, since, epoch, watch_id)
+        for event in backlog:
+            self._send_event(queue_name, event)
+        return {
+            'watch_id': watch.watch_id,
+            'epoch': self._watches.epoch,
+            'sequence': self._watches.sequence,
+            'reset': reset,
+            'timeout': self._watches.timeout,
+        }
+
+    def on_unwatch(self, message, watch_id):
+        """
+        Handler for the "storage.unwatch" routing key.
+
+        Cancels a watch made through "storage.watch".
+
+        :param message: A message instance
+        :type message: kombu.message.Message
+        :param watch_id: Identifier of the watch
+        :type watch_id: str
+        :returns: Whether the watch existed
+        :rtype: bool
+        """
+        return self._watches.remove(watch_id)
@@ -0,0 +1,170 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Write-behind buffering for the StorageService.
+"""
+
+from .deadline import DeadlineBuffer
+
+
+class WriteBehindBuffer(DeadlineBuffer):
+    """
+    Holds saved models for a short window before writing them to their
+    store.  Saves of the same model within the window replace the pending
+    model, so only the last one is written.
+
+    Each model type has its own window, in seconds; types without one are
+    never buffered.  A model is written at most one window after its first
+    pending save, by a background thread started on first use.
+
+    Writes are serialized, so a model's writes reach the store in the
+    order they were made.  A model which fails to write stays pending and
+    is retried one window later, and the failure is raised from the next
+    flush.
+    """
+
+    name = 'WriteBehindBuffer'
+
+    def __init__(self, windows, write):
+        """
+        Creates a new WriteBehindBuffer.
+
+        :param windows: Seconds to hold saves, by model type name
+        :type windows: dict
+        :param write: Called with each model instance to write
+        :type write: callable
+        """
+        super().__init__(windows)
+        self._write = write
+        #: Number of saves buffered.
+        self.saves = 0
+        #: Number of writes made to stores.
+        self.writes = 0
+        #: Number of writes which failed.
+        self.errors = 0
+
+    def put(self, model_instance):
+        """
+        Buffers a save, replacing any pending save of the same model.
+
+        :param model_instance: A validated model instance
+        :type model_instance: commissaire.model.Model
+        """
+        model_type_name = type(model_instance).__name__
+        key = (model_type_name, model_instance.primary_key)
+        with self._lock:
+            self.saves += 1
+            self._entry(model_type_name, key, model_instance)[1] = (
+                model_instance)
+
+    def get(self, model_type_name, key):
+        """
+        Returns the pending model, or None.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        :rtype: commissaire.model.Model or None
+        """
+        if not self._pending:
+            return None
+        with self._lock:
+            entry = self._pending.get((model_type_name, key))
+            return None if entry is None else entry[1]
+
+    def discard(self, model_type_name, key):
+        """
+        Drops the pending save of a model, such as when it is deleted.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str
+        :param key: The model's primary key
+        :type key: str
+        """
+        if not self._pending:
+            return
+        # Wait for a write of the model in progress to finish.
+        with self._handle_lock, self._lock:
+            self._pending.pop((model_type_name, key), None)
+
+    def flush(self, model_type_name=None, key=None):
+        """
+        Writes pending saves now: all of them, or those of one model.
+
+        :param model_type_name: A model type name
+        :type model_type_name: str or None
+        :param key: The model's primary key
+        :type key: str or None
+        :raises Exception: the first failed write, if any; failed saves
+                           stay pending
+        """
+        if model_type_name is None:
+            self._handle_entries(None)
+        else:
+            self._handle_entries([(model_type_name, key)])
+
+    def close(self):
+        """
+        Stops buffering and writes all pending saves.
+        """
+        try:
+            super().close()
+        except Exception as error:
+            self.logger.error(
+                'Closing with {} unwritten saves: {}: {}'.format(
+                    len(self._pending), type(error), error))
+
+    def stats(self):
+        """
+        Returns buffer counters.
+
+        :returns: saves, writes, saved_writes, errors and pending
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'saves': self.saves,
+                'writes': self.writes,
+                'saved_writes': self.saves - self.writes - len(self._pending),
+                'errors': self.errors,
+                'pending': len(self._pending),
+            }
+
+    def _handle(self, key, model_instance):
+        """
+        Writes one model, keeping it pending if the write fails.  Called
+        with the handle lock held.
+
+        :param key: The model's ( model_type_name, primary_key )
+        :type key: tuple
+        :param model_instance: The model instance to write
+        :type model_instance: commissaire.model.Model
+        :raises Exception: if the write fails
+        """
+        try:
+            self._write(model_instance)
+        except Exception as error:
+            with self._lock:
+                self.errors += 1
+                # A save made during the write replaces this one.
+                self._entry(key[0], key, model_instance)
+            self.logger.error(
+                'Unable to write {}, retrying in {}s: {}: {}'.format(
+                    model_instance, self._windows[key[0]], type(error),
+                    error))
+            raise
+        with self._lock:
+            self.writes += 1
@@ -0,0 +1,89 @@
+# Copyright (C) 2017  Red Hat, Inc
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Tests for commissaire_service.clusterexec.ClusterExecService.
+"""
+
+from . import TestCase, mock
+
+from commissaire.bus import RemoteProcedureCallError
+from commissaire_service.clusterexec import ClusterExecService
+
+
+class TestClusterExecService(TestCase):
+    """
+    Tests for the ClusterExecService class.
+    """
+
+    def setUp(self):
+        """
+        Called before each test case.
+        """
+        self._connection_patcher = mock.patch(
+            'commissaire_service.service.Connection')
+        self._exchange_patcher = mock.patch(
+            'commissaire_service.service.Exchange')
+        self._producer_patcher = mock.patch(
+            'commissaire_service.service.Producer')
+        self._connection_patcher.start()
+        self._exchange_patcher.start()
+        self._producer_patcher.start()
+
+        self.service_instance = ClusterExecService(
+            'commissaire',
+            'redis://127.0.0.1:6379/'
+        )
+        self.service_instance.request = mock.MagicMock()
+
+    def tearDown(self):
+        """
+        Called after each test case.
+        """
+        self._connection_patcher.stop()
+        self._exchange_patcher.stop()
+        self._producer_patcher.stop()
+
+    def test_get_host_creds(self):
+        """
+        Verify ClusterExecService._get_host_creds fetches in one request
+        """
+        addresses = ['10.0.0.1', '10.0.0.2']
+        self.service_instance.request.return_value = {
+            'result': [{'address': x, 'remote_user': 'root'}
+                       for x in addresses]}
+
+        host_creds = self.service_instance._get_host_creds(addresses)
+        self.service_instance.request.assert_called_once_with(
+            'storage.get', 'HostCreds',
+            [{'address': x} for x in addresses])
+        self.assertEquals(sorted(host_creds), addresses)
+        self.assertEquals(host_creds['10.0.0.2'].address, '10.0.0.2')
+
+        self.assertEquals(self.service_instance._get_host_creds([]), {})
+        self.assertEquals(self.service_instance.request.call_count, 1)
+
+    def test_get_host_creds_fallback(self):
+        """
+        Verify ClusterExecService._get_host_creds warns and returns nothing
+        when the bulk request fails
+        """
+        self.service_instance.request.side_effect = RemoteProcedureCallError(
+            'No HostCreds "10.0.0.2"')
+        self.service_instance.logger = mock.MagicMock()
+
+        self.assertEquals(
+            self.service_instance._get_host_creds(['10.0.0.1', '10.0.0.2']),
+            {})
+        self.assertEquals(self.service_instance.logger.warn.call_count, 1)
@@ -173,3 +173,27 @@ class TestCommissaireService(TestCase):
             properties={'reply_to': 'test_queue'})
         self.service_instance.on_message(body, message)
         self.assertEquals(1, self.service_instance.on_message.call_count)
+
+    @mock.patch('commissaire.bus.BusMixin.request')
+    def test_request_storage_shards(self, request):
+        """
+        Verify CommissaireService.request routes sharded storage requests
+        """
+        self.service_instance._storage_shards = ['Host*']
+        for args, kwargs, expected in (
+                (('HostCreds', {}), {}, 'storage.HostCreds.get'),
+                ((), {'params': {'model_type_name': 'Hosts'}},
+                 'storage.Hosts.get'),
+                (({'model_type_name': 'Host'},), {}, 'storage.Host.get'),
+                ((['Host', {}],), {}, 'storage.Host.get'),
+                ((), {'params': ['Host', {}]}, 'storage.Host.get'),
+                ((), {'model_type_name': 'Host', 'model_json_data': '{}'},
+                 'storage.Host.get'),
+                (('Cluster', {}), {}, 'storage.get'),
+                (({'model_type_name': 'Cluster'},), {}, 'storage.get'),
+                ((), {'model_type_name': 'Cluster'}, 'storage.get')):
+            self.service_instance.request('storage.get', *args, **kwargs)
+            request.assert_called_with(expected, *args, **kwargs)
+
+        self.service_instance.request('storage.stats')
+        request.assert_called_with('storage.stats')
@@ -18,13 +18,41 @@ Tests for commissaire_service.storage.StorageService.
 
 from . import TestCase, mock
 
+import gzip
 import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 
+import requests
+
+from datetime import datetime, timedelta
+
+from commissaire import constants as C
 from commissaire import models
-from commissaire.storage import StoreHandlerBase
+from commissaire.bus import StorageLookupError
+from commissaire.storage import StoreHandlerBase, client
 from commissaire.util.config import ConfigurationError
 from commissaire_service.storage import StorageService
+from commissaire_service.storage.base import (
+    NOT_MODIFIED_KEY, REVISION_KEY, BulkStoreHandler, ExpiringStoreHandler,
+    RevisionedStoreHandler, StorageConflictError, content_revision)
+from commissaire_service.storage.cache import (
+    EncodedJSON, ModelCache, NegativeCache)
 from commissaire_service.storage.custodia import CustodiaStoreHandler
+from commissaire_service.storage.etcd import EtcdStoreHandler
+from commissaire_service.storage.hedge import HedgedReader
+from commissaire_service.storage.journal import WriteJournal
+from commissaire_service.storage.memory import MemoryStoreHandler
+from commissaire_service.storage.notify import (
+    NotifyBatcher, notify_body, unbatch)
+from commissaire_service.storage.retention import RetentionPolicy
+from commissaire_service.storage.sqlite import SqliteStoreHandler
+from commissaire_service.storage.watch import NotifyTap
+from commissaire_service.storage.writebehind import WriteBehindBuffer
 
 
 SECRET_MODEL_TYPES = (
@@ -42,6 +70,34 @@ class StoreHandlerTest(StoreHandlerBase):
         return True
 
 
+class RevisionedStoreHandlerTest(RevisionedStoreHandler, StoreHandlerTest):
+    """
+    Minimal revisioned store handler implementation to aid in unit testing.
+    """
+    pass
+
+
+class BulkStoreHandlerTest(BulkStoreHandler, StoreHandlerTest):
+    """
+    Minimal bulk store handler implementation to aid in unit testing.
+    """
+    pass
+
+
+class ExpiringStoreHandlerTest(ExpiringStoreHandler, StoreHandlerTest):
+    """
+    Minimal expiring store handler implementation to aid in unit testing.
+    """
+    pass
+
+
+class BulkExpiringStoreHandlerTest(BulkStoreHandler, ExpiringStoreHandlerTest):
+    """
+    Minimal bulk and expiring store handler to aid in unit testing.
+    """
+    pass
+
+
 class TestStorageService(TestCase):
     """
     Tests for the StorageService class.
@@ -67,15 +123,23 @@ class TestStorageService(TestCase):
         patcher.start().return_value = StoreHandlerTest
         self.addCleanup(patcher.stop)
 
-        # This gets the StorageService created without registering any
-        # store handlers.
+        self.service_instance = self._create_service()
+
+    def _create_service(self, config_data=None):
+        """
+        Creates a StorageService without registering any store handlers.
+
+        :param config_data: Configuration data
+        :type config_data: dict or None
+        :rtype: StorageService
+        """
         with mock.patch(
                 'commissaire_service.service.read_config_file') as rcf, \
             mock.patch(
                 'commissaire_service.storage.'
-                'StorageService._register_store_handler') as rsh:
-            rcf.return_value = {}
-            self.service_instance = StorageService(
+                'StorageService._register_store_handler'):
+            rcf.return_value = config_data or {}
+            return StorageService(
                 'commissaire',
                 'redis://127.0.0.1:6379/')
 
@@ -226,6 +290,28 @@ class TestStorageService(TestCase):
         # pre-registered SecretModel types.
         self.service_instance._register_store_handler(config)
 
+    def test_configure_queues(self):
+        """
+        Verify StorageService._configure_queues serves "storage_models"
+        """
+        default = [{'routing_key': 'storage.*'}]
+        self.assertEquals(
+            self.service_instance._configure_queues(default), default)
+
+        self.service_instance._config_data = {
+            'storage_models': ['Host', 'Host*']}
+        queues = self.service_instance._configure_queues(default)
+        routing_keys = [q['routing_key'] for q in queues]
+        self.assertEquals(routing_keys[0], 'storage.Host.*')
+        self.assertIn('storage.Hosts.*', routing_keys)
+        self.assertEquals(len(set(routing_keys)), len(routing_keys))
+        self.assertEquals(queues[0]['name'], 'storage.Host')
+
+        self.service_instance._config_data = {'storage_models': ['Nope']}
+        self.assertRaises(
+            ConfigurationError, self.service_instance._configure_queues,
+            default)
+
     def test_get_handler(self):
         """
         Verify StorageService._get_handler() works as intended
@@ -598,3 +684,1479 @@ class TestStorageService(TestCase):
         self.assertIsInstance(list_of_models, list)
         self.assertEquals(len(list_of_models), 1)
         self.assertEquals(list_of_models[0], host.to_dict())
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_get_with_revision(self, get_handler):
+        """
+        Verify StorageService.on_get reports content revisions
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+
+        json_data = {'address': '127.0.0.1'}
+        host = models.Host.new(**json_data)
+        handler._get.return_value = host
+
+        message = mock.MagicMock()
+        result = self.service_instance.on_get(
+            message, 'Host', json_data, with_revision=True)
+
+        self.assertEquals(
+            result[REVISION_KEY], content_revision(host.to_dict()))
+        del result[REVISION_KEY]
+        self.assertEquals(result, host.to_dict())
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_get_with_native_revision(self, get_handler):
+        """
+        Verify StorageService.on_get reports native revisions
+        """
+        handler = mock.MagicMock(spec=RevisionedStoreHandlerTest)
+        get_handler.return_value = handler
+
+        json_data = {'address': '127.0.0.1'}
+        host = models.Host.new(**json_data)
+        handler._get_with_revision.return_value = (host, '42')
+
+        message = mock.MagicMock()
+        result = self.service_instance.on_get(
+            message, 'Host', json_data, with_revision=True)
+
+        self.assertEquals(result[REVISION_KEY], '42')
+        handler._get.assert_not_called()
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_get_not_modified(self, get_handler):
+        """
+        Verify StorageService.on_get skips models at the given revision
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+
+        json_data = [{'address': '127.0.0.1'}, {'address': '127.0.0.2'}]
+        hosts = [models.Host.new(**x) for x in json_data]
+        handler._get.side_effect = hosts
+        revision = content_revision(hosts[0].to_dict())
+
+        message = mock.MagicMock()
+        result = self.service_instance.on_get(
+            message, 'Host', json_data, if_not_revision=[revision, 'old'])
+
+        self.assertEquals(
+            result[0], {NOT_MODIFIED_KEY: True, REVISION_KEY: revision})
+        self.assertEquals(
+            result[1][REVISION_KEY], content_revision(hosts[1].to_dict()))
+        self.assertEquals(result[1]['address'], '127.0.0.2')
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_save_with_revision_unsupported(self, get_handler):
+        """
+        Verify StorageService.on_save refuses revisions it can not enforce
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+
+        json_data = {'address': '127.0.0.1', 'status': 'failed'}
+
+        message = mock.MagicMock()
+        self.assertRaises(
+            ValueError,
+            self.service_instance.on_save,
+            message, 'Host', json_data, revision='1')
+
+        handler._get.assert_not_called()
+        handler._save.assert_not_called()
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_save_with_revision_conflict(self, get_handler):
+        """
+        Verify revision checked saves by two services sharing a store
+        """
+        handler = MemoryStoreHandler({})
+        handler.notify = mock.MagicMock()
+        get_handler.return_value = handler
+        services = [self.service_instance, self._create_service()]
+
+        json_data = {'address': '127.0.0.1', 'status': 'active'}
+        message = mock.MagicMock()
+        revision = services[0].on_save(
+            message, 'Host', json_data, with_revision=True)[REVISION_KEY]
+
+        # Both services saw the same revision; only one save may win.
+        json_data['status'] = 'failed'
+        services[0].on_save(message, 'Host', json_data, revision=revision)
+        json_data['status'] = 'disassociated'
+        self.assertRaises(
+            StorageConflictError,
+            services[1].on_save,
+            message, 'Host', json_data, revision=revision)
+        self.assertEquals(
+            handler._get(models.Host.new(address='127.0.0.1')).status,
+            'failed')
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_save_with_native_revision(self, get_handler):
+        """
+        Verify StorageService.on_save defers to native revision checks
+        """
+        handler = mock.MagicMock(spec=RevisionedStoreHandlerTest)
+        get_handler.return_value = handler
+
+        json_data = {'address': '127.0.0.1'}
+        host = models.Host.new(**json_data)
+        handler._save_if_revision.return_value = host
+
+        message = mock.MagicMock()
+        self.service_instance.on_save(
+            message, 'Host', json_data, revision='41')
+
+        self.assertEquals(handler._save_if_revision.call_count, 1)
+        self.assertEquals(
+            handler._save_if_revision.call_args[0][1], '41')
+        handler._get.assert_not_called()
+        handler._save.assert_not_called()
+
+    def test_on_watch(self):
+        """
+        Verify StorageService.on_watch delivers matching events
+        """
+        message = mock.MagicMock()
+        result = self.service_instance.on_watch(
+            message, 'Host', 'watcher_queue', key_filter='192.168.1.*')
+        self.assertFalse(result['reset'])
+
+        simple_queue = self._connection().SimpleQueue
+        simple_queue.reset_mock()
+
+        # Non-matching key and non-matching type.
+        self.service_instance._on_notify(
+            client.NOTIFY_EVENT_UPDATED,
+            models.Host.new(address='10.0.0.1'))
+        self.service_instance._on_notify(
+            client.NOTIFY_EVENT_UPDATED,
+            models.Cluster.new(name='honeynut'))
+        simple_queue.assert_not_called()
+
+        host = models.Host.new(address='192.168.1.1')
+        self.service_instance._on_notify(client.NOTIFY_EVENT_CREATED, host)
+        simple_queue.assert_called_once_with('watcher_queue')
+        event = simple_queue().put.call_args[0][0]
+        self.assertEquals(event['event'], client.NOTIFY_EVENT_CREATED)
+        self.assertEquals(event['key'], '192.168.1.1')
+        self.assertEquals(
+            event['model'][REVISION_KEY], content_revision(host.to_dict()))
+
+        # Resume from before the matching event.
+        simple_queue.reset_mock()
+        result = self.service_instance.on_watch(
+            message, 'Host', 'watcher_queue', key_filter='192.168.1.*',
+            since=event['sequence'] - 1, epoch=result['epoch'],
+            watch_id=result['watch_id'])
+        self.assertFalse(result['reset'])
+        simple_queue().put.assert_called_once_with(event)
+
+        # Resume from another epoch.
+        result = self.service_instance.on_watch(
+            message, 'Host', 'watcher_queue', since=0, epoch='bogus',
+            watch_id=result['watch_id'])
+        self.assertTrue(result['reset'])
+
+        self.assertTrue(
+            self.service_instance.on_unwatch(message, result['watch_id']))
+        self.assertFalse(
+            self.service_instance.on_unwatch(message, result['watch_id']))
+
+    def test_on_watch_across_processes(self):
+        """
+        Verify StorageService.on_watch delivers changes made through other
+        storage service processes
+        """
+        config_data = {'storage_shards': ['Host']}
+        watching = self._create_service(config_data)
+        saving = self._create_service(config_data)
+        message = mock.MagicMock()
+        watching.on_watch(message, 'Host', 'watcher_queue')
+        simple_queue = self._connection().SimpleQueue
+        simple_queue.reset_mock()
+
+        # Both processes receive the notification from the exchange.
+        host = models.Host.new(address='192.168.1.1')
+        saving._on_notify(client.NOTIFY_EVENT_CREATED, host)
+        body = notify_body(client.NOTIFY_EVENT_CREATED, host)
+        saving._storage_notification(body, message)
+        watching._storage_notification(body, message)
+        simple_queue.assert_called_once_with('watcher_queue')
+        event = simple_queue().put.call_args[0][0]
+        self.assertEquals(event['event'], client.NOTIFY_EVENT_CREATED)
+        self.assertEquals(event['key'], '192.168.1.1')
+
+        # The echo of a local change is not delivered twice.
+        watching._on_notify(client.NOTIFY_EVENT_UPDATED, host)
+        watching._storage_notification(
+            notify_body(client.NOTIFY_EVENT_UPDATED, host), message)
+        self.assertEquals(simple_queue.call_count, 2)
+        self.assertEquals(watching._watches.sequence, 2)
+
+    def test_on_watch_with_secret_model(self):
+        """
+        Verify StorageService.on_watch never sends secret model data
+        """
+        message = mock.MagicMock()
+        self.service_instance.on_watch(message, 'HostCreds', 'watcher_queue')
+        simple_queue = self._connection().SimpleQueue
+
+        self.service_instance._on_notify(
+            client.NOTIFY_EVENT_UPDATED,
+            models.HostCreds.new(address='127.0.0.1'))
+        event = simple_queue().put.call_args[0][0]
+        self.assertIsNone(event['model'])
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_get_model_coalescing(self, get_handler):
+        """
+        Verify concurrent StorageService._get_model calls share a lookup
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+
+        host = models.Host.new(address='127.0.0.1')
+        entered = threading.Event()
+        release = threading.Event()
+
+        def slow_get(model_instance):
+            entered.set()
+            release.wait(5)
+            return host
+
+        handler._get.side_effect = slow_get
+
+        results = []
+
+        def get():
+            model = models.Host.new(address='127.0.0.1')
+            results.append(self.service_instance._get_model(model))
+
+        leader = threading.Thread(target=get)
+        leader.start()
+        entered.wait(5)
+        follower = threading.Thread(target=get)
+        follower.start()
+        # Wait until the follower joined the flight.
+        while self.service_instance._flights.shared == 0:
+            time.sleep(0.01)
+        release.set()
+        leader.join(5)
+        follower.join(5)
+
+        self.assertEquals(handler._get.call_count, 1)
+        self.assertEquals(results, [host, host])
+        message = mock.MagicMock()
+        self.assertEquals(
+            self.service_instance.on_stats(message)['coalescing'],
+            {'backend_calls': 1, 'saved_calls': 1})
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_get_model_after_save_during_flight(self, get_handler):
+        """
+        Verify a StorageService._get_model call after a save does not share
+        a lookup which started before the save
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+
+        old = models.Host.new(address='127.0.0.1', status='inactive')
+        new = models.Host.new(address='127.0.0.1', status='active')
+        entered = threading.Event()
+        release = threading.Event()
+
+        def slow_get(model_instance):
+            entered.set()
+            release.wait(5)
+            return old
+
+        handler._get.side_effect = slow_get
+        handler._save.return_value = new
+
+        results = []
+
+        def get():
+            model = models.Host.new(address='127.0.0.1')
+            results.append(self.service_instance._get_model(model))
+
+        leader = threading.Thread(target=get)
+        leader.start()
+        entered.wait(5)
+        self.service_instance._save_model(new, buffered=False)
+        handler._get.side_effect = None
+        handler._get.return_value = new
+        get()
+        release.set()
+        leader.join(5)
+
+        self.assertEquals(handler._get.call_count, 2)
+        self.assertEquals(self.service_instance._flights.shared, 0)
+        self.assertEquals(results, [new, old])
+
+    def test_on_message_with_workers(self):
+        """
+        Verify StorageService.on_message hands messages to workers
+        """
+        executor = mock.MagicMock()
+        self.service_instance._executor = executor
+        self.service_instance._executor_slots = threading.BoundedSemaphore(2)
+
+        message = mock.MagicMock()
+        self.service_instance.on_message('{}', message)
+        executor.submit.assert_called_once_with(
+            self.service_instance._on_message_worker, '{}', message)
+
+        # The worker replies on its own connection and releases its slot
+        # when done, and the message is then acknowledged by the consumer.
+        message.properties = {'reply_to': 'reply_queue'}
+        thread = threading.Thread(
+            target=self.service_instance._on_message_worker,
+            args=('{}', message))
+        thread.start()
+        thread.join()
+        self.assertRaises(
+            ValueError, self.service_instance._executor_slots.release)
+        connection = self._connection()
+        connection.clone().SimpleQueue.assert_called_once_with(
+            'reply_queue')
+        connection.SimpleQueue.assert_not_called()
+
+        message.ack.assert_not_called()
+        self.service_instance.on_iteration()
+        message.ack.assert_called_once_with()
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_get_model_negative_cache(self, get_handler):
+        """
+        Verify StorageService._get_model caches lookup misses
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+        self.service_instance._negative_cache = NegativeCache({'Host': 60})
+
+        model = models.Host.new(address='127.0.0.1')
+        handler._get.side_effect = StorageLookupError('missing', model)
+
+        for _ in range(2):
+            self.assertRaises(
+                StorageLookupError,
+                self.service_instance._get_model, model)
+        self.assertEquals(handler._get.call_count, 1)
+
+        # Saving the model forgets the miss.
+        handler._save.return_value = model
+        self.service_instance._save_model(model)
+        handler._get.side_effect = None
+        handler._get.return_value = model
+        self.assertIs(self.service_instance._get_model(model), model)
+        self.assertEquals(handler._get.call_count, 2)
+
+    def test_negative_cache_generation(self):
+        """
+        Verify NegativeCache ignores misses that raced an invalidation
+        """
+        cache = NegativeCache({'Host': 60, 'Cluster': 0})
+        self.assertTrue(cache.enabled('Host'))
+        self.assertFalse(cache.enabled('Cluster'))
+
+        generation = cache.generation
+        cache.discard('Host', '127.0.0.1')
+        cache.add('Host', '127.0.0.1', generation)
+        self.assertFalse(cache.contains('Host', '127.0.0.1'))
+
+        cache.add('Host', '127.0.0.1', cache.generation)
+        self.assertTrue(cache.contains('Host', '127.0.0.1'))
+        cache.add('Cluster', 'honeynut', cache.generation)
+        self.assertFalse(cache.contains('Cluster', 'honeynut'))
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_get_model_cache(self, get_handler):
+        """
+        Verify StorageService.on_get reuses encoded replies of cached models
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+        self.service_instance._model_cache = ModelCache({'Cluster': 60})
+
+        json_data = {'name': 'honeynut'}
+        cluster = models.Cluster.new(**json_data)
+        handler._get.return_value = cluster
+
+        message = mock.MagicMock()
+        first = self.service_instance.on_get(message, 'Cluster', json_data)
+        second = self.service_instance.on_get(message, 'Cluster', json_data)
+        self.assertIsInstance(first, EncodedJSON)
+        self.assertIs(first, second)
+        self.assertEquals(handler._get.call_count, 1)
+
+        for result in (first, [first, second], {'nested': first}):
+            text = self.service_instance._encode_response(
+                {'jsonrpc': '2.0', 'id': 1, 'result': result})
+            expected = json.loads(json.dumps(result, default=lambda x: x.data))
+            self.assertEquals(
+                json.loads(text),
+                {'jsonrpc': '2.0', 'id': 1, 'result': expected})
+        self.assertEquals(first.data, cluster.to_dict())
+
+        # Saving the model forgets the cached model.
+        handler._save.return_value = cluster
+        self.service_instance.on_save(message, 'Cluster', json_data)
+        self.service_instance.on_get(message, 'Cluster', json_data)
+        self.assertEquals(handler._get.call_count, 2)
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_save_model_write_behind(self, get_handler):
+        """
+        Verify StorageService._save_model merges buffered saves
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+        write_behind = WriteBehindBuffer(
+            {'Host': 60}, self.service_instance._write_buffered)
+        self.service_instance._write_behind = write_behind
+
+        for status in ('investigating', 'bootstrapping', 'active'):
+            host = models.Host.new(address='127.0.0.1', status=status)
+            self.assertIs(self.service_instance._save_model(host), host)
+        handler._save.assert_not_called()
+
+        # Reads see the last save.
+        model = models.Host.new(address='127.0.0.1')
+        self.assertEquals(
+            self.service_instance._get_model(model).status, 'active')
+        handler._get.assert_not_called()
+
+        write_behind.close()
+        handler._save.assert_called_once_with(host)
+        self.assertEquals(write_behind.stats(), {
+            'saves': 3, 'writes': 1, 'saved_writes': 2,
+            'errors': 0, 'pending': 0})
+
+        # Once closed, saves are written right away.
+        handler._save.return_value = host
+        self.service_instance._save_model(host)
+        self.assertEquals(handler._save.call_count, 2)
+
+    def test_write_behind_failed_write(self):
+        """
+        Verify WriteBehindBuffer keeps failed writes and raises them
+        """
+        write = mock.MagicMock(side_effect=IOError('unavailable'))
+        write_behind = WriteBehindBuffer({'Host': 60}, write)
+        host = models.Host.new(address='127.0.0.1', status='active')
+        write_behind.put(host)
+
+        self.assertRaises(IOError, write_behind.flush)
+        self.assertIs(write_behind.get('Host', '127.0.0.1'), host)
+        self.assertEquals(write_behind.stats(), {
+            'saves': 1, 'writes': 0, 'saved_writes': 0,
+            'errors': 1, 'pending': 1})
+
+        write.side_effect = None
+        write_behind.flush()
+        write.assert_called_with(host)
+        self.assertIsNone(write_behind.get('Host', '127.0.0.1'))
+        self.assertEquals(write_behind.stats(), {
+            'saves': 1, 'writes': 1, 'saved_writes': 0,
+            'errors': 1, 'pending': 0})
+        write_behind.close()
+
+    def test_notify_batches(self):
+        """
+        Verify batched notifications reach callbacks one at a time
+        """
+        published = []
+        batcher = NotifyBatcher(
+            {'Host': 60}, lambda key, body: published.append((key, body)))
+        notify = mock.MagicMock()
+        tap = NotifyTap(notify, mock.MagicMock(), threading.RLock(), batcher)
+
+        hosts = [models.Host.new(address='10.0.0.{}'.format(i))
+                 for i in range(3)]
+        for host in hosts:
+            tap.created(host)
+        tap.updated(hosts[0])
+        tap.created(models.HostCreds.new(address='10.0.0.0'))
+        notify.created.assert_called_once_with(mock.ANY)
+        notify.updated.assert_not_called()
+
+        batcher.close()
+        self.assertEquals(
+            [key for key, _ in published],
+            ['notify.storage.Host.' + client.NOTIFY_EVENT_CREATED,
+             'notify.storage.Host.' + client.NOTIFY_EVENT_UPDATED])
+        self.assertEquals(batcher.stats(), {
+            'notifications': 4, 'messages': 2, 'errors': 0, 'pending': 0})
+
+        callback = mock.MagicMock()
+        message = mock.MagicMock()
+        for _, body in published:
+            unbatch(callback)(body, message)
+        unbatch(callback)({'event': 'created'}, message)
+        self.assertEquals(
+            [c[0][0]['model']['address'] for c in callback.call_args_list[:4]],
+            ['10.0.0.0', '10.0.0.1', '10.0.0.2', '10.0.0.0'])
+        self.assertEquals(callback.call_count, 5)
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_delete_where(self, get_handler):
+        """
+        Verify StorageService.on_delete_where deletes matching models
+        """
+        published = []
+
+        def publish(routing_key, body):
+            published.append(body)
+
+        self.service_instance._notify_batcher = NotifyBatcher({}, publish)
+        handler = MemoryStoreHandler({})
+        handler.notify = NotifyTap(
+            mock.MagicMock(), mock.MagicMock(), threading.RLock())
+        get_handler.return_value = handler
+        for address in ('10.0.0.1', '10.0.0.2', '10.0.1.1'):
+            handler._save(models.Host.new(address=address, status='new'))
+        handler._save(models.Host.new(address='10.0.1.2', status='active'))
+
+        # One notification per deleted model.
+        message = mock.MagicMock()
+        self.assertEquals(self.service_instance.on_delete_where(
+            message, 'Host', prefix='10.0.0.'), 2)
+        self.assertEquals(handler.notify._notify.deleted.call_count, 2)
+        self.assertEquals(published, [])
+
+        # One batch for model types with batched notifications.
+        handler.notify._notify.deleted.reset_mock()
+        self.service_instance._notify_batcher = NotifyBatcher(
+            {'Host': 60}, publish)
+        self.assertEquals(self.service_instance.on_delete_where(
+            message, 'Host', where={'status': 'new'}), 1)
+        self.assertEquals(
+            [x.address for x in handler._list(models.Hosts.new()).hosts],
+            ['10.0.1.2'])
+        self.assertEquals(
+            [[x['model']['address'] for x in body['notifications']]
+             for body in published],
+            [['10.0.1.1']])
+        handler.notify._notify.deleted.assert_not_called()
+        self.assertRaises(
+            ValueError, self.service_instance.on_delete_where,
+            message, 'Host')
+
+    @mock.patch('commissaire_service.storage.snapshot.IMPORT_BATCH_SIZE', 2)
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_export_and_import(self, get_handler):
+        """
+        Verify StorageService.on_export snapshots are loaded by on_import
+        """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.service_instance._snapshot_dir = directory
+        source = SqliteStoreHandler(
+            {'path': os.path.join(directory, 'storage.db')})
+        source.notify = mock.MagicMock()
+        for i in range(5):
+            source._save(models.Host.new(address='10.0.0.{}'.format(i)))
+        source._save(models.Cluster.new(name='test'))
+
+        message = mock.MagicMock()
+        get_handler.return_value = source
+        counts = self.service_instance.on_export(message, 'all.json.gz')
+        self.assertEquals((counts['Host'], counts['Cluster']), (5, 1))
+        self.assertEquals(sorted(os.listdir(directory)),
+                          ['all.json.gz', 'storage.db'])
+
+        target = MemoryStoreHandler({})
+        target.notify = mock.MagicMock()
+        get_handler.return_value = target
+        self.assertEquals(
+            self.service_instance.on_import(message, 'all.json.gz'),
+            {'saved': 6, 'failed': 0})
+        self.assertEquals(
+            [x.address for x in target._list(models.Hosts.new()).hosts],
+            ['10.0.0.{}'.format(i) for i in range(5)])
+        self.assertRaises(
+            ValueError, self.service_instance.on_import,
+            message, '../all.json.gz')
+
+        # Malformed lines are skipped.
+        with gzip.open(os.path.join(directory, 'all.json.gz'), 'rt') as f:
+            lines = f.readlines()
+        lines[1:1] = ['{"model_type": "Host", "mod\n', '[]\n']
+        with open(os.path.join(directory, 'corrupt.json'), 'w') as f:
+            f.writelines(lines)
+        self.assertEquals(
+            self.service_instance.on_import(message, 'corrupt.json'),
+            {'saved': 6, 'failed': 2})
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_multi(self, get_handler):
+        """
+        Verify StorageService.on_multi runs operations in order
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+
+        host = models.Host.new(address='127.0.0.1')
+        creds = models.HostCreds.new(address='127.0.0.1')
+        handler._get.side_effect = [
+            host, creds, StorageLookupError('missing', host)]
+        handler._save.return_value = host
+
+        operations = [
+            {'op': 'get', 'model_type': 'Host',
+             'data': {'address': '127.0.0.1'}},
+            {'op': 'get', 'model_type': 'HostCreds',
+             'data': {'address': '127.0.0.1'}},
+            {'op': 'save', 'model_type': 'Host',
+             'data': {'address': '127.0.0.1'}},
+            {'op': 'get', 'model_type': 'Host',
+             'data': {'address': '10.0.0.1'}},
+            {'op': 'delete', 'model_type': 'Host',
+             'data': {'address': '127.0.0.1'}},
+        ]
+
+        message = mock.MagicMock()
+        results = self.service_instance.on_multi(
+            message, operations, stop_on_error=True)
+
+        self.assertEquals(len(results), 4)
+        self.assertEquals(results[0], {'result': host.to_dict()})
+        self.assertEquals(results[1], {'result': creds.to_dict()})
+        self.assertEquals(results[2], {'result': host.to_dict()})
+        self.assertIn('error', results[3])
+        handler._delete.assert_not_called()
+
+        # Without stop_on_error every operation runs.
+        handler._get.side_effect = [StorageLookupError('missing', host)]
+        results = self.service_instance.on_multi(
+            message, operations[3:] + [{'op': 'bogus'}])
+        self.assertEquals(len(results), 3)
+        self.assertIn('error', results[0])
+        self.assertEquals(results[1], {'result': None})
+        self.assertIn('error', results[2])
+        self.assertEquals(handler._delete.call_count, 1)
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_multi_with_bulk_handler(self, get_handler):
+        """
+        Verify StorageService.on_multi groups operations for bulk handlers
+        """
+        handler = mock.MagicMock(spec=BulkStoreHandlerTest)
+        get_handler.return_value = handler
+
+        hosts = [models.Host.new(address='192.168.1.1'),
+                 models.Host.new(address='192.168.1.2')]
+        handler._get_many.return_value = [
+            hosts[0], StorageLookupError('missing', hosts[1])]
+        handler._save_many.return_value = hosts
+
+        operations = [
+            {'op': 'get', 'model_type': 'Host', 'data': h.to_dict()}
+            for h in hosts]
+        operations += [
+            {'op': 'save', 'model_type': 'Host', 'data': h.to_dict()}
+            for h in hosts]
+
+        message = mock.MagicMock()
+        results = self.service_instance.on_multi(message, operations)
+
+        self.assertEquals(handler._get_many.call_count, 1)
+        self.assertEquals(handler._save_many.call_count, 1)
+        handler._get.assert_not_called()
+        handler._save.assert_not_called()
+        self.assertEquals(results[0], {'result': hosts[0].to_dict()})
+        self.assertIn('error', results[1])
+        self.assertEquals(results[2], {'result': hosts[0].to_dict()})
+        self.assertEquals(results[3], {'result': hosts[1].to_dict()})
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_multi_not_modified(self, get_handler):
+        """
+        Verify StorageService.on_multi skips models at the given revision
+        """
+        handler = mock.MagicMock(spec=BulkStoreHandlerTest)
+        get_handler.return_value = handler
+
+        hosts = [models.Host.new(address='192.168.1.1'),
+                 models.Host.new(address='192.168.1.2')]
+        handler._get_many.return_value = hosts
+        revision = content_revision(hosts[0].to_dict())
+
+        operations = [
+            {'op': 'get', 'model_type': 'Host', 'data': h.to_dict(),
+             'if_not_revision': x}
+            for h, x in zip(hosts, (revision, 'old'))]
+
+        message = mock.MagicMock()
+        results = self.service_instance.on_multi(message, operations)
+
+        self.assertEquals(handler._get_many.call_count, 1)
+        self.assertEquals(
+            results[0],
+            {'result': {NOT_MODIFIED_KEY: True, REVISION_KEY: revision}})
+        self.assertEquals(
+            results[1]['result'][REVISION_KEY],
+            content_revision(hosts[1].to_dict()))
+        self.assertEquals(results[1]['result']['address'], '192.168.1.2')
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_count_and_aggregate(self, get_handler):
+        """
+        Verify StorageService.on_count and on_aggregate work as intended
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+
+        hosts = [
+            models.Host.new(address='192.168.1.1', status='active', os='a'),
+            models.Host.new(address='192.168.1.2', status='active', os='b'),
+            models.Host.new(address='192.168.1.3', status='failed', os='a'),
+        ]
+        handler._list.return_value = models.Hosts.new(hosts=hosts)
+
+        message = mock.MagicMock()
+        self.assertEquals(
+            self.service_instance.on_count(message, 'Hosts'), 3)
+        self.assertEquals(
+            self.service_instance.on_aggregate(message, 'Hosts', 'status'),
+            [[['active'], 2], [['failed'], 1]])
+        result = self.service_instance.on_aggregate(
+            message, 'Hosts', ['status', 'os'])
+        self.assertEquals(len(result), 3)
+        self.assertIn([['active', 'b'], 1], result)
+        self.assertRaises(
+            ValueError,
+            self.service_instance.on_aggregate,
+            message, 'Hosts', 'bogus')
+        self.assertRaises(
+            ValueError, self.service_instance.on_count, message, 'Host')
+        self.assertRaises(
+            ValueError,
+            self.service_instance.on_aggregate,
+            message, 'Host', 'status')
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_count_and_aggregate_in_store(self, get_handler):
+        """
+        Verify StorageService.on_count and on_aggregate use the store
+        """
+        handler = MemoryStoreHandler({})
+        handler.notify = mock.MagicMock()
+        get_handler.return_value = handler
+        handler._save(models.Host.new(address='192.168.1.1', status='active'))
+        handler._save(models.Host.new(address='192.168.1.2', status='active'))
+        handler._save(models.Host.new(address='192.168.1.3', status='failed'))
+        handler._list = mock.MagicMock(side_effect=AssertionError)
+
+        message = mock.MagicMock()
+        self.assertEquals(
+            self.service_instance.on_count(message, 'Hosts'), 3)
+        self.assertEquals(
+            self.service_instance.on_aggregate(message, 'Hosts', 'status'),
+            [[['active'], 2], [['failed'], 1]])
+        self.assertRaises(
+            ValueError,
+            self.service_instance.on_aggregate,
+            message, 'Hosts', 'bogus')
+
+    def test_warm_up_handlers(self):
+        """
+        Verify StorageService._warm_up_handlers probes every handler
+        """
+        self.service_instance._register_store_handler({
+            'type': 'test',
+            'name': 'default',
+            'models': ['Host']
+        })
+        custodia_name = CustodiaStoreHandler.__module__
+
+        with mock.patch.object(
+                StoreHandlerTest, '_get',
+                side_effect=StorageLookupError('missing')) as test_get, \
+            mock.patch.object(
+                CustodiaStoreHandler, '_get',
+                side_effect=ConnectionError('refused')):
+            not_ready = self.service_instance._warm_up_handlers()
+
+        self.assertEquals(not_ready, set([custodia_name]))
+        self.assertEquals(test_get.call_count, 1)
+        self.assertEquals(
+            test_get.call_args[0][0].address, '__commissaire_probe__')
+        status = self.service_instance._handler_status
+        self.assertTrue(status['default']['ready'])
+        self.assertFalse(status[custodia_name]['ready'])
+        self.assertIn('refused', status[custodia_name]['error'])
+        self.assertIn(
+            'default', self.service_instance._handlers_by_name)
+
+        # Ready handlers are not probed again.
+        with mock.patch.object(
+                StoreHandlerTest, '_get') as test_get, \
+            mock.patch.object(
+                CustodiaStoreHandler, '_get',
+                side_effect=StorageLookupError('missing')):
+            not_ready = self.service_instance._warm_up_handlers()
+        self.assertEquals(not_ready, set())
+        test_get.assert_not_called()
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_on_stats_latency_and_hot_keys(self, get_handler):
+        """
+        Verify StorageService.on_stats reports latency and hot keys
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+        host = models.Host.new(address='127.0.0.1')
+        handler._get.side_effect = [
+            host, host, StorageLookupError('missing'), ConnectionError()]
+
+        message = mock.MagicMock()
+        for address in ('127.0.0.1', '127.0.0.1', '127.0.0.2', '127.0.0.3'):
+            try:
+                self.service_instance.on_get(
+                    message, 'Host', {'address': address})
+            except Exception:
+                pass
+
+        stats = self.service_instance.on_stats(message)
+        rows = {(r['handler'], r['model_type'], r['op']): r
+                for r in stats['latency']}
+        get_row = rows[('MagicMock', 'Host', 'get')]
+        self.assertEquals(get_row['count'], 4)
+        self.assertEquals(get_row['misses'], 1)
+        self.assertEquals(get_row['errors'], 1)
+        self.assertEquals(sum(get_row['buckets'].values()), 4)
+        self.assertEquals(rows[('MagicMock', 'Host', 'validate')]['count'], 2)
+        self.assertEquals(
+            stats['hot_keys'][0],
+            {'model_type': 'Host', 'key': '127.0.0.1', 'count': 2})
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_get_model_skips_validated_revision(self, get_handler):
+        """
+        Verify StorageService._get_model skips validating known revisions
+        """
+        handler = mock.MagicMock(spec=RevisionedStoreHandlerTest)
+        get_handler.return_value = handler
+
+        saved = models.Host.new(address='127.0.0.1')
+        setattr(saved, REVISION_KEY, '42')
+        handler._save_if_revision.return_value = saved
+        self.service_instance._save_model(models.Host.new(address='127.0.0.1'))
+
+        for revision, skipped in (('42', 1), ('43', 1), ('43', 2)):
+            host = models.Host.new(address='127.0.0.1')
+            handler._get_with_revision.return_value = (host, revision)
+            self.service_instance._get_model(
+                models.Host.new(address='127.0.0.1'))
+            self.assertEquals(
+                self.service_instance._validation.skipped, skipped)
+
+        # Invalid models are still rejected.
+        host = models.Host.new(address='127.0.0.1')
+        host.status = None
+        handler._get_with_revision.return_value = (host, '44')
+        self.assertRaises(
+            models.ValidationError,
+            self.service_instance._get_model,
+            models.Host.new(address='127.0.0.1'))
+
+    def test_list_hosts_fan_out(self):
+        """
+        Verify StorageService.on_list lists Hosts from every source
+        """
+        for name, model_names in (('default', ['*']),
+                                  ('remote', []),
+                                  ('slow', [])):
+            self.service_instance._register_store_handler({
+                'type': 'test',
+                'name': name,
+                'models': model_names
+            })
+        self.service_instance._list_timeout = 0.5
+        release = threading.Event()
+        self.addCleanup(release.set)
+
+        addresses = {
+            'default': ['192.168.1.1', '192.168.1.2'],
+            'remote': ['192.168.1.2', '192.168.1.3'],
+            'slow': ['192.168.1.4'],
+        }
+
+        def list_hosts(handler, model_instance):
+            name = self.service_instance._handler_name(handler)
+            if name == 'slow':
+                release.wait(5)
+            return models.Hosts.new(hosts=[
+                models.Host.new(address=x, source=name)
+                for x in addresses[name]])
+
+        message = mock.MagicMock()
+        with mock.patch.object(
+                StoreHandlerTest, '_list', autospec=True,
+                side_effect=list_hosts):
+            result = self.service_instance.on_list(
+                message, 'Hosts', stream_queue='partial')
+
+        self.assertEquals(
+            [(x['address'], x['source']) for x in result],
+            [('192.168.1.1', 'default'),
+             ('192.168.1.2', 'default'),
+             ('192.168.1.3', 'remote')])
+        put = self._connection().SimpleQueue().put
+        self.assertEquals(
+            sorted(x[0][0]['handler'] for x in put.call_args_list),
+            ['default', 'remote'])
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_sweep_retention(self, get_handler):
+        """
+        Verify StorageService._sweep_retention applies retention policies
+        """
+        handler = mock.MagicMock(spec=ExpiringStoreHandlerTest)
+        get_handler.return_value = handler
+        self.service_instance._retention = {
+            'ClusterUpgrade': RetentionPolicy(
+                models.ClusterUpgrade, {'ttl': 3600, 'keep_last': 2})}
+
+        now = datetime.utcnow()
+
+        def record(name, age):
+            finished_at = ''
+            if age is not None:
+                finished_at = (now - timedelta(seconds=age)).strftime(
+                    C.DATE_FORMAT)
+            return models.ClusterUpgrade.new(
+                name=name, status='finished', finished_at=finished_at)
+
+        records = [record('a', 10), record('b', 7200), record('c', 20),
+                   record('d', 30), record('e', None)]
+        with mock.patch.object(
+                self.service_instance, '_retention_records',
+                return_value=records):
+            self.assertEquals(self.service_instance._sweep_retention(), 2)
+        self.assertEquals(
+            sorted(x[0][0].name for x in handler._delete.call_args_list),
+            ['b', 'd'])
+
+        # Finished records are saved with a native TTL.
+        handler._save_with_ttl.return_value = records[0]
+        self.service_instance._save_model(records[0])
+        self.assertEquals(handler._save_with_ttl.call_count, 1)
+        self.assertTrue(
+            3580 < handler._save_with_ttl.call_args[0][1] <= 3600)
+        self.service_instance._save_model(records[4])
+        self.assertEquals(handler._save_with_ttl.call_count, 1)
+        self.assertEquals(handler._save.call_count, 1)
+
+        self.assertRaises(
+            ConfigurationError,
+            RetentionPolicy, models.ClusterUpgrade, {'ttl': -1})
+        self.assertRaises(
+            ConfigurationError,
+            RetentionPolicy, models.Host, {'ttl': 60})
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_save_models_with_retention_ttl(self, get_handler):
+        """
+        Verify StorageService._save_models saves with retention TTLs
+        """
+        handler = mock.MagicMock(spec=BulkExpiringStoreHandlerTest)
+        get_handler.return_value = handler
+        self.service_instance._retention = {
+            'ClusterUpgrade': RetentionPolicy(
+                models.ClusterUpgrade, {'ttl': 3600})}
+
+        finished = models.ClusterUpgrade.new(
+            name='a', status='finished',
+            finished_at=datetime.utcnow().strftime(C.DATE_FORMAT))
+        running = models.ClusterUpgrade.new(name='b', status='in_process')
+        handler._save_with_ttl.return_value = finished
+        handler._save_many.return_value = [running]
+
+        self.assertEquals(
+            self.service_instance._save_models([finished, running]),
+            [finished, running])
+        handler._save_with_ttl.assert_called_once_with(finished, mock.ANY)
+        handler._save_many.assert_called_once_with([running])
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_write_journal(self, get_handler):
+        """
+        Verify StorageService journals writes while a store is unreachable
+        """
+        handler = mock.MagicMock()
+        get_handler.return_value = handler
+        handler._save.side_effect = ConnectionError('refused')
+        handler._delete.side_effect = ConnectionError('refused')
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'storage.journal')
+
+        def create_journal():
+            return WriteJournal(
+                path, {'Host'}, 2,
+                self.service_instance._replay_journal_entry,
+                self.service_instance._build_model)
+
+        journal = create_journal()
+        self.service_instance._journal = journal
+
+        host = models.Host.new(address='127.0.0.1', status='active')
+        self.assertIs(self.service_instance._save_model(host), host)
+        model = models.Host.new(address='127.0.0.1')
+        self.assertEquals(
+            self.service_instance._get_model(model).status, 'active')
+        handler._get.assert_not_called()
+
+        self.service_instance._delete_model(model)
+        self.assertRaises(
+            StorageLookupError, self.service_instance._get_model, model)
+        self.assertRaises(
+            RuntimeError, self.service_instance._save_model, host)
+        self.assertEquals(handler._save.call_count, 1)
+        self.assertEquals(handler._delete.call_count, 0)
+
+        # The journal survives a restart.
+        journal.close()
+        journal = create_journal()
+        self.service_instance._journal = journal
+        self.assertEquals(journal.backlog, 2)
+
+        # Nothing is replayed while the store is unreachable.
+        self.assertEquals(journal.replay(), 0)
+
+        handler._save.side_effect = None
+        handler._save.return_value = host
+        handler._delete.side_effect = None
+        self.assertEquals(journal.replay(), 2)
+        self.assertEquals(
+            handler._save.call_args[0][0].to_dict(), host.to_dict())
+        self.assertEquals(handler._delete.call_count, 1)
+        self.assertEquals(journal.backlog, 0)
+        self.assertEquals(journal.stats()['replayed'], 2)
+        journal.close()
+        self.assertEquals(os.path.getsize(path), 0)
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_write_journal_bulk(self, get_handler):
+        """
+        Verify StorageService journals bulk saves while a store is
+        unreachable
+        """
+        handler = mock.MagicMock(spec=BulkStoreHandlerTest)
+        get_handler.return_value = handler
+        handler._save_many.side_effect = ConnectionError('refused')
+        handler._save.side_effect = ConnectionError('refused')
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        journal = WriteJournal(
+            os.path.join(directory, 'storage.journal'), {'Host'}, 10,
+            self.service_instance._replay_journal_entry,
+            self.service_instance._build_model)
+        self.addCleanup(journal.close)
+        self.service_instance._journal = journal
+
+        hosts = [models.Host.new(address='127.0.0.{}'.format(i))
+                 for i in range(1, 3)]
+        self.assertEquals(self.service_instance._save_models(hosts), hosts)
+        self.assertEquals(journal.backlog, 2)
+
+        # Further saves are journaled behind the pending ones.
+        host = models.Host.new(address='127.0.0.3')
+        self.assertEquals(
+            self.service_instance._save_models([host]), [host])
+        self.assertEquals(handler._save_many.call_count, 1)
+        self.assertEquals(journal.backlog, 3)
+
+
+    @mock.patch('commissaire_service.storage.StorageService._get_handler')
+    def test_write_journal_lists(self, get_handler):
+        """
+        Verify StorageService lists, counts and aggregates see journaled
+        writes
+        """
+        handler = MemoryStoreHandler({})
+        handler.notify = mock.MagicMock()
+        get_handler.return_value = handler
+        for address in ('10.0.0.1', '10.0.0.2'):
+            handler._save(models.Host.new(address=address, status='new'))
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'storage.journal')
+        journal = WriteJournal(
+            path, {'Host'}, 10,
+            self.service_instance._replay_journal_entry,
+            self.service_instance._build_model)
+        self.addCleanup(journal.close)
+        self.service_instance._journal = journal
+
+        # Another process sharing the path uses its own file.
+        other = WriteJournal(
+            path, {'Host'}, 10, mock.MagicMock(), mock.MagicMock())
+        self.addCleanup(other.close)
+        self.assertEquals(other._path, path + '.1')
+
+        with mock.patch.object(
+                handler, '_save_if_revision',
+                side_effect=ConnectionError('refused')), \
+                mock.patch.object(
+                    handler, '_delete',
+                    side_effect=ConnectionError('refused')):
+            for address in ('10.0.0.1', '10.0.0.3'):
+                self.service_instance._save_model(
+                    models.Host.new(address=address, status='active'))
+            self.service_instance._delete_model(
+                models.Host.new(address='10.0.0.2'))
+        self.assertEquals(journal.backlog, 3)
+
+        message = mock.MagicMock()
+        self.assertEquals(
+            [x.to_dict() for x in self.service_instance._list_models(
+                models.Hosts.new())],
+            [models.Host.new(address=address, status='active').to_dict()
+             for address in ('10.0.0.1', '10.0.0.3')])
+        self.assertEquals(
+            self.service_instance.on_count(message, 'Hosts'), 2)
+        self.assertEquals(
+            self.service_instance.on_aggregate(message, 'Hosts', 'status'),
+            [[['active'], 2]])
+
+class TestCustodiaStoreHandler(TestCase):
+    """
+    Tests for the CustodiaStoreHandler class.
+    """
+
+    def setUp(self):
+        """
+        Called before each test.
+        """
+        self.handler = CustodiaStoreHandler({})
+        self.request = mock.MagicMock()
+        self.handler._session = mock.MagicMock(
+            return_value=mock.MagicMock(request=self.request))
+
+    def test_save_known_container(self):
+        """
+        Verify CustodiaStoreHandler._save creates each key container once
+        """
+        self.request.return_value = mock.MagicMock(status_code=201)
+        for address in ('10.0.0.1', '10.0.0.2'):
+            creds = models.HostCreds.new(address=address)
+            self.assertIs(self.handler._save(creds), creds)
+        methods = [c[0][0] for c in self.request.call_args_list]
+        self.assertEquals(methods, ['POST', 'PUT', 'PUT'])
+
+        # The container is created again if it vanished.
+        self.request.reset_mock()
+        self.request.side_effect = [
+            mock.MagicMock(status_code=404),
+            mock.MagicMock(status_code=201),
+            mock.MagicMock(status_code=201)]
+        self.handler._save(creds)
+        methods = [c[0][0] for c in self.request.call_args_list]
+        self.assertEquals(methods, ['PUT', 'POST', 'PUT'])
+
+    def test_get_many(self):
+        """
+        Verify CustodiaStoreHandler._get_many returns creds in order
+        """
+        def request(method, url, **kwargs):
+            address = url.rsplit('/', 1)[1]
+            if address == '10.0.0.2':
+                return mock.MagicMock(
+                    status_code=404, raise_for_status=mock.MagicMock(
+                        side_effect=requests.HTTPError(
+                            response=mock.MagicMock(status_code=404))))
+            return mock.MagicMock(
+                status_code=200, json=lambda: {'address': address})
+
+        self.request.side_effect = request
+        addresses = ['10.0.0.{}'.format(i) for i in range(5)]
+        results = self.handler._get_many(
+            [models.HostCreds.new(address=x) for x in addresses])
+        self.assertIsInstance(results[2], StorageLookupError)
+        self.assertEquals(
+            [getattr(x, 'address', None) for x in results],
+            ['10.0.0.0', '10.0.0.1', None, '10.0.0.3', '10.0.0.4'])
+        self.assertEquals(self.request.call_count, 5)
+
+    def test_get_secret_cache(self):
+        """
+        Verify CustodiaStoreHandler._get caches secrets when configured
+        """
+        handler = CustodiaStoreHandler({'cache_ttl': 60, 'cache_size': 1})
+        handler._session = self.handler._session
+        self.request.return_value = mock.MagicMock(
+            status_code=200, content=b'{"address": "10.0.0.1"}',
+            json=lambda: {'address': '10.0.0.1'})
+
+        creds = models.HostCreds.new(address='10.0.0.1')
+        for _ in range(2):
+            self.assertEquals(handler._get(creds).address, '10.0.0.1')
+        self.assertEquals(self.request.call_count, 1)
+        cached = next(iter(handler._cache._entries.values()))[1]
+
+        # Saves invalidate and zero the cached secret.
+        handler._save(creds)
+        self.assertEquals(cached, bytearray(len(cached)))
+        self.request.reset_mock()
+        handler._get(creds)
+        self.assertEquals(self.request.call_count, 1)
+
+        # The least recently used secret is evicted.
+        cached = next(iter(handler._cache._entries.values()))[1]
+        handler._get(models.HostCreds.new(address='10.0.0.2'))
+        self.assertEquals(cached, bytearray(len(cached)))
+        self.assertEquals(len(handler._cache._entries), 1)
+
+    @mock.patch('time.sleep')
+    def test_request_retries(self, sleep):
+        """
+        Verify CustodiaStoreHandler retries requests which fail to connect
+        """
+        handler = CustodiaStoreHandler({
+            'retries': 1, 'timeout': 2, 'timeouts': {'get': [0.5, 1]}})
+        handler._session = self.handler._session
+        response = mock.MagicMock(
+            status_code=200, json=lambda: {'address': '10.0.0.1'})
+        self.request.side_effect = [requests.ConnectionError(), response]
+        creds = models.HostCreds.new(address='10.0.0.1')
+        self.assertEquals(handler._get(creds).address, '10.0.0.1')
+        self.assertEquals(sleep.call_count, 1)
+        self.assertEquals(
+            self.request.call_args[1]['timeout'], (0.5, 1))
+
+        self.request.side_effect = requests.Timeout()
+        self.assertRaises(requests.Timeout, handler._delete, creds)
+        self.assertEquals(self.request.call_args[1]['timeout'], 2)
+
+        for config in ({'pool_size': -1}, {'timeout': [1]},
+                       {'timeouts': {'list': 1}}):
+            self.assertRaises(
+                ConfigurationError, CustodiaStoreHandler.check_config,
+                config)
+
+
+class TestLocalStoreHandlers(TestCase):
+    """
+    Tests for the MemoryStoreHandler and SqliteStoreHandler classes.
+    """
+
+    def setUp(self):
+        """
+        Called before each test.
+        """
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """
+        Called after each test.
+        """
+        shutil.rmtree(self.directory)
+
+    def test_store_handlers(self):
+        """
+        Verify the local store handlers save, get, list and delete
+        """
+        for handler in (MemoryStoreHandler({}), SqliteStoreHandler(
+                {'path': os.path.join(self.directory, 'storage.db')})):
+            handler.notify = mock.MagicMock()
+            host = models.Host.new(address='10.0.0.2', status='new')
+            revision = handler._save(host)._revision
+            handler._save(models.Host.new(address='10.0.0.1'))
+            handler.notify.created.assert_called_with(mock.ANY)
+
+            model, actual = handler._get_with_revision(
+                models.Host.new(address='10.0.0.2'))
+            self.assertEquals((model.status, actual), ('new', revision))
+            self.assertRaises(
+                StorageConflictError, handler._save_if_revision,
+                host, 'stale')
+            handler._save_if_revision(host, revision)
+            handler.notify.updated.assert_called_once_with(host)
+
+            hosts = handler._list(models.Hosts.new()).hosts
+            self.assertEquals(
+                [x.address for x in hosts], ['10.0.0.1', '10.0.0.2'])
+
+            results = handler._get_many([
+                models.Host.new(address='10.0.0.2'),
+                models.Host.new(address='10.0.0.3')])
+            self.assertEquals(results[0].address, '10.0.0.2')
+            self.assertIsInstance(results[1], StorageLookupError)
+            results = handler._save_many([
+                models.Host.new(address='10.0.0.3'),
+                models.Host.new(address='10.0.0.4')])
+            self.assertEquals(len(set(x._revision for x in results)), 2)
+
+            handler._delete(host)
+            handler.notify.deleted.assert_called_once_with(host)
+            self.assertRaises(StorageLookupError, handler._get, host)
+            self.assertRaises(StorageLookupError, handler._delete, host)
+
+            deleted = handler._delete_prefix(models.Hosts.new(), '10.0.0.')
+            self.assertEquals(
+                [x.address for x in deleted],
+                ['10.0.0.1', '10.0.0.3', '10.0.0.4'])
+            self.assertEquals(handler._list(models.Hosts.new()).hosts, [])
+
+    def test_count_and_aggregate(self):
+        """
+        Verify the local store handlers count and group models
+        """
+        for handler in (MemoryStoreHandler({}), SqliteStoreHandler(
+                {'path': os.path.join(self.directory, 'storage.db')})):
+            handler.notify = mock.MagicMock()
+            handler._save_many([
+                models.Host.new(address='10.0.0.1', status='active'),
+                models.Host.new(address='10.0.0.2', status='failed'),
+                models.Host.new(address='10.0.0.3', status='active')])
+            self.assertEquals(handler._count(models.Hosts.new()), 3)
+            self.assertEquals(
+                handler._aggregate(models.Hosts.new(), ['status']),
+                [[['active'], 2], [['failed'], 1]])
+
+    @mock.patch('commissaire_service.storage.sqlite.json_available')
+    def test_sqlite_aggregate_without_json(self, json_available):
+        """
+        Verify SqliteStoreHandler groups models itself without JSON support
+        in SQLite
+        """
+        json_available.return_value = False
+        path = os.path.join(self.directory, 'storage.db')
+        handler = SqliteStoreHandler({'path': path})
+        handler.notify = mock.MagicMock()
+        handler._save_many([
+            models.Host.new(address='10.0.0.1', status='active'),
+            models.Host.new(address='10.0.0.2', status='failed'),
+            models.Host.new(address='10.0.0.3', status='active')])
+        self.assertEquals(
+            handler._aggregate(models.Hosts.new(), ['status']),
+            [[['active'], 2], [['failed'], 1]])
+        self.assertEquals(
+            handler._connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'"
+                " AND name = 'models_status'").fetchall(), [])
+
+    def test_sqlite_revision_check_across_connections(self):
+        """
+        Verify SqliteStoreHandler checks revisions while holding the write
+        lock of the database
+        """
+        path = os.path.join(self.directory, 'storage.db')
+        handler = SqliteStoreHandler({'path': path})
+        handler.notify = mock.MagicMock()
+        host = models.Host.new(address='10.0.0.1', status='new')
+        revision = handler._save(host)._revision
+
+        # Another process writes the model while the save waits.
+        other = sqlite3.connect(path, isolation_level=None)
+        self.addCleanup(other.close)
+        other.execute('BEGIN IMMEDIATE')
+        other.execute('UPDATE models SET revision = revision + 100')
+        errors = []
+
+        def save():
+            try:
+                handler._save_if_revision(host, revision)
+            except StorageConflictError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target=save)
+        thread.start()
+        time.sleep(0.2)
+        other.execute('COMMIT')
+        thread.join()
+        self.assertEquals(len(errors), 1)
+
+
+class TestHedgedReader(TestCase):
+    """
+    Tests for the HedgedReader class.
+    """
+
+    def test_read(self):
+        """
+        Verify HedgedReader hedges slow reads within its budget
+        """
+        def read(endpoint):
+            if endpoint == 'slow':
+                time.sleep(0.2)
+            return endpoint
+
+        reader = HedgedReader(['fast'], budget=0.5)
+        for seconds in range(1, HedgedReader.RECOMPUTE_EVERY + 1):
+            reader._record(seconds / 1000.0)
+        self.assertEquals(reader.delay, 0.048)
+
+        # The budget allows no hedge yet.
+        self.assertEquals(reader.read(read, 'slow'), 'slow')
+        self.assertEquals(reader.read(read, 'fast'), 'fast')
+        # Hedged to the hedge endpoint, which answers first.
+        self.assertEquals(reader.read(read, 'slow'), 'fast')
+        stats = reader.stats()
+        self.assertEquals(
+            (stats['reads'], stats['hedged'], stats['hedge_wins'],
+             stats['denied']), (3, 1, 1, 1))
+
+
+class TestEtcdStoreHandler(TestCase):
+    """
+    Tests for the EtcdStoreHandler class.
+    """
+
+    def test_get_after_save_with_endpoints(self):
+        """
+        Verify EtcdStoreHandler gets its own saves when hedging gets
+        """
+        urls = ['http://10.0.0.{}:2379'.format(i) for i in range(1, 4)]
+        members = [mock.MagicMock(), mock.MagicMock()]
+        with mock.patch(
+                'commissaire_service.storage.etcd.'
+                'EtcdStoreHandler._endpoint_client', side_effect=members):
+            handler = EtcdStoreHandler({
+                'server_url': urls[0], 'endpoints': urls, 'hedge_budget': 1})
+        handler.notify = mock.MagicMock()
+        handler._store = mock.MagicMock()
+
+        host = models.Host.new(address='10.0.0.9', status='active')
+        handler._store.write.return_value = mock.MagicMock(
+            modifiedIndex=7, newKey=False)
+        handler._store.read.return_value = mock.MagicMock(
+            value=host.to_json(), modifiedIndex=7, etcd_index=7)
+        # The other members have not applied the save yet.
+        for member in members:
+            member.read.return_value = mock.MagicMock(
+                value=models.Host.new(
+                    address='10.0.0.9', status='new').to_json(),
+                modifiedIndex=3, etcd_index=5)
+
+        handler._save(host)
+        model, revision = handler._get_with_revision(
+            models.Host.new(address='10.0.0.9'))
+        self.assertEquals((model.status, revision), ('active', '7'))
+        for member in members:
+            member.read.assert_not_called()
+
+        # A slow get is hedged, but the lagging member's answer is ignored.
+        for _ in range(HedgedReader.RECOMPUTE_EVERY):
+            handler._hedge._record(0.001)
+
+        def slow_read(key):
+            time.sleep(0.1)
+            return handler._store.read.return_value
+
+        handler._store.read.side_effect = slow_read
+        model, revision = handler._get_with_revision(
+            models.Host.new(address='10.0.0.9'))
+        self.assertEquals((model.status, revision), ('active', '7'))
+        self.assertEquals(members[0].read.call_count, 1)
+        self.assertEquals(handler.hedge_stats()['hedge_wins'], 0)